@@ -1,28 +1,93 @@
 """Analiza páginas escaneadas usando GPT-4o mini (visión) para extraer datos.
 
 Optimizaciones de velocidad:
-- Procesamiento PARALELO (todas las páginas a la vez, con semáforo)
-- Imágenes JPEG comprimidas (en vez de PNG pesados)
+- Procesamiento PARALELO con concurrencia adaptativa (AIMD, RPM/TPM, Retry-After)
+- Modo streaming: cada página se envía en cuanto el splitter la renderiza
+- Imágenes JPEG comprimidas (en vez de PNG pesados), recortadas al contenido
+  y ajustadas a los tiles del modelo (core.image_optimizer)
 - detail: "low" por defecto (4x menos tokens)
+- Cascada de modelos: barato en low → barato en high → fallback, cada modelo
+  con su propio pool de concurrencia y timeout
 - response_format: json_object (respuesta más limpia y rápida)
-- Post-proceso local para detección de continuaciones
+- Facturas sin albaranes referenciados: el reintento envía solo el recorte de
+  la tabla de líneas (core.layout), no la página entera
+- Resultados definitivos entregados en orden de página (`on_page`) para
+  agrupar documentos en línea (core.grouper)
+- Páginas en blanco (detectadas en el splitter) sin llamada a la API
+- Facturas con QR VeriFactu/TicketBAI (decodificado en el splitter): NIF, nº
+  y fecha sin llamada de fase 1; solo suben por la cascada a por proveedor y
+  albaranes referenciados
+- Páginas de PDF nativo: llamada solo-texto (o parsers locales), sin imagen
+- Opcional: varias páginas consecutivas por llamada (un solo prompt de sistema)
+- Opcional: clasificar primero (miniatura + prompt corto) y extraer solo las
+  páginas que empiezan documento; las continuaciones se quedan con la
+  clasificación
 """
 
 from __future__ import annotations
 import asyncio
 import base64
+import hashlib
 import json
 import logging
 import time
+from dataclasses import replace
 from datetime import date
 from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable
 
 from openai import AsyncOpenAI
 
+from .image_store import PageImageStore
+from .config import CascadeStep
+from .hedging import Hedger
+from .image_optimizer import ImageOptions, optimize_image_bytes
+from .layout import crop_line_items
+from .local_ocr import LocalOcrEngine
 from .models import PageResult, TipoDocumento
+from .rate_limiter import AdaptiveLimiter, retry_after_seconds
+from .result_cache import PageResultCache
+from .splitter import JPEG_QUALITY
+from .supplier_templates import TemplateStore, read_template_fields
+from .text_layer import parse_document_text
+from .validators import PageValidator, valid_document_number
 
 logger = logging.getLogger(__name__)
 
+# Origen de cada PageResult (qué etapa lo produjo)
+ORIGEN_VISION = "vision"
+ORIGEN_CLASIFICACION = "clasificacion"  # continuación resuelta solo con la clasificación
+ORIGEN_TEXTO = "texto"
+ORIGEN_TEXTO_LOCAL = "texto-local"
+ORIGEN_BLANCO = "blanco"
+ORIGEN_CODIGO = "codigo"  # QR fiscal decodificado localmente
+ORIGEN_OCR = "ocr-local"  # página escaneada leída con OCR local
+_TEXT_ORIGINS = (ORIGEN_TEXTO, ORIGEN_TEXTO_LOCAL)
+_VISION_ORIGINS = (ORIGEN_VISION, ORIGEN_CLASIFICACION)
+# Resueltas sin ninguna llamada a la API
+_LOCAL_ORIGINS = (ORIGEN_BLANCO, ORIGEN_TEXTO_LOCAL, ORIGEN_CODIGO, ORIGEN_OCR)
+
+# Campos que los parsers locales pueden rellenar si el modelo los deja vacíos
+_LOCAL_FILL_KEYS = (
+    "proveedor_nif", "numero_factura", "numero_albaran",
+    "numeros_albaran_referenciados", "numero_pedido", "fecha",
+)
+
+# Máximo de caracteres de texto enviados en la llamada solo-texto
+TEXT_MAX_CHARS = 8000
+
+# Umbral de confianza por debajo del cual se reintenta con detail:high
+LOW_CONFIDENCE = 0.6
+# Prioridad en el limitador (menor = antes). Los reintentos van primero: son
+# pocos y así no se acumulan al final del lote detrás de páginas nuevas
+PRIORITY_RETRY = 0
+PRIORITY_PAGE = 1
+
+# Motor de las páginas escaneadas (`vision_backend`)
+BACKEND_LLM = "llm"                  # solo la API de visión
+BACKEND_LOCAL_FIRST = "local-first"  # OCR local; a la API si el resultado no basta
+BACKEND_LOCAL = "local"              # solo OCR local, sin red
+
 SYSTEM_PROMPT = """Eres un asistente experto en clasificación de documentos contables de COMPRA españoles.
 Estos son documentos que la empresa FABRICACIONES METÁLICAS VALDEPINTO S.L. (FMV) RECIBE de sus proveedores.
 
@@ -100,14 +165,103 @@ Responde con JSON:
 
 confianza: 0.9-1.0 si ves datos claros, 0.5-0.8 si hay ambigüedad, <0.5 si no estás seguro."""
 
+MULTI_PAGE_INSTRUCTIONS = """
+
+═══════════════════════════════════════
+6. VARIAS PÁGINAS EN UNA PETICIÓN
+═══════════════════════════════════════
+Si recibes varias páginas consecutivas, analiza CADA una por separado y responde con:
+
+{"paginas": [ {objeto de la página 1 del grupo}, {objeto de la página 2}, ... ]}
+
+- Un objeto por página, en el mismo orden, con el formato del apartado 5.
+- es_continuacion_anterior de cada página se refiere a la página INMEDIATAMENTE anterior
+  (para la primera del grupo, a la página previa que no ves)."""
+
+# Reintento de facturas a las que solo les faltan los albaranes: recorte de la tabla
+REGION_PROMPT = """Recibes un RECORTE de una factura de COMPRA española: la tabla de líneas de detalle
+(con su cabecera de columnas si se ve).
+
+Extrae TODOS los números de albarán referenciados en las líneas:
+- "Alb.", "Albarán", "N/A", "Nº Alb.", "Ref. albarán", o una columna de albarán
+- Pueden aparecer como columna, como texto entre líneas, o agrupados
+- Extraer CADA número de albarán individual (no agrupar), con el formato EXACTO
+- Suelen tener 4-6 dígitos
+
+Responde con JSON:
+
+{
+  "numeros_albaran_referenciados": ["nºs albarán citados"] o [],
+  "numero_pedido": "número de pedido o null"
+}"""
+REGION_MAX_TOKENS = 200
+
+# Primera pasada del modo clasificar-y-extraer: solo tipo y continuación
+CLASSIFY_PROMPT = """Clasificas páginas escaneadas de documentos contables de COMPRA españoles
+(facturas y albaranes que recibe FABRICACIONES METÁLICAS VALDEPINTO S.L.).
+
+Para cada página decide SOLO:
+- tipo: "factura" | "albaran" | "desconocido"
+- es_continuacion_anterior: true si continúa el documento de la página anterior
+  (sin cabecera/logo del emisor, "Página 2 de 3", "Hoja 2", "Continuación", tabla
+  que sigue sin encabezado, sin nuevo número de factura o albarán); false si
+  empieza un documento
+- confianza: 0.0 a 1.0
+
+Responde con JSON:
+
+{"paginas": [ {"tipo": ..., "es_continuacion_anterior": ..., "confianza": ...}, ... ]}
+
+Un objeto por página, en el mismo orden. Para la primera página,
+es_continuacion_anterior se refiere a la página previa que no ves."""
+CLASSIFY_MAX_TOKENS = 40  # por página
+# Confianza mínima para quedarse con la clasificación de una continuación sin extraer
+CLASSIFY_CONFIDENCE = 0.8
+
+# Confianza mínima de una página completada con la plantilla de su proveedor
+TEMPLATE_CONFIDENCE = 0.8
+
+# Versión del prompt para la caché de resultados: cambia sola al editar el prompt
+PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+
+async def _encode_image(image_path: str, store: PageImageStore | None = None) -> str:
+    """Codifica imagen en base64 para la API de OpenAI.
+
+    Lee del almacén en memoria si la tiene; si no, del disco en un hilo para
+    no bloquear el event loop.
+    """
+    data = await _read_image(image_path, store)
+    return base64.b64encode(data).decode("utf-8")
+
+
+async def _read_image(image_path: str, store: PageImageStore | None = None) -> bytes:
+    if store is not None and store.contains(image_path):
+        return await store.aread(image_path)
+    return await asyncio.to_thread(Path(image_path).read_bytes)
+
 
-def _encode_image(image_path: str) -> str:
-    """Codifica imagen en base64 para la API de OpenAI."""
-    with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+async def _encode_retry_image(
+    image_path: str,
+    page_number: int,
+    detail: str,
+    store: PageImageStore | None = None,
+    image: ImageOptions | None = None,
+) -> tuple[str, str]:
+    """Preview de un reintento en base64 + su MIME.
+
+    Con `image` se recorta y se ajusta a los tiles del `detail` del paso en
+    vez de enviar el PNG completo.
+    """
+    if image is None:
+        return await _encode_image(image_path, store), _get_mime_type(image_path)
+    data = await _read_image(image_path, store)
+    data, stats = await asyncio.to_thread(optimize_image_bytes, data, image, JPEG_QUALITY, detail)
+    logger.info(f"  Pag {page_number} RETRY-HD imagen: {stats.describe(detail)}")
+    return base64.b64encode(data).decode("utf-8"), "image/jpeg"
 
 
-def _get_api_image_path(preview_path: str) -> str:
+def _get_api_image_path(preview_path: str, store: PageImageStore | None = None) -> str:
     """Dada la ruta de un PNG de preview, devuelve la ruta del JPEG para API.
 
     page_001.png → page_001_api.jpg
@@ -115,6 +269,8 @@ def _get_api_image_path(preview_path: str) -> str:
     """
     p = Path(preview_path)
     jpg_path = p.parent / f"{p.stem}_api.jpg"
+    if store is not None and store.contains(str(jpg_path)):
+        return str(jpg_path)
     if jpg_path.exists():
         return str(jpg_path)
     return preview_path
@@ -152,12 +308,15 @@ def _parse_response(raw: str, page_number: int) -> dict:
             "confianza": 0.0,
         }
 
-    # GPT a veces devuelve la cadena "null" en vez de JSON null
+    return _normalize_nulls(data)
+
+
+def _normalize_nulls(data: dict) -> dict:
+    """GPT a veces devuelve la cadena "null" en vez de JSON null."""
     for key in ("proveedor", "proveedor_nif", "numero_factura", "numero_albaran",
                 "numero_pedido", "fecha"):
         if isinstance(data.get(key), str) and data[key].strip().lower() == "null":
             data[key] = None
-
     return data
 
 
@@ -182,7 +341,12 @@ def _filter_fmv(data: dict) -> dict:
     return data
 
 
-def _to_page_result(data: dict, page_number: int, image_path: str) -> PageResult:
+def _to_page_result(
+    data: dict,
+    page_number: int,
+    image_path: str,
+    origen: str = ORIGEN_VISION,
+) -> PageResult:
     """Convierte el dict parseado de OpenAI en un PageResult."""
     fecha = None
     if data.get("fecha"):
@@ -210,55 +374,39 @@ def _to_page_result(data: dict, page_number: int, image_path: str) -> PageResult
         es_continuacion_anterior=bool(data.get("es_continuacion_anterior", False)),
         confianza=float(data.get("confianza", 0.0)),
         image_path=image_path,
+        origen=origen,
     )
 
 
-def _postprocess_continuations(results: list[PageResult]) -> list[PageResult]:
-    """Post-proceso local: refuerza la detección de continuaciones.
+def _blank_page_result(page_number: int, image_path: str) -> PageResult:
+    """PageResult de una página en blanco: continuación sin datos, sin API."""
+    return PageResult(
+        page_number=page_number,
+        tipo=TipoDocumento.DESCONOCIDO,
+        es_continuacion_anterior=True,
+        confianza=1.0,
+        image_path=image_path,
+        es_blanco=True,
+        origen=ORIGEN_BLANCO,
+    )
 
-    Si una página tiene es_continuacion_anterior=True pero tiene datos
-    que la hacen parecer un documento nuevo, se corrige.
 
-    Si una página NO tiene cabecera (sin proveedor, sin nº doc) y la anterior
-    sí tenía, se marca como continuación.
-    """
-    if len(results) <= 1:
-        return results
+def _code_page_result(data: dict, page_number: int, image_path: str | None) -> PageResult:
+    """PageResult de una factura resuelta con su QR fiscal (sin API)."""
+    result = _to_page_result(data, page_number, image_path, origen=ORIGEN_CODIGO)
+    importe = data.get("importe")
+    _log_result(result, label=f"Pág {page_number} [QR{f', importe {importe}' if importe else ''}]")
+    return result
 
-    for i in range(1, len(results)):
-        curr = results[i]
-        prev = results[i - 1]
 
-        # Caso 1: GPT dice continuación pero tiene su propio nº de documento → NO es continuación
-        if curr.es_continuacion_anterior:
-            has_own_number = (
-                (curr.numero_factura and curr.numero_factura != prev.numero_factura) or
-                (curr.numero_albaran and curr.numero_albaran != prev.numero_albaran)
-            )
-            if has_own_number:
-                curr.es_continuacion_anterior = False
-                logger.debug(
-                    f"  Página {curr.page_number}: corregido continuación→nuevo "
-                    f"(tiene nº propio: fac={curr.numero_factura}, alb={curr.numero_albaran})"
-                )
-
-        # Caso 2: GPT dice NO continuación pero no tiene datos propios
-        # y el proveedor coincide → probablemente SÍ es continuación
-        if not curr.es_continuacion_anterior and prev.tipo != TipoDocumento.DESCONOCIDO:
-            no_own_data = (
-                not curr.numero_factura and
-                not curr.numero_albaran and
-                not curr.proveedor and
-                curr.tipo == prev.tipo
-            )
-            if no_own_data and curr.confianza < 0.7:
-                curr.es_continuacion_anterior = True
-                logger.debug(
-                    f"  Página {curr.page_number}: corregido nuevo→continuación "
-                    f"(sin datos propios, baja confianza)"
-                )
-
-    return results
+def _fill_from_codes(result: PageResult, store: PageImageStore | None) -> None:
+    """Rellena el nº de un albarán con su código de barras si el modelo no lo leyó."""
+    if store is None or result.tipo != TipoDocumento.ALBARAN or result.numero_albaran:
+        return
+    codes = store.codes(result.page_number)
+    if codes is not None and codes.albaran:
+        result.numero_albaran = codes.albaran
+        logger.info(f"  Pág {result.page_number}: nº de albarán {codes.albaran} del código de barras")
 
 
 async def _analyze_single_page(
@@ -268,17 +416,52 @@ async def _analyze_single_page(
     model: str,
     timeout: int,
     max_retries: int,
+    store: PageImageStore | None = None,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    hedger: Hedger | None = None,
+    detail: str = "low",
 ) -> PageResult:
     """Analiza una sola página con la API de visión de OpenAI.
 
-    Usa JPEG comprimido + detail:low para máxima velocidad.
+    Usa JPEG comprimido + detail:low (por defecto) para máxima velocidad. Con `hedger`, una
+    llamada que tarda más que el percentil de latencia del lote se duplica.
     """
     # Usar JPEG comprimido si está disponible
-    api_image = _get_api_image_path(image_path)
-    b64 = _encode_image(api_image)
+    api_image = _get_api_image_path(image_path, store)
+    b64 = await _encode_image(api_image, store)
     mime = _get_mime_type(api_image)
 
-    messages = [
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(b64, model, PROMPT_VERSION, detail)
+        cached = await cache.aget(cache_key, page_number, image_path)
+        if cached is not None:
+            _log_result(cached, label=f"Pág {page_number} [caché]")
+            return cached
+
+    raw_text = await _complete_json(
+        client=client,
+        messages=_vision_messages(b64, mime, page_number, detail),
+        page_number=page_number,
+        model=model,
+        timeout=timeout,
+        max_retries=max_retries,
+        limiter=limiter,
+        hedger=hedger,
+    )
+    result = _vision_result(raw_text, page_number, image_path)
+    if raw_text is None:
+        return result
+    _log_result(result)
+    # Respuestas no parseables (confianza 0) no se cachean
+    if cache is not None and result.confianza > 0:
+        await cache.aput(cache_key, result)
+    return result
+
+
+def _vision_messages(b64: str, mime: str, page_number: int, detail: str = "low") -> list[dict]:
+    return [
         {"role": "system", "content": SYSTEM_PROMPT},
         {
             "role": "user",
@@ -288,54 +471,650 @@ async def _analyze_single_page(
                     "type": "image_url",
                     "image_url": {
                         "url": f"data:{mime};base64,{b64}",
-                        "detail": "auto",
+                        "detail": detail,
                     },
                 },
             ],
         },
     ]
 
-    for attempt in range(max_retries):
-        try:
-            response = await asyncio.wait_for(
-                client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=500,
-                    temperature=0.1,
-                    response_format={"type": "json_object"},
-                ),
-                timeout=timeout,
+
+def _vision_result(raw_text: str | None, page_number: int, image_path: str | None) -> PageResult:
+    """PageResult a partir de la respuesta de visión (None = llamada fallida)."""
+    if raw_text is None:
+        logger.error(f"  Página {page_number}: todos los intentos fallaron")
+        return PageResult(
+            page_number=page_number,
+            tipo=TipoDocumento.DESCONOCIDO,
+            confianza=0.0,
+            image_path=image_path,
+        )
+
+    data = _parse_response(raw_text, page_number)
+    data = _filter_fmv(data)
+    return _to_page_result(data, page_number, image_path)
+
+
+async def _analyze_text_page(
+    client: AsyncOpenAI,
+    text: str,
+    image_path: str,
+    page_number: int,
+    model: str,
+    timeout: int,
+    max_retries: int,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+) -> PageResult:
+    """Analiza una página nativa (con capa de texto) con una llamada solo-texto.
+
+    Los parsers locales rellenan los campos que el modelo deje vacíos y, si la
+    API falla, su resultado se usa tal cual.
+    """
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(text, model, PROMPT_VERSION, "text")
+        cached = await cache.aget(cache_key, page_number, image_path)
+        if cached is not None:
+            _log_result(cached, label=f"Pág {page_number} [texto, caché]")
+            return cached
+
+    raw_text = await _complete_json(
+        client=client,
+        messages=_text_messages(text, page_number),
+        page_number=page_number,
+        model=model,
+        timeout=timeout,
+        max_retries=max_retries,
+        limiter=limiter,
+    )
+    result = _text_result(raw_text, text, page_number, image_path)
+    _log_result(result, label=f"Pág {page_number} [texto]")
+    # Lo resuelto solo en local no se cachea: la próxima vez puede haber API
+    if cache is not None and result.origen == ORIGEN_TEXTO:
+        await cache.aput(cache_key, result)
+    return result
+
+
+def _text_messages(text: str, page_number: int) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                f"Analiza esta página (página {page_number}). No hay imagen: este es "
+                f"el texto extraído del PDF original.\n\n{text[:TEXT_MAX_CHARS]}"
+            ),
+        },
+    ]
+
+
+def _text_result(
+    raw_text: str | None, text: str, page_number: int, image_path: str | None,
+) -> PageResult:
+    """PageResult de una página nativa: respuesta del modelo + parsers locales.
+
+    Si la llamada falló (None), se usa solo lo que extraen los parsers.
+    """
+    local = parse_document_text(text)
+    if raw_text is None:
+        logger.warning(f"  Página {page_number}: API no disponible, usando parsers locales")
+        data = local
+        origen = ORIGEN_TEXTO_LOCAL
+    else:
+        data = _parse_response(raw_text, page_number)
+        for key in _LOCAL_FILL_KEYS:
+            if local.get(key) and not data.get(key):
+                data[key] = local[key]
+        origen = ORIGEN_TEXTO
+
+    data = _filter_fmv(data)
+    return _to_page_result(data, page_number, image_path, origen=origen)
+
+
+def _analyze_text_page_locally(text: str, image_path: str, page_number: int) -> PageResult:
+    """Página nativa resuelta solo con parsers locales (sin API)."""
+    data = _filter_fmv(parse_document_text(text))
+    result = _to_page_result(data, page_number, image_path, origen=ORIGEN_TEXTO_LOCAL)
+    _log_result(result, label=f"Pág {page_number} [texto local]")
+    return result
+
+
+async def _analyze_ocr_page(
+    ocr: LocalOcrEngine,
+    image_path: str,
+    page_number: int,
+    store: PageImageStore | None = None,
+    validator: PageValidator | None = None,
+) -> PageResult:
+    """Página escaneada resuelta con OCR local + parsers (sin API).
+
+    La confianza es la menor entre la de los parsers y la media del OCR. Sin
+    razón social, el proveedor se toma del maestro por NIF si el validador
+    lo conoce.
+    """
+    try:
+        page = await ocr.read(await _read_image(image_path, store))
+    except Exception as e:
+        logger.warning(f"  Pág {page_number}: OCR local falló: {e}")
+        return PageResult(
+            page_number=page_number,
+            tipo=TipoDocumento.DESCONOCIDO,
+            confianza=0.0,
+            image_path=image_path,
+            origen=ORIGEN_OCR,
+        )
+
+    data = parse_document_text(page.text)
+    data["confianza"] = round(min(data["confianza"], page.confidence), 2)
+    data = _filter_fmv(data)
+    result = _to_page_result(data, page_number, image_path, origen=ORIGEN_OCR)
+    if validator is not None and not result.proveedor:
+        result.proveedor = validator.supplier_name(result.proveedor_nif)
+    _log_result(result, label=f"Pág {page_number} [OCR local]")
+    return result
+
+
+async def _read_with_template(
+    result: PageResult,
+    templates: TemplateStore,
+    ocr: LocalOcrEngine,
+    store: PageImageStore | None = None,
+    validator: PageValidator | None = None,
+) -> PageResult:
+    """Relee con la plantilla del proveedor (OCR de sus regiones) una página dudosa.
+
+    Rellena los campos que faltan o no tienen formato válido. Devuelve el
+    mismo resultado si no hay plantilla o la lectura falla; los fallos
+    cuentan para invalidar la plantilla.
+    """
+    if result.es_continuacion_anterior or not result.image_path:
+        return result
+    template = templates.get(result.proveedor_nif, result.tipo)
+    if template is None:
+        return result
+
+    try:
+        values = await read_template_fields(template, await _read_image(result.image_path, store), ocr)
+    except Exception as e:
+        logger.warning(f"  Pág {result.page_number}: lectura con plantilla falló: {e}")
+        values = None
+
+    updated = result
+    if values is not None:
+        fill = {}
+        for key, value in values.items():
+            current = getattr(result, key)
+            if key in ("numero_factura", "numero_albaran"):
+                if not valid_document_number(current):
+                    fill[key] = value
+            elif not current:
+                fill[key] = value
+        updated = replace(result, **fill, confianza=max(result.confianza, TEMPLATE_CONFIDENCE))
+    ok = values is not None and (validator is None or not validator.check(updated).errors)
+    await templates.arecord(template, ok)
+    if not ok:
+        return result
+
+    _log_result(updated, label=f"Pág {result.page_number} [plantilla {template.codigo} v{template.version}]")
+    return updated
+
+
+async def _analyze_page_group(
+    client: AsyncOpenAI,
+    pages: list[tuple[int, str]],
+    model: str,
+    timeout: int,
+    max_retries: int,
+    store: PageImageStore | None = None,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    detail: str = "low",
+) -> list[PageResult]:
+    """Analiza varias páginas consecutivas en una sola llamada de visión.
+
+    El prompt de sistema se paga una vez por grupo y el modelo ve las páginas
+    vecinas, lo que ayuda a decidir `es_continuacion_anterior`. Si la
+    respuesta no trae un resultado válido por página, se vuelve a llamadas
+    individuales.
+
+    Las páginas que ya están en caché analizadas solas parten el grupo: el
+    resto se envía por tramos consecutivos (ver `_analyze_page_run`). Las
+    llamadas van de una en una: el grupo ocupa un solo hueco del limitador.
+    """
+    encoded: list[tuple[int, str, str, str]] = []
+    for page_number, image_path in pages:
+        api_image = _get_api_image_path(image_path, store)
+        encoded.append((page_number, image_path, await _encode_image(api_image, store), _get_mime_type(api_image)))
+
+    results: dict[int, PageResult] = {}
+    runs: list[list[tuple[int, str, str, str]]] = [encoded]
+    if cache is not None:
+        runs = [[]]
+        for page in encoded:
+            page_number, image_path, b64, _ = page
+            cached = await cache.aget(
+                cache.make_key(b64, model, PROMPT_VERSION, detail), page_number, image_path,
             )
+            if cached is None:
+                runs[-1].append(page)
+                continue
+            _log_result(cached, label=f"Pág {page_number} [caché]")
+            results[page_number] = cached
+            if runs[-1]:
+                runs.append([])
+
+    for run in runs:
+        if len(run) == 1:
+            page_number, image_path = run[0][:2]
+            results[page_number] = await _analyze_single_page(
+                client, image_path, page_number, model, timeout, max_retries, store, cache, limiter,
+                detail=detail,
+            )
+        elif run:
+            for result in await _analyze_page_run(
+                client, run, model, timeout, max_retries, store, cache, limiter, detail,
+            ):
+                results[result.page_number] = result
+
+    return [results[page_number] for page_number, _ in pages]
+
+
+def _group_variant(detail: str, images: list[str]) -> str:
+    """Variante de caché de un tramo: el resultado de cada página depende de sus vecinas."""
+    pages = "".join(hashlib.sha256(b64.encode("utf-8")).hexdigest() for b64 in images)
+    return f"{detail}|grupo|{hashlib.sha256(pages.encode('utf-8')).hexdigest()}"
+
+
+async def _analyze_page_run(
+    client: AsyncOpenAI,
+    run: list[tuple[int, str, str, str]],
+    model: str,
+    timeout: int,
+    max_retries: int,
+    store: PageImageStore | None = None,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    detail: str = "low",
+) -> list[PageResult]:
+    """Una llamada para un tramo de páginas consecutivas (página, ruta, base64, MIME).
+
+    En caché va con su propia variante (`_group_variant`), distinta de la de
+    una página sola, y se sirve el tramo entero o nada.
+    """
+    keys: list[str | None] = [None] * len(run)
+    if cache is not None:
+        variant = _group_variant(detail, [b64 for _, _, b64, _ in run])
+        keys = [cache.make_key(b64, model, PROMPT_VERSION, variant) for _, _, b64, _ in run]
+        cached = [
+            await cache.aget(key, page_number, image_path)
+            for key, (page_number, image_path, _, _) in zip(keys, run)
+        ]
+        if all(result is not None for result in cached):
+            for result in cached:
+                _log_result(result, label=f"Pág {result.page_number} [caché grupo]")
+            return cached
+
+    first, last = run[0][0], run[-1][0]
+    content: list[dict] = [{
+        "type": "text",
+        "text": (
+            f"Analiza estas {len(run)} páginas consecutivas "
+            f"(páginas {first} a {last}), en orden:"
+        ),
+    }]
+    for page_number, _, b64, mime in run:
+        content.append({"type": "text", "text": f"Página {page_number}:"})
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:{mime};base64,{b64}", "detail": detail},
+        })
 
-            raw_text = response.choices[0].message.content or ""
-            data = _parse_response(raw_text, page_number)
-            data = _filter_fmv(data)
-            result = _to_page_result(data, page_number, image_path)
-
-            logger.info(
-                f"  Pág {page_number}: {result.tipo.value} | "
-                f"prov={result.proveedor or '-'} | "
-                f"fac={result.numero_factura or '-'} | "
-                f"alb={result.numero_albaran or '-'} | "
-                f"conf={result.confianza:.0%}"
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT + MULTI_PAGE_INSTRUCTIONS},
+        {"role": "user", "content": content},
+    ]
+    raw_text = await _complete_json(
+        client=client,
+        messages=messages,
+        page_number=first,
+        model=model,
+        timeout=timeout,
+        max_retries=max_retries,
+        max_tokens=500 * len(run),
+        limiter=limiter,
+    )
+    page_data = _parse_multi_response(raw_text, len(run), first) if raw_text else None
+
+    if page_data is None:
+        logger.warning(
+            f"  Págs {first}-{last}: respuesta multi-página no válida, "
+            f"analizando por separado"
+        )
+        return [
+            await _analyze_single_page(
+                client, image_path, page_number, model, timeout, max_retries, store, cache, limiter,
+                detail=detail,
             )
-            return result
+            for page_number, image_path, _, _ in run
+        ]
+
+    results = []
+    for (page_number, image_path, _, _), key, data in zip(run, keys, page_data):
+        data = _filter_fmv(data)
+        result = _to_page_result(data, page_number, image_path)
+        _log_result(result, label=f"Pág {page_number} [grupo {first}-{last}]")
+        if cache is not None and result.confianza > 0:
+            await cache.aput(key, result)
+        results.append(result)
+    return results
+
+
+async def _classify_then_extract(
+    client: AsyncOpenAI,
+    pages: list[tuple[int, str]],
+    model: str,
+    timeout: int,
+    max_retries: int,
+    store: PageImageStore | None = None,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    hedger: Hedger | None = None,
+    detail: str = "low",
+) -> list[PageResult]:
+    """Clasifica las páginas y extrae completas solo las que empiezan documento.
+
+    Las continuaciones claras (`CLASSIFY_CONFIDENCE`) se quedan con el
+    resultado de la clasificación: tipo + es_continuacion_anterior, que es lo
+    que usan el post-proceso y el agrupador. Las demás se extraen como
+    siempre, por tramos consecutivos.
+
+    Con `limiter`, se llama con un hueco ya tomado: cubre la clasificación y
+    se suelta al terminarla; cada llamada de extracción toma después el suyo.
+    """
+    try:
+        classes = await _classify_pages(client, pages, model, timeout, max_retries, store, cache, limiter)
+    finally:
+        if limiter is not None:
+            limiter.release()
+
+    results: dict[int, PageResult] = {}
+    runs: list[list[tuple[int, str]]] = [[]]
+    for (page_number, image_path), cls in zip(pages, classes):
+        if cls is not None and _is_sure_continuation(cls):
+            _log_result(cls, label=f"Pág {page_number} [clasificación]")
+            results[page_number] = cls
+            if runs[-1]:
+                runs.append([])
+        else:
+            runs[-1].append((page_number, image_path))
+
+    async def extract(run: list[tuple[int, str]]) -> PageResult | list[PageResult]:
+        if limiter is not None:
+            await limiter.acquire(priority=PRIORITY_PAGE)
+        try:
+            if len(run) == 1:
+                page_number, image_path = run[0]
+                return await _analyze_single_page(
+                    client, image_path, page_number, model, timeout, max_retries, store, cache, limiter,
+                    hedger=hedger, detail=detail,
+                )
+            return await _analyze_page_group(
+                client, run, model, timeout, max_retries, store, cache, limiter, detail=detail,
+            )
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    for extracted in await asyncio.gather(*(extract(run) for run in runs if run)):
+        for result in extracted if isinstance(extracted, list) else [extracted]:
+            results[result.page_number] = result
+
+    return [results[page_number] for page_number, _ in pages]
+
+
+async def _classify_pages(
+    client: AsyncOpenAI,
+    pages: list[tuple[int, str]],
+    model: str,
+    timeout: int,
+    max_retries: int,
+    store: PageImageStore | None = None,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+) -> list[PageResult | None]:
+    """Pasada barata con la miniatura (detail:low) y el prompt corto.
+
+    Una sola llamada para todo el tramo. None en las páginas sin
+    clasificación válida (se extraen completas).
+    """
+    encoded: list[tuple[str, str]] = []
+    for _, image_path in pages:
+        api_image = _get_api_image_path(image_path, store)
+        encoded.append((await _encode_image(api_image, store), _get_mime_type(api_image)))
+
+    keys: list[str | None] = [None] * len(pages)
+    classes: list[PageResult | None] = [None] * len(pages)
+    if cache is not None:
+        # La continuación depende de las vecinas: la clave incluye el tramo
+        # entero, y se sirve todo el tramo desde la caché o nada
+        variant = _group_variant("low", [b64 for b64, _ in encoded])
+        for i, ((page_number, image_path), (b64, _)) in enumerate(zip(pages, encoded)):
+            keys[i] = cache.make_key(b64 + CLASSIFY_PROMPT, model, PROMPT_VERSION, variant)
+            classes[i] = await cache.aget(keys[i], page_number, image_path)
+        if all(cls is not None for cls in classes):
+            return classes
+
+    first, last = pages[0][0], pages[-1][0]
+    content: list[dict] = []
+    for (page_number, _), (b64, mime) in zip(pages, encoded):
+        content.append({"type": "text", "text": f"Página {page_number}:"})
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:{mime};base64,{b64}", "detail": "low"},
+        })
+    messages = [
+        {"role": "system", "content": CLASSIFY_PROMPT},
+        {"role": "user", "content": content},
+    ]
+    raw_text = await _complete_json(
+        client=client,
+        messages=messages,
+        page_number=first,
+        model=model,
+        timeout=timeout,
+        max_retries=max_retries,
+        max_tokens=CLASSIFY_MAX_TOKENS * len(pages),
+        limiter=limiter,
+    )
+    items = _parse_multi_response(raw_text, len(pages), first) if raw_text else None
+    if items is None:
+        logger.warning(f"  Págs {first}-{last}: clasificación no válida, extracción completa")
+        return [None] * len(pages)
+
+    for i, ((page_number, image_path), data) in enumerate(zip(pages, items)):
+        classes[i] = _to_page_result(data, page_number, image_path, origen=ORIGEN_CLASIFICACION)
+        if cache is not None and classes[i].confianza > 0:
+            await cache.aput(keys[i], classes[i])
+    return classes
+
+
+def _is_sure_continuation(result: PageResult) -> bool:
+    return (
+        result.es_continuacion_anterior
+        and result.tipo != TipoDocumento.DESCONOCIDO
+        and result.confianza >= CLASSIFY_CONFIDENCE
+    )
+
+
+def _parse_multi_response(raw: str, expected: int, first_page: int) -> list[dict] | None:
+    """Extrae la lista de resultados por página de una respuesta multi-página.
+
+    Devuelve None si no es JSON o no trae exactamente `expected` objetos.
+    """
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else text[3:]
+        if text.endswith("```"):
+            text = text[:-3]
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+    items = data.get("paginas") if isinstance(data, dict) else data
+    if not isinstance(items, list) or len(items) != expected:
+        return None
+    if not all(isinstance(item, dict) for item in items):
+        return None
+
+    for item in items:
+        _normalize_nulls(item)
+    return items
+
+
+async def _complete_json(
+    client: AsyncOpenAI,
+    messages: list[dict],
+    page_number: int,
+    model: str,
+    timeout: int,
+    max_retries: int,
+    max_tokens: int = 500,
+    limiter: AdaptiveLimiter | None = None,
+    hedger: Hedger | None = None,
+) -> str | None:
+    """Llamada a chat completions (JSON) con reintentos. None si todos fallan.
+
+    Con `limiter`, cada intento espera presupuesto RPM/TPM (y el Retry-After
+    de un 429 previo) e informa del resultado para ajustar la concurrencia.
+    Con `hedger`, un intento que se retrasa se duplica (ver `core.hedging`).
+    """
+    tokens = _estimate_tokens(messages, max_tokens)
+
+    async def send():
+        return await asyncio.wait_for(
+            client.chat.completions.create(**_completion_params(model, messages, max_tokens)),
+            timeout=timeout,
+        )
+
+    async def send_hedge():
+        # La copia también consume presupuesto RPM/TPM
+        if limiter is not None:
+            await limiter.wait_budget(tokens)
+        return await send()
+
+    for attempt in range(max_retries):
+        retry_after = None
+        if limiter is not None:
+            await limiter.wait_budget(tokens)
+        started = time.monotonic()
+        try:
+            if hedger is None:
+                response = await send()
+            else:
+                calls = iter((send, send_hedge))
+                response = await hedger.run(lambda: next(calls)(), label=f"Página {page_number}")
+                hedger.record(time.monotonic() - started)
+            if limiter is not None:
+                usage = getattr(response, "usage", None)
+                limiter.on_success(
+                    time.monotonic() - started,
+                    tokens_used=getattr(usage, "total_tokens", None),
+                    tokens_reserved=tokens,
+                )
+            return response.choices[0].message.content or ""
 
         except asyncio.TimeoutError:
             logger.warning(f"  Página {page_number}: timeout (intento {attempt + 1}/{max_retries})")
+            if limiter is not None:
+                limiter.on_timeout()
         except Exception as e:
             logger.warning(f"  Página {page_number}: error (intento {attempt + 1}/{max_retries}): {e}")
+            retry_after = retry_after_seconds(e)
+            if limiter is not None:
+                limiter.on_error(e)
 
         if attempt < max_retries - 1:
-            await asyncio.sleep(2 ** attempt)
+            # Con limitador, la espera de un 429 ya la impone wait_budget
+            if retry_after is not None and limiter is None:
+                await asyncio.sleep(retry_after)
+            else:
+                await asyncio.sleep(2 ** attempt)
+
+    return None
+
+
+def _completion_params(model: str, messages: list[dict], max_tokens: int) -> dict:
+    """Parámetros de chat completions (también el `body` de una línea Batch API)."""
+    return {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": 0.1,
+        "response_format": {"type": "json_object"},
+    }
+
+
+def _estimate_tokens(messages: list[dict], max_tokens: int) -> int:
+    """Estimación de tokens de una llamada para el presupuesto TPM."""
+    total = max_tokens
+    for message in messages:
+        content = message["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part.get("type") == "text":
+                total += len(part["text"]) // 4
+            elif part.get("image_url", {}).get("detail") == "low":
+                total += 85
+            else:
+                # detail:high/auto: varios tiles de 512 px
+                total += 765
+    return total
+
+
+def needs_high_detail(result: PageResult, validator: PageValidator | None = None) -> bool:
+    """Decide si un resultado de la fase 1 merece reintento con detail:high.
+
+    - Datos inválidos según el validador (NIF, fecha, nºs), aunque la confianza sea alta
+    - Baja confianza (< LOW_CONFIDENCE), salvo que el validador dé la página por completa
+    - Facturas sin nºs de albarán referenciados (necesitan leer líneas de detalle),
+      salvo las continuaciones resueltas solo con la clasificación: los
+      albaranes los aporta la página que empieza el documento
+
+    Las facturas con QR fiscal solo suben si les faltan los albaranes: NIF,
+    nº y fecha ya vienen del QR.
+    """
+    # Blancas y nativas: una imagen en alta no aporta nada
+    if result.es_blanco or result.origen in _TEXT_ORIGINS:
+        return False
+    if result.origen == ORIGEN_CODIGO:
+        return not result.numeros_albaran_ref
+
+    complete = False
+    if validator is not None:
+        report = validator.check(result)
+        if report.errors:
+            logger.debug(f"  Pág {result.page_number}: reintento por {'; '.join(report.errors)}")
+            return True
+        complete = report.complete
+
+    if result.confianza < LOW_CONFIDENCE and not complete:
+        return True
+    return (
+        result.tipo == TipoDocumento.FACTURA
+        and not result.numeros_albaran_ref
+        and result.origen != ORIGEN_CLASIFICACION
+    )
 
-    logger.error(f"  Página {page_number}: todos los intentos fallaron")
-    return PageResult(
-        page_number=page_number,
-        tipo=TipoDocumento.DESCONOCIDO,
-        confianza=0.0,
-        image_path=image_path,
+
+def _log_result(result: PageResult, label: str | None = None) -> None:
+    logger.info(
+        f"  {label or f'Pág {result.page_number}'}: {result.tipo.value} | "
+        f"prov={result.proveedor or '-'} | "
+        f"fac={result.numero_factura or '-'} | "
+        f"alb={result.numero_albaran or '-'} | "
+        f"conf={result.confianza:.0%}"
     )
 
 
@@ -344,8 +1123,17 @@ async def _retry_with_high_detail(
     result: PageResult,
     model: str,
     timeout: int,
+    store: PageImageStore | None = None,
+    cache: PageResultCache | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    detail: str = "high",
+    image: ImageOptions | None = None,
 ) -> PageResult:
-    """Re-analiza una página con detail:high + PNG original.
+    """Re-analiza una página con detail:high (o el de su paso de cascada) + PNG original.
+
+    Con `image` el PNG se optimiza para ese detail (ver `_encode_retry_image`).
+    Si solo faltan los albaranes de una factura, se envía la tabla de líneas
+    (ver `_retry_messages`).
 
     Acepta el nuevo resultado si:
     - Mejora la confianza, O
@@ -355,18 +1143,161 @@ async def _retry_with_high_detail(
     if not image_path:
         return result
 
-    # Para retry usar el PNG original (mayor calidad)
-    b64 = _encode_image(image_path)
-
-    hint = ""
-    if result.tipo == TipoDocumento.FACTURA:
-        hint = (
-            " IMPORTANTE: Si es una factura, busca con mucho cuidado TODOS los "
-            "numeros de albaran referenciados en las lineas de detalle. "
-            "Los numeros suelen tener 4-6 digitos."
+    messages, key_material, max_tokens = await _retry_messages(result, detail, store, image)
+
+    cache_key = None
+    new_result = None
+    if cache is not None:
+        cache_key = cache.make_key(key_material, model, PROMPT_VERSION, detail)
+        new_result = await cache.aget(cache_key, result.page_number, image_path)
+        if new_result is not None:
+            logger.info(f"  Pag {result.page_number} RETRY-HD: resultado en caché")
+
+    if new_result is None:
+        raw_text = await _complete_json(
+            client=client,
+            messages=messages,
+            page_number=result.page_number,
+            model=model,
+            timeout=timeout,
+            max_retries=1,
+            max_tokens=max_tokens,
+            limiter=limiter,
         )
+        if raw_text is None:
+            logger.warning(f"  Pag {result.page_number} RETRY-HD fallo")
+            return result
 
-    messages = [
+        new_result = _retry_result(raw_text, result)
+        if cache is not None and new_result.confianza > 0:
+            await cache.aput(cache_key, new_result)
+
+    return _pick_high_detail(result, new_result)
+
+
+async def _retry_messages(
+    result: PageResult,
+    detail: str,
+    store: PageImageStore | None = None,
+    image: ImageOptions | None = None,
+) -> tuple[list[dict], str, int]:
+    """Mensajes de un reintento, material de la clave de caché y max_tokens.
+
+    Facturas fiables a las que solo les faltan los albaranes: solo el recorte
+    de la tabla de líneas. Si la tabla no se localiza, o en el resto de
+    casos, la página entera.
+    """
+    if _wants_region(result):
+        region = await _encode_region_image(result.image_path, result.page_number, detail, store, image)
+        if region is not None:
+            b64, mime = region
+            messages = _region_messages(b64, mime, result.page_number, detail)
+            return messages, b64 + REGION_PROMPT, REGION_MAX_TOKENS
+
+    b64, mime = await _encode_retry_image(result.image_path, result.page_number, detail, store, image)
+    hint = _high_detail_hint(result)
+    return _high_detail_messages(b64, mime, result.page_number, hint, detail), b64 + hint, 600
+
+
+def _wants_region(result: PageResult) -> bool:
+    """Factura leída con confianza a la que solo le faltan los albaranes referenciados.
+
+    A las resueltas por QR les falta también el proveedor: van con la página entera.
+    """
+    return (
+        result.tipo == TipoDocumento.FACTURA
+        and not result.numeros_albaran_ref
+        and result.confianza >= LOW_CONFIDENCE
+        and result.origen != ORIGEN_CODIGO
+    )
+
+
+async def _encode_region_image(
+    image_path: str,
+    page_number: int,
+    detail: str,
+    store: PageImageStore | None = None,
+    image: ImageOptions | None = None,
+) -> tuple[str, str] | None:
+    """Recorte de la tabla de líneas en base64 + MIME. None si no se localiza."""
+    if image is not None:
+        options = replace(image, detail=detail)
+    else:
+        options = ImageOptions(detail=detail, mode="color", crop=False)
+    data = await _read_image(image_path, store)
+    region = await asyncio.to_thread(crop_line_items, data, options, JPEG_QUALITY)
+    if region is None:
+        logger.info(f"  Pag {page_number} RETRY-HD: tabla de líneas no localizada, página completa")
+        return None
+    data, stats = region
+    logger.info(f"  Pag {page_number} RETRY-HD recorte tabla: {stats.describe(detail)}")
+    return base64.b64encode(data).decode("utf-8"), "image/jpeg"
+
+
+def _region_messages(b64: str, mime: str, page_number: int, detail: str = "high") -> list[dict]:
+    return [
+        {"role": "system", "content": REGION_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": f"Tabla de líneas de la página {page_number}:"},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime};base64,{b64}",
+                        "detail": detail,
+                    },
+                },
+            ],
+        },
+    ]
+
+
+def _retry_result(raw_text: str, result: PageResult) -> PageResult:
+    """PageResult de un reintento: página entera, o recorte de tabla (sin `tipo`).
+
+    El recorte solo aporta albaranes y pedido; el resto viene del original.
+    En una factura resuelta por QR, la página entera aporta proveedor y
+    albaranes pero tipo, NIF, nº y fecha siguen siendo los del QR.
+    """
+    data = _parse_response(raw_text, result.page_number)
+    if "tipo" in data:
+        new_result = _to_page_result(_filter_fmv(data), result.page_number, result.image_path)
+        if result.origen == ORIGEN_CODIGO:
+            new_result = replace(
+                new_result,
+                tipo=result.tipo,
+                proveedor_nif=result.proveedor_nif,
+                numero_factura=result.numero_factura,
+                fecha=result.fecha,
+                es_continuacion_anterior=False,
+                confianza=result.confianza,
+                origen=ORIGEN_CODIGO,
+            )
+        return new_result
+
+    refs = [str(ref) for ref in data.get("numeros_albaran_referenciados") or [] if ref]
+    return replace(
+        result,
+        numeros_albaran_ref=refs,
+        numero_pedido=result.numero_pedido or data.get("numero_pedido"),
+    )
+
+
+def _high_detail_hint(result: PageResult) -> str:
+    if result.tipo != TipoDocumento.FACTURA:
+        return ""
+    return (
+        " IMPORTANTE: Si es una factura, busca con mucho cuidado TODOS los "
+        "numeros de albaran referenciados en las lineas de detalle. "
+        "Los numeros suelen tener 4-6 digitos."
+    )
+
+
+def _high_detail_messages(
+    b64: str, mime: str, page_number: int, hint: str, detail: str = "high",
+) -> list[dict]:
+    return [
         {"role": "system", "content": SYSTEM_PROMPT},
         {
             "role": "user",
@@ -374,61 +1305,140 @@ async def _retry_with_high_detail(
                 {
                     "type": "text",
                     "text": (
-                        f"Analiza esta pagina con MAXIMO detalle (pagina {result.page_number}).{hint}"
+                        f"Analiza esta pagina con MAXIMO detalle (pagina {page_number}).{hint}"
                     ),
                 },
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/png;base64,{b64}",
-                        "detail": "high",
+                        "url": f"data:{mime};base64,{b64}",
+                        "detail": detail,
                     },
                 },
             ],
         },
     ]
 
-    try:
-        response = await asyncio.wait_for(
-            client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=600,
-                temperature=0.1,
-                response_format={"type": "json_object"},
-            ),
-            timeout=timeout * 2,
-        )
 
-        raw_text = response.choices[0].message.content or ""
-        data = _parse_response(raw_text, result.page_number)
-        data = _filter_fmv(data)
-        new_result = _to_page_result(data, result.page_number, image_path)
-
-        # Aceptar si mejora confianza O extrae más datos
-        better_confidence = new_result.confianza >= result.confianza
-        more_data = (
-            len(new_result.numeros_albaran_ref) > len(result.numeros_albaran_ref) or
-            (new_result.proveedor and not result.proveedor) or
-            (new_result.proveedor_nif and not result.proveedor_nif)
+def _pick_high_detail(result: PageResult, new_result: PageResult) -> PageResult:
+    """Elige entre el resultado original y el del reintento detail:high."""
+    # Aceptar si mejora confianza O extrae más datos
+    better_confidence = new_result.confianza >= result.confianza
+    more_data = (
+        len(new_result.numeros_albaran_ref) > len(result.numeros_albaran_ref) or
+        (new_result.proveedor and not result.proveedor) or
+        (new_result.proveedor_nif and not result.proveedor_nif)
+    )
+
+    if better_confidence or more_data:
+        refs = new_result.numeros_albaran_ref
+        logger.info(
+            f"  Pag {result.page_number} RETRY-HD: {new_result.tipo.value} | "
+            f"conf={result.confianza:.0%}->{new_result.confianza:.0%} | "
+            f"alb_ref={refs if refs else '-'}"
         )
+        return new_result
+    else:
+        logger.info(f"  Pag {result.page_number} RETRY-HD: sin mejora, manteniendo original")
+        return result
+
+
+class ModelRouter:
+    """Cascada de modelos con un pool de concurrencia por modelo.
 
-        if better_confidence or more_data:
-            refs = new_result.numeros_albaran_ref
-            logger.info(
-                f"  Pag {result.page_number} RETRY-HD: {new_result.tipo.value} | "
-                f"conf={result.confianza:.0%}->{new_result.confianza:.0%} | "
-                f"alb_ref={refs if refs else '-'}"
+    El paso 1 es el análisis inicial; si su resultado necesita más detalle
+    (`needs_high_detail`), la página sube al paso 2, luego al 3... hasta que
+    deja de necesitarlo o se acaban los pasos. Cada PageResult de visión
+    guarda el paso (`paso_cascada`) y el modelo que lo produjo.
+    """
+
+    def __init__(
+        self,
+        steps: list[CascadeStep],
+        rpm_limit: int = 0,
+        tpm_limit: int = 0,
+        image: ImageOptions | None = None,
+        validator: PageValidator | None = None,
+    ):
+        if not steps:
+            raise ValueError("La cascada de modelos necesita al menos un paso")
+        self.steps = steps
+        # Optimización de la imagen de los pasos 2..n (None = PNG completo)
+        self.image = image
+        # Validación local que decide qué páginas suben (None = solo confianza)
+        self.validator = validator
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._pools: dict[str, AdaptiveLimiter] = {}
+        for step in steps:
+            self._add_pool(step.model, step.max_concurrent, step.timeout)
+
+    def _add_pool(self, model: str, max_concurrent: int, timeout: int) -> None:
+        pool = self._pools.get(model)
+        if pool is None:
+            # Los límites RPM/TPM de OpenAI son por modelo: cada pool lleva los suyos
+            self._pools[model] = AdaptiveLimiter(
+                max_limit=max_concurrent,
+                rpm=self.rpm_limit,
+                tpm=self.tpm_limit,
+                latency_target=timeout / 2,
             )
-            return new_result
         else:
-            logger.info(f"  Pag {result.page_number} RETRY-HD: sin mejora, manteniendo original")
-            return result
-
-    except Exception as e:
-        logger.warning(f"  Pag {result.page_number} RETRY-HD fallo: {e}")
+            pool.max_limit = max(pool.max_limit, max_concurrent)
+            pool.latency_target = max(pool.latency_target, timeout / 2)
+
+    def pool(self, model: str) -> AdaptiveLimiter:
+        """Pool del modelo (p.ej. el de texto); se crea con los valores del paso 1."""
+        if model not in self._pools:
+            first = self.steps[0]
+            self._add_pool(model, first.max_concurrent, first.timeout)
+        return self._pools[model]
+
+    @staticmethod
+    def mark(result: PageResult, step_number: int, model: str) -> None:
+        result.paso_cascada = step_number
+        result.modelo = model
+
+    async def escalate(
+        self,
+        client: AsyncOpenAI,
+        result: PageResult,
+        store: PageImageStore | None = None,
+        cache: PageResultCache | None = None,
+    ) -> PageResult:
+        """Sube una página por los pasos 2..n mientras siga necesitando detalle."""
+        for index, step in enumerate(self.steps[1:], start=2):
+            if not needs_high_detail(result, self.validator):
+                break
+            pool = self._pools[step.model]
+            await pool.acquire(priority=PRIORITY_RETRY)
+            try:
+                new_result = await _retry_with_high_detail(
+                    client=client,
+                    result=result,
+                    model=step.model,
+                    timeout=step.timeout,
+                    store=store,
+                    cache=cache,
+                    limiter=pool,
+                    detail=step.detail,
+                    image=self.image,
+                )
+            finally:
+                pool.release()
+            if new_result is not result:
+                self.mark(new_result, index, step.model)
+            result = new_result
         return result
 
+    def summary(self, results: list[PageResult]) -> str:
+        parts = []
+        for index, step in enumerate(self.steps, start=1):
+            count = sum(1 for r in results if r.paso_cascada == index)
+            parts.append(f"paso {index} ({step.model}/{step.detail})={count}")
+        pools = "; ".join(f"{model}: {pool.summary()}" for model, pool in self._pools.items())
+        return f"{', '.join(parts)} | {pools}"
+
 
 async def analyze_pages(
     image_paths: list[str],
@@ -437,100 +1447,482 @@ async def analyze_pages(
     max_concurrent: int = 10,
     timeout: int = 30,
     max_retries: int = 3,
+    store: PageImageStore | None = None,
+    text_pages: dict[int, str] | None = None,
+    text_model: str | None = None,
+    text_local_only: bool = False,
+    cache: PageResultCache | None = None,
+    pages_per_request: int = 1,
+    rpm_limit: int = 0,
+    tpm_limit: int = 0,
+    router: ModelRouter | None = None,
+    cascade: list[CascadeStep] | None = None,
+    hedge_budget: float = 0.0,
+    hedge_percentile: float = 0.9,
+    base_url: str | None = None,
+    image: ImageOptions | None = None,
+    classify_first: bool = False,
+    validator: PageValidator | None = None,
+    vision_backend: str = BACKEND_LLM,
+    ocr: LocalOcrEngine | None = None,
+    templates: TemplateStore | None = None,
 ) -> list[PageResult]:
     """Analiza todas las páginas de un lote EN PARALELO.
 
-    Estrategia en 3 fases:
-    1. Enviar TODAS las páginas a la vez (con semáforo de concurrencia) usando
+    Estrategia en 2 fases:
+    1. Enviar TODAS las páginas a la vez (con limitador de concurrencia) usando
        JPEG + detail:low para máxima velocidad.
-    2. Re-analizar con detail:high las páginas con confianza < 0.6
-    3. Post-procesar continuaciones localmente (sin API)
+    2. Subir por la cascada de modelos (`ModelRouter`) las páginas con
+       confianza < 0.6 o facturas sin albaranes ref. Cada página escala en
+       cuanto llega su resultado, sin esperar al resto del lote.
+
+    La corrección local de continuaciones la hace el agrupador
+    (`grouper.settle_continuation`).
 
     Args:
         image_paths: Lista de rutas a las imágenes PNG (previews).
         api_key: API key de OpenAI.
         model: Modelo a usar.
-        max_concurrent: Máximo de llamadas concurrentes.
+        max_concurrent: Techo de llamadas concurrentes (el limitador adaptativo
+                        arranca en la mitad y sube o baja según la API).
         timeout: Timeout por llamada en segundos.
         max_retries: Reintentos por página.
+        store: Almacén en memoria con las imágenes del lote. Opcional.
+        text_pages: Texto de las páginas nativas ({nº página: texto}). Esas
+                    páginas se analizan sin imagen.
+        text_model: Modelo para la llamada solo-texto (por defecto `model`).
+        text_local_only: Resolver las páginas nativas solo con parsers locales.
+        cache: Caché persistente de resultados por página. Opcional.
+        pages_per_request: Páginas consecutivas por llamada de visión (1 = una
+                           por llamada).
+        rpm_limit: Peticiones por minuto permitidas (0 = sin límite).
+        tpm_limit: Tokens por minuto permitidos (0 = sin límite).
+        router: Cascada ya creada, para compartir sus pools entre lotes. Si se
+                pasa, se ignoran model, max_concurrent, timeout, rpm_limit,
+                tpm_limit y cascade.
+        cascade: Pasos de la cascada de modelos. Por defecto: `model` en low
+                 y después `model` en high.
+        hedge_budget: Fracción máxima de llamadas de visión que se pueden
+                      duplicar si se retrasan (0 = sin duplicados).
+        hedge_percentile: Percentil de latencia a partir del cual se duplica.
+        base_url: URL base de la API (None = OpenAI). Para proxies o pruebas.
+        image: Optimización de la imagen en los pasos 2..n de la cascada (la
+               de la fase 1 ya la hace el splitter). Se ignora si se pasa
+               `router`.
+        classify_first: Clasificar primero cada tramo de páginas (miniatura +
+                        prompt corto) y extraer completas solo las que
+                        empiezan documento.
+        validator: Validación local (NIF, fechas, nºs, maestro) que decide
+                   junto con la confianza qué páginas suben por la cascada.
+                   Se ignora si se pasa `router`.
+        vision_backend: Motor de las páginas escaneadas: "llm" (API de
+                        visión), "local-first" (OCR local y a la API solo
+                        las que no lo superan) o "local" (solo OCR).
+        ocr: Motor de OCR local. Obligatorio salvo con "llm"; lo usan
+             también las plantillas.
+        templates: Plantillas de maquetación por proveedor. Las páginas que
+                   subirían por la cascada se releen antes con OCR en las
+                   regiones de la plantilla de su proveedor (requiere `ocr`).
 
     Returns:
         Lista de PageResult ordenada por número de página.
     """
-    client = AsyncOpenAI(api_key=api_key)
-    semaphore = asyncio.Semaphore(max_concurrent)
+    async def pages() -> AsyncIterator[tuple[int, str]]:
+        for i, image_path in enumerate(image_paths):
+            yield i + 1, image_path
+
+    return await analyze_page_stream(
+        pages=pages(),
+        api_key=api_key,
+        model=model,
+        max_concurrent=max_concurrent,
+        timeout=timeout,
+        max_retries=max_retries,
+        store=store,
+        text_pages=text_pages,
+        text_model=text_model,
+        text_local_only=text_local_only,
+        cache=cache,
+        pages_per_request=pages_per_request,
+        rpm_limit=rpm_limit,
+        tpm_limit=tpm_limit,
+        router=router,
+        cascade=cascade,
+        hedge_budget=hedge_budget,
+        hedge_percentile=hedge_percentile,
+        base_url=base_url,
+        image=image,
+        classify_first=classify_first,
+        validator=validator,
+        vision_backend=vision_backend,
+        ocr=ocr,
+        templates=templates,
+    )
 
-    total = len(image_paths)
-    logger.info(f"Analizando {total} páginas con {model} (max {max_concurrent} en paralelo)")
-    t0 = time.time()
 
-    # ── FASE 1: Análisis paralelo con detail:low + JPEG ──
+async def analyze_page_stream(
+    pages: AsyncIterator[tuple[int, str]],
+    api_key: str,
+    model: str = "gpt-4o-mini",
+    max_concurrent: int = 10,
+    timeout: int = 30,
+    max_retries: int = 3,
+    store: PageImageStore | None = None,
+    text_pages: dict[int, str] | None = None,
+    text_model: str | None = None,
+    text_local_only: bool = False,
+    cache: PageResultCache | None = None,
+    pages_per_request: int = 1,
+    rpm_limit: int = 0,
+    tpm_limit: int = 0,
+    router: ModelRouter | None = None,
+    cascade: list[CascadeStep] | None = None,
+    hedge_budget: float = 0.0,
+    hedge_percentile: float = 0.9,
+    base_url: str | None = None,
+    image: ImageOptions | None = None,
+    classify_first: bool = False,
+    validator: PageValidator | None = None,
+    vision_backend: str = BACKEND_LLM,
+    ocr: LocalOcrEngine | None = None,
+    templates: TemplateStore | None = None,
+    on_page: Callable[[PageResult], None] | None = None,
+) -> list[PageResult]:
+    """Analiza las páginas según van llegando de un productor (p.ej. `stream_pdf_pages`).
 
-    async def analyze_with_semaphore(image_path: str, page_number: int) -> PageResult:
-        async with semaphore:
-            return await _analyze_single_page(
-                client=client,
-                image_path=image_path,
-                page_number=page_number,
-                model=model,
-                timeout=timeout,
-                max_retries=max_retries,
-            )
+    Cada página se envía a la API en cuanto llega. Sin hueco en el limitador
+    se deja de consumir del productor, de modo que su cola
+    acotada frena también el renderizado. La fase 2 es la misma que en
+    `analyze_pages`.
 
-    tasks = [
-        analyze_with_semaphore(image_path, i + 1)
-        for i, image_path in enumerate(image_paths)
-    ]
-    results = await asyncio.gather(*tasks)
-    results = list(results)
+    Args:
+        pages: Iterador asíncrono de (nº de página, ruta PNG de preview).
+        api_key: API key de OpenAI.
+        model: Modelo a usar.
+        max_concurrent: Techo de llamadas concurrentes (el limitador adaptativo
+                        arranca en la mitad y sube o baja según la API).
+        timeout: Timeout por llamada en segundos.
+        max_retries: Reintentos por página.
+        store: Almacén en memoria con las imágenes del lote. Opcional.
+        text_pages: Texto de las páginas nativas ({nº página: texto}). Esas
+                    páginas se analizan sin imagen.
+        text_model: Modelo para la llamada solo-texto (por defecto `model`).
+        text_local_only: Resolver las páginas nativas solo con parsers locales.
+        cache: Caché persistente de resultados por página. Opcional.
+        pages_per_request: Páginas consecutivas por llamada de visión (1 = una
+                           por llamada).
+        rpm_limit: Peticiones por minuto permitidas (0 = sin límite).
+        tpm_limit: Tokens por minuto permitidos (0 = sin límite).
+        router: Cascada ya creada, para compartir sus pools entre lotes. Si se
+                pasa, se ignoran model, max_concurrent, timeout, rpm_limit,
+                tpm_limit y cascade.
+        cascade: Pasos de la cascada de modelos. Por defecto: `model` en low
+                 y después `model` en high.
+        hedge_budget: Fracción máxima de llamadas de visión que se pueden
+                      duplicar si se retrasan (0 = sin duplicados).
+        hedge_percentile: Percentil de latencia a partir del cual se duplica.
+        base_url: URL base de la API (None = OpenAI). Para proxies o pruebas.
+        image: Optimización de la imagen en los pasos 2..n de la cascada (la
+               de la fase 1 ya la hace el splitter). Se ignora si se pasa
+               `router`.
+        classify_first: Clasificar primero cada tramo de páginas (miniatura +
+                        prompt corto) y extraer completas solo las que
+                        empiezan documento.
+        validator: Validación local (NIF, fechas, nºs, maestro) que decide
+                   junto con la confianza qué páginas suben por la cascada.
+                   Se ignora si se pasa `router`.
+        vision_backend: Motor de las páginas escaneadas: "llm" (API de
+                        visión), "local-first" (OCR local y a la API solo
+                        las que no lo superan) o "local" (solo OCR).
+        ocr: Motor de OCR local. Obligatorio salvo con "llm"; lo usan
+             también las plantillas.
+        templates: Plantillas de maquetación por proveedor. Las páginas que
+                   subirían por la cascada se releen antes con OCR en las
+                   regiones de la plantilla de su proveedor (requiere `ocr`).
+        on_page: Se llama con el resultado definitivo de cada página (tras la
+                 cascada), en orden de página y en cuanto están definitivas
+                 ella y todas las anteriores. Para el agrupado en línea.
 
-    t1 = time.time()
-    logger.info(f"Fase 1 completada en {t1 - t0:.1f}s ({total} páginas)")
+    Returns:
+        Lista de PageResult ordenada por número de página.
+    """
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    if router is None:
+        cascade = cascade or [
+            CascadeStep(model, "low", max_concurrent, timeout),
+            CascadeStep(model, "high", 3, timeout * 2),
+        ]
+        router = ModelRouter(
+            cascade, rpm_limit=rpm_limit, tpm_limit=tpm_limit, image=image, validator=validator,
+        )
+    first = router.steps[0]
+    model = first.model
+    limiter = router.pool(model)
+    text_limiter = router.pool(text_model or model)
+
+    # OCR local: tantas páginas en vuelo como procesos tiene el motor
+    ocr_limiter = None
+    if vision_backend != BACKEND_LLM:
+        if ocr is None:
+            raise ValueError(f"vision_backend='{vision_backend}' necesita un motor de OCR local")
+        ocr_limiter = AdaptiveLimiter(max_limit=ocr.workers, initial=ocr.workers)
+    # Resultados de OCR que se mandaron a la API: se conservan si la API falla
+    ocr_fallbacks: dict[int, PageResult] = {}
+
+    # Resultados definitivos por página; `on_page` los recibe en orden
+    by_page: dict[int, PageResult] = {}
+    next_page = 1
+
+    def settle(result: PageResult) -> PageResult:
+        nonlocal next_page
+        local = ocr_fallbacks.get(result.page_number)
+        if local is not None and result.confianza == 0:
+            logger.warning(f"  Pág {result.page_number}: API no disponible, usando el resultado del OCR local")
+            result = local
+        by_page[result.page_number] = result
+        if on_page is not None:
+            while next_page in by_page:
+                on_page(by_page[next_page])
+                next_page += 1
+        return result
+
+    # Presupuesto de duplicados propio de este lote
+    hedger = Hedger(hedge_percentile, hedge_budget) if hedge_budget > 0 else None
 
-    # ── FASE 2: Retry con detail:high para páginas que necesitan más detalle ──
-    # - Baja confianza (<0.6)
-    # - Facturas sin nºs de albarán referenciados (necesitan leer líneas de detalle)
+    logger.info(
+        f"Analizando páginas con {model}/{first.detail} "
+        f"(concurrencia adaptativa {int(limiter.limit)}-{limiter.max_limit}, "
+        f"{len(router.steps)} pasos de cascada"
+        f"{f', motor {vision_backend} con {ocr.workers} procesos de OCR' if ocr_limiter else ''})"
+    )
+    t0 = time.time()
 
-    LOW_CONFIDENCE = 0.6
-    needs_retry = []
-    for i, r in enumerate(results):
-        if r.confianza < LOW_CONFIDENCE:
-            needs_retry.append(i)
-        elif r.tipo == TipoDocumento.FACTURA and not r.numeros_albaran_ref:
-            needs_retry.append(i)
+    # ── FASE 1: Análisis paralelo (paso 1 de la cascada) + JPEG, según llegan ──
 
-    low_conf_indices = list(set(needs_retry))
+    # La fase 1 de cada página decide al terminar si la sube por la cascada,
+    # sin esperar al resto del lote
+    retry_tasks: list[asyncio.Task] = []
 
-    if low_conf_indices:
-        logger.info(
-            f"Fase 2: re-analizando {len(low_conf_indices)} páginas con detail:high "
-            f"(baja confianza o facturas sin albaranes ref.)"
+    async def run_and_release(coro: Awaitable, pool: AdaptiveLimiter | None) -> list[PageResult]:
+        try:
+            result = await coro
+        finally:
+            if pool is not None:
+                pool.release()
+        page_results = result if isinstance(result, list) else [result]
+        for r in page_results:
+            if r.origen in _VISION_ORIGINS and r.paso_cascada is None:
+                router.mark(r, 1, model)
+            _fill_from_codes(r, store)
+            if needs_high_detail(r, router.validator):
+                retry_tasks.append(asyncio.create_task(escalate_and_settle(r)))
+            else:
+                settle(r)
+        return page_results
+
+    template_reads = 0
+
+    async def reread_or_escalate(result: PageResult) -> PageResult:
+        # Con plantilla del proveedor se releen solo sus regiones antes de subir por la cascada
+        nonlocal template_reads
+        if templates is not None and ocr is not None:
+            reread = await _read_with_template(result, templates, ocr, store, router.validator)
+            if reread is not result:
+                template_reads += 1
+                result = reread
+                if not needs_high_detail(result, router.validator):
+                    return result
+        return await router.escalate(client, result, store, cache)
+
+    async def escalate_and_settle(result: PageResult) -> PageResult:
+        result = await reread_or_escalate(result)
+        _fill_from_codes(result, store)
+        return settle(result)
+
+    async def run_local(page_number: int, image_path: str) -> list[PageResult]:
+        nonlocal template_reads
+        try:
+            result = await _analyze_ocr_page(ocr, image_path, page_number, store, router.validator)
+        finally:
+            ocr_limiter.release()
+        _fill_from_codes(result, store)
+        if templates is not None and needs_high_detail(result, router.validator):
+            reread = await _read_with_template(result, templates, ocr, store, router.validator)
+            if reread is not result:
+                template_reads += 1
+                result = reread
+        if vision_backend == BACKEND_LOCAL or not needs_high_detail(result, router.validator):
+            return [settle(result)]
+
+        # El OCR no basta: a la API como cualquier página de visión
+        ocr_fallbacks[page_number] = result
+        await limiter.acquire(priority=PRIORITY_PAGE)
+        coro = _analyze_single_page(
+            client=client,
+            image_path=image_path,
+            page_number=page_number,
+            model=model,
+            timeout=first.timeout,
+            max_retries=max_retries,
+            store=store,
+            cache=cache,
+            limiter=limiter,
+            hedger=hedger,
+            detail=first.detail,
         )
+        return await run_and_release(coro, limiter)
+
+    tasks: list[asyncio.Task] = []
+    # Páginas de visión consecutivas pendientes de enviar juntas
+    vision_buffer: list[tuple[int, str]] = []
+
+    async def flush_vision() -> None:
+        if not vision_buffer:
+            return
+        group = list(vision_buffer)
+        vision_buffer.clear()
+        # Sin hueco no se pide la siguiente página al productor
+        await limiter.acquire(priority=PRIORITY_PAGE)
+        if classify_first:
+            coro = _classify_then_extract(
+                client=client,
+                pages=group,
+                model=model,
+                timeout=first.timeout,
+                max_retries=max_retries,
+                store=store,
+                cache=cache,
+                limiter=limiter,
+                hedger=hedger,
+                detail=first.detail,
+            )
+        elif len(group) == 1:
+            page_number, image_path = group[0]
+            coro = _analyze_single_page(
+                client=client,
+                image_path=image_path,
+                page_number=page_number,
+                model=model,
+                timeout=first.timeout,
+                max_retries=max_retries,
+                store=store,
+                cache=cache,
+                limiter=limiter,
+                hedger=hedger,
+                detail=first.detail,
+            )
+        else:
+            coro = _analyze_page_group(
+                client=client,
+                pages=group,
+                model=model,
+                timeout=first.timeout,
+                max_retries=max_retries,
+                store=store,
+                cache=cache,
+                limiter=limiter,
+                detail=first.detail,
+            )
+        # Clasificar primero suelta el hueco por su cuenta (uno por petición)
+        pool = None if classify_first else limiter
+        tasks.append(asyncio.create_task(run_and_release(coro, pool)))
 
-        retry_semaphore = asyncio.Semaphore(3)  # Menos concurrencia para high detail
-
-        async def retry_with_semaphore(idx: int) -> tuple[int, PageResult]:
-            async with retry_semaphore:
-                new_result = await _retry_with_high_detail(
+    try:
+        async for page_number, image_path in pages:
+            if store is not None and store.is_blank(page_number):
+                settle(_blank_page_result(page_number, image_path))
+                logger.info(f"  Pág {page_number}: en blanco (sin llamada a la API)")
+                continue
+
+            codes = store.codes(page_number) if store is not None else None
+            if codes is not None and codes.fiscal is not None:
+                result = _code_page_result(codes.fiscal, page_number, image_path)
+                if needs_high_detail(result, router.validator):
+                    # El QR no trae proveedor ni albaranes: la página sube por la cascada
+                    retry_tasks.append(asyncio.create_task(escalate_and_settle(result)))
+                else:
+                    settle(result)
+                continue
+
+            text = text_pages.get(page_number) if text_pages else None
+            if text is not None and text_local_only:
+                settle(_analyze_text_page_locally(text, image_path, page_number))
+                continue
+
+            if text is not None:
+                await text_limiter.acquire(priority=PRIORITY_PAGE)
+                coro = _analyze_text_page(
                     client=client,
-                    result=results[idx],
-                    model=model,
-                    timeout=timeout,
+                    text=text,
+                    image_path=image_path,
+                    page_number=page_number,
+                    model=text_model or model,
+                    timeout=first.timeout,
+                    max_retries=max_retries,
+                    cache=cache,
+                    limiter=text_limiter,
                 )
-                return idx, new_result
-
-        retry_tasks = [retry_with_semaphore(i) for i in low_conf_indices]
-        retry_results = await asyncio.gather(*retry_tasks)
-
-        for idx, new_result in retry_results:
-            results[idx] = new_result
+                tasks.append(asyncio.create_task(run_and_release(coro, text_limiter)))
+                continue
+
+            if ocr_limiter is not None:
+                await ocr_limiter.acquire(priority=PRIORITY_PAGE)
+                tasks.append(asyncio.create_task(run_local(page_number, image_path)))
+                continue
+
+            # Solo se agrupan páginas consecutivas
+            if vision_buffer and vision_buffer[-1][0] != page_number - 1:
+                await flush_vision()
+            vision_buffer.append((page_number, image_path))
+            if len(vision_buffer) >= max(1, pages_per_request):
+                await flush_vision()
+
+        await flush_vision()
+        await asyncio.gather(*tasks)
+        t1 = time.time()
+        # Con la fase 1 terminada ya no se encolan más reintentos
+        await asyncio.gather(*retry_tasks)
+    except BaseException:
+        for task in tasks + retry_tasks:
+            task.cancel()
+        raise
+
+    results = [by_page[n] for n in sorted(by_page)]
+    if on_page is not None:
+        # Páginas tras un hueco en la numeración (no deberían quedar)
+        for r in results:
+            if r.page_number >= next_page:
+                on_page(r)
+
+    total = len(results)
+    if not total:
+        return results
 
+    n_blank = sum(1 for r in results if r.es_blanco)
+    n_text = sum(1 for r in results if r.origen in _TEXT_ORIGINS)
+    n_codes = sum(1 for r in results if r.origen == ORIGEN_CODIGO)
+    n_ocr = sum(1 for r in results if r.origen == ORIGEN_OCR)
+    n_local = sum(1 for r in results if r.origen in _LOCAL_ORIGINS)
+    n_classified = sum(1 for r in results if r.origen == ORIGEN_CLASIFICACION)
+    logger.info(
+        f"Fase 1 completada en {t1 - t0:.1f}s ({total} páginas, "
+        f"{n_blank} en blanco sin API, {n_text} por capa de texto, {n_codes} por QR"
+        f"{f', {n_ocr} por OCR local' if ocr_limiter else ''}"
+        f"{f', {n_classified} continuaciones solo clasificadas' if classify_first else ''})"
+    )
+    logger.info(f"Resueltas localmente: {n_local}/{total} páginas ({n_local / total:.0%})")
+    if retry_tasks:
         t2 = time.time()
-        logger.info(f"Fase 2 completada en {t2 - t1:.1f}s")
-
-    # ── FASE 3: Post-proceso local de continuaciones ──
-
-    results = _postprocess_continuations(results)
+        logger.info(
+            f"Fase 2: {len(retry_tasks)} páginas escaladas por la cascada "
+            f"(baja confianza o facturas sin albaranes ref.), "
+            f"{t2 - t1:.1f}s tras la fase 1"
+        )
+    if template_reads:
+        logger.info(f"Plantillas de proveedor: {template_reads} páginas completadas releyendo sus regiones")
+    logger.info(f"Cascada: {router.summary(results)}")
+    if hedger is not None:
+        logger.info(f"Duplicados: {hedger.summary()}")
 
     elapsed = time.time() - t0
     logger.info(
@@ -538,3 +1930,85 @@ async def analyze_pages(
         f"({elapsed / total:.1f}s/pág)"
     )
     return results
+
+
+# ── Modo Batch API (ver core.batch_mode) ──
+# Mismos prompts y mismo tratamiento de respuestas que el modo en línea, pero
+# separando la construcción de la petición de la lectura de la respuesta.
+
+
+def resolve_page_locally(
+    page_number: int,
+    image_path: str | None,
+    store: PageImageStore | None = None,
+    text: str | None = None,
+    text_local_only: bool = False,
+) -> PageResult | None:
+    """Resultado de una página que no necesita API (blanca, QR fiscal o nativa local)."""
+    if store is not None and store.is_blank(page_number):
+        return _blank_page_result(page_number, image_path)
+    codes = store.codes(page_number) if store is not None else None
+    if codes is not None and codes.fiscal is not None:
+        return _code_page_result(codes.fiscal, page_number, image_path)
+    if text is not None and text_local_only:
+        return _analyze_text_page_locally(text, image_path, page_number)
+    return None
+
+
+async def build_page_request(
+    page_number: int,
+    image_path: str,
+    model: str,
+    store: PageImageStore | None = None,
+    text: str | None = None,
+    detail: str = "low",
+) -> dict:
+    """Cuerpo de chat completions de la fase 1 para una página."""
+    if text is not None:
+        return _completion_params(model, _text_messages(text, page_number), 500)
+    api_image = _get_api_image_path(image_path, store)
+    b64 = await _encode_image(api_image, store)
+    messages = _vision_messages(b64, _get_mime_type(api_image), page_number, detail)
+    return _completion_params(model, messages, 500)
+
+
+async def build_high_detail_request(
+    result: PageResult,
+    model: str,
+    store: PageImageStore | None = None,
+    detail: str = "high",
+    image: ImageOptions | None = None,
+) -> dict:
+    """Cuerpo de chat completions de un paso de escalado de la cascada."""
+    messages, _, max_tokens = await _retry_messages(result, detail, store, image)
+    return _completion_params(model, messages, max_tokens)
+
+
+def page_result_from_answer(
+    raw_text: str | None,
+    page_number: int,
+    image_path: str | None,
+    text: str | None = None,
+    model: str | None = None,
+) -> PageResult:
+    """PageResult de la fase 1 a partir de una respuesta (None = sin respuesta)."""
+    if text is not None:
+        result = _text_result(raw_text, text, page_number, image_path)
+    else:
+        result = _vision_result(raw_text, page_number, image_path)
+        ModelRouter.mark(result, 1, model)
+    _log_result(result)
+    return result
+
+
+def high_detail_from_answer(
+    result: PageResult, raw_text: str | None, step_number: int | None = None, model: str | None = None,
+) -> PageResult:
+    """Aplica la respuesta de un paso de escalado (None = sin respuesta)."""
+    if raw_text is None:
+        logger.warning(f"  Pag {result.page_number} RETRY-HD fallo")
+        return result
+    new_result = _retry_result(raw_text, result)
+    ModelRouter.mark(new_result, step_number, model)
+    return _pick_high_detail(result, new_result)
+
@@ -1,8 +1,10 @@
 """Renombra y mueve documentos procesados a la carpeta destino del servidor."""
 
 from __future__ import annotations
+import contextlib
 import logging
 import shutil
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
@@ -12,6 +14,10 @@ from .models import Document, EstadoDocumento, TipoDocumento
 
 logger = logging.getLogger(__name__)
 
+# Nombres de destino reservados por archivados en curso (varios hilos a la vez)
+_reserved_lock = threading.Lock()
+_reserved: set[Path] = set()
+
 
 def archive_documents(
     documents: list[Document],
@@ -36,36 +42,55 @@ def archive_documents(
     year = str(datetime.now().year)
 
     for doc in documents:
-        if not doc.pdf_path:
-            continue  # Albarán asociado sin PDF propio
+        archive_document(doc, config, year)
 
-        if doc.estado == EstadoDocumento.REVISAR or doc.estado == EstadoDocumento.CORREGIDO:
-            # Mover a pendientes de revisión
-            dest_dir = Path(config.paths.pendientes)
-        else:
-            # Mover a salida organizada
-            dest_dir = _build_dest_dir(doc, config.paths.salida, year)
+    archivados = sum(1 for d in documents if d.ruta_destino)
+    logger.info(f"Archivado completado: {archivados} documentos movidos")
 
-        dest_dir.mkdir(parents=True, exist_ok=True)
+    return documents
 
-        # Generar nombre de fichero
-        filename = _build_filename(doc)
-        dest_path = dest_dir / filename
 
-        # Evitar sobreescritura
-        dest_path = _safe_path(dest_path)
+def archive_document(doc: Document, config: AppConfig, year: str | None = None) -> bool:
+    """Renombra y mueve un documento a su carpeta destino (ver `archive_documents`).
 
-        # Mover
-        shutil.move(doc.pdf_path, str(dest_path))
-        doc.ruta_destino = str(dest_path)
-        doc.fichero_nombre = dest_path.name
+    Se puede llamar desde varios hilos a la vez: el nombre de destino se
+    reserva para que dos documentos no acaben en el mismo fichero.
 
-        logger.info(f"  Archivado: {dest_path.name} → {dest_dir}")
+    Returns:
+        True si se movió un PDF.
+    """
+    if not doc.pdf_path:
+        return False  # Albarán asociado sin PDF propio
 
-    archivados = sum(1 for d in documents if d.ruta_destino)
-    logger.info(f"Archivado completado: {archivados} documentos movidos")
+    year = year or str(datetime.now().year)
+    if doc.estado == EstadoDocumento.REVISAR or doc.estado == EstadoDocumento.CORREGIDO:
+        # Mover a pendientes de revisión
+        dest_dir = Path(config.paths.pendientes)
+    else:
+        # Mover a salida organizada
+        dest_dir = _build_dest_dir(doc, config.paths.salida, year)
 
-    return documents
+    dest_dir.mkdir(parents=True, exist_ok=True)
+
+    # Generar nombre de fichero (evitando sobreescritura)
+    dest_path = _reserve_path(dest_dir / _build_filename(doc))
+    try:
+        # Mover
+        shutil.move(doc.pdf_path, str(dest_path))
+    except OSError:
+        # Copia a medias (p.ej. corte de red en el recurso compartido): se borra para reintentar
+        if Path(doc.pdf_path).exists():
+            with contextlib.suppress(OSError):
+                dest_path.unlink(missing_ok=True)
+        raise
+    finally:
+        with _reserved_lock:
+            _reserved.discard(dest_path)
+    doc.ruta_destino = str(dest_path)
+    doc.fichero_nombre = dest_path.name
+
+    logger.info(f"  Archivado: {dest_path.name} → {dest_dir}")
+    return True
 
 
 def move_original_to_processed(pdf_path: str | Path, config: AppConfig) -> None:
@@ -123,14 +148,22 @@ def _sanitize(text: str) -> str:
     return result
 
 
-def _safe_path(path: Path) -> Path:
+def _reserve_path(path: Path) -> Path:
+    """Como `_safe_path`, pero descartando también los nombres reservados por otros hilos."""
+    with _reserved_lock:
+        path = _safe_path(path, _reserved)
+        _reserved.add(path)
+        return path
+
+
+def _safe_path(path: Path, taken: set[Path] = frozenset()) -> Path:
     """Si el fichero ya existe, añade sufijo _2, _3, etc."""
-    if not path.exists():
+    if not path.exists() and path not in taken:
         return path
 
     counter = 2
     while True:
         new_path = path.parent / f"{path.stem}_{counter}{path.suffix}"
-        if not new_path.exists():
+        if not new_path.exists() and new_path not in taken:
             return new_path
         counter += 1
@@ -0,0 +1,252 @@
+"""Asociación óptima de albaranes con facturas (modo `optimal`).
+
+El asociador por niveles (`associator`) es voraz: cada albarán se queda con
+la primera factura que pasa un nivel, así que un match parcial temprano y
+erróneo puede quitarle la referencia al albarán que de verdad le
+corresponde. Aquí se construye la matriz de puntuaciones albarán × factura
+de una vez con NumPy y se resuelve la asignación que maximiza la suma
+(algoritmo húngaro de scipy), con capacidad: cada nº de albarán
+referenciado en una factura admite un solo albarán.
+
+Señales por par (albarán, referencia), de más a menos fuerte:
+exacto normalizado, dígitos exactos, contención normalizada y dígitos en
+común (contenidos o como sufijo, mínimo 4). La puntuación de la factura es
+la de su mejor referencia, y a igualdad deshacen el empate el mismo
+proveedor y la cercanía de fechas.
+
+Los albaranes que no casan por número pasan al fallback por proveedor
+(mismo proveedor; si hay varias facturas, la de fecha más cercana, máximo
+30 días), igual que el asociador por niveles.
+
+Requiere scipy; sin él se usa el asociador por niveles.
+"""
+
+from __future__ import annotations
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # scipy no instalado
+    linear_sum_assignment = None
+
+from .associator import FacturaIndex, _extract_digits, _normalize, associate_delivery_notes
+from .models import Document, TipoDocumento
+
+logger = logging.getLogger(__name__)
+
+# Pesos de las señales. Cada nivel supera a cualquier puntuación del siguiente
+# con todos sus bonus: W_OVERLAP_DIGIT * MAX_SCORED_CHARS + W_PROVIDER +
+# MAX_DATE_DAYS = 190 es menor que cualquier hueco entre niveles (200)
+W_EXACT = 1000.0
+W_DIGITS = 800.0
+W_PARTIAL = 400.0
+W_OVERLAP = 100.0
+W_OVERLAP_DIGIT = 10.0     # por carácter en común (contención o sufijo)
+MAX_SCORED_CHARS = 12      # caracteres en común que puntúan, como mucho
+W_PROVIDER = 40.0
+MAX_DATE_DAYS = 30         # bonus por cercanía de fechas: MAX_DATE_DAYS - días
+
+
+@dataclass
+class PairScore:
+    """Puntuación de una asociación, para auditoría."""
+    albaran_id: str
+    numero_albaran: str | None
+    factura_id: str
+    numero_factura: str | None
+    score: float
+    metodo: str   # "numero" | "mismo proveedor"
+
+
+def scipy_available() -> bool:
+    return linear_sum_assignment is not None
+
+
+def assign_delivery_notes(
+    documents: list[Document],
+    audit: list[PairScore] | None = None,
+) -> list[Document]:
+    """Asocia cada albarán con su factura resolviendo la asignación óptima.
+
+    Args:
+        documents: Lista de documentos ya agrupados.
+        audit: Si se pasa, se le añade la puntuación de cada asociación.
+
+    Returns:
+        La misma lista con las asociaciones establecidas.
+    """
+    if not scipy_available():
+        logger.warning("scipy no instalado — se usa el asociador por niveles")
+        return associate_delivery_notes(documents)
+
+    facturas = [d for d in documents if d.tipo == TipoDocumento.FACTURA]
+    albaranes = [
+        d for d in documents if d.tipo == TipoDocumento.ALBARAN and d.numero_albaran
+    ]
+    if not facturas or not albaranes:
+        logger.info(f"Asociacion optima: {len(facturas)} facturas, {len(albaranes)} albaranes con nº - nada que asociar")
+        return documents
+
+    logger.info(f"Asociacion optima: {len(albaranes)} albaranes con {len(facturas)} facturas")
+    scores, provider, days = score_matrix(albaranes, facturas)
+
+    # Columnas: una por nº de albarán referenciado (capacidad de cada factura)
+    capacity = np.array([len(f.numeros_albaran_ref) for f in facturas])
+    columns = np.repeat(np.arange(len(facturas)), capacity)
+    assigned: dict[int, tuple[int, str]] = {}
+    if columns.size:
+        rows, cols = linear_sum_assignment(scores[:, columns], maximize=True)
+        for a, c in zip(rows, cols):
+            f = columns[c]
+            if scores[a, f] > 0:
+                assigned[a] = (f, "numero")
+
+    # Fallback por proveedor para los que no casan por número
+    for a in range(len(albaranes)):
+        if a in assigned:
+            continue
+        candidates = np.flatnonzero(provider[a])
+        if len(candidates) == 1:
+            assigned[a] = (candidates[0], "mismo proveedor")
+        elif len(candidates) > 1:
+            dist = days[a, candidates]
+            if not np.isnan(dist).all():
+                best = int(np.nanargmin(dist))
+                if dist[best] <= MAX_DATE_DAYS:
+                    assigned[a] = (candidates[best], "mismo proveedor")
+
+    for a, albaran in enumerate(albaranes):
+        if a not in assigned:
+            logger.info(
+                f"  Albaran {albaran.numero_albaran} "
+                f"(prov: {albaran.proveedor_nombre}) -> sin factura asociada"
+            )
+            continue
+        f, metodo = assigned[a]
+        factura = facturas[f]
+        albaran.factura_asociada_id = factura.id
+        pair = PairScore(
+            albaran.id, albaran.numero_albaran, factura.id, factura.numero_factura,
+            round(float(scores[a, f]), 1), metodo,
+        )
+        if audit is not None:
+            audit.append(pair)
+        logger.info(
+            f"  Albaran {albaran.numero_albaran} -> Factura {factura.numero_factura or '?'} "
+            f"({metodo}, puntuacion {pair.score})"
+        )
+
+    logger.info(f"Asociacion completada: {len(assigned)}/{len(albaranes)} albaranes asociados")
+    return documents
+
+
+def score_matrix(
+    albaranes: list[Document],
+    facturas: list[Document],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Matrices albarán × factura: puntuación por nº, mismo proveedor y días entre fechas.
+
+    La puntuación es 0 si ninguna referencia de la factura casa con el nº del
+    albarán. Los días son NaN si falta alguna de las dos fechas.
+    """
+    n_alb, n_fac = len(albaranes), len(facturas)
+
+    # ── Albarán × referencia ──
+    refs = [ref for f in facturas for ref in f.numeros_albaran_ref]
+    owners = np.array([fi for fi, f in enumerate(facturas) for _ in f.numeros_albaran_ref], dtype=int)
+    numbers = np.zeros((n_alb, n_fac))
+    if refs:
+        ref_scores = _reference_scores([a.numero_albaran for a in albaranes], refs)
+        # Mejor referencia de cada factura (las referencias van agrupadas por factura)
+        starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        numbers[:, owners[starts]] = np.maximum.reduceat(ref_scores, starts, axis=1)
+
+    # ── Proveedor ──
+    alb_nif = _column([(a.proveedor_nif or "").strip().upper() for a in albaranes])
+    fac_nif = _row([(f.proveedor_nif or "").strip().upper() for f in facturas])
+    alb_name = _column([(a.proveedor_nombre or "").strip().lower() for a in albaranes])
+    fac_name = _row([(f.proveedor_nombre or "").strip().lower() for f in facturas])
+    provider = (
+        ((alb_nif == fac_nif) & (alb_nif != ""))
+        | (
+            ((np.char.find(fac_name, alb_name) >= 0) | (np.char.find(alb_name, fac_name) >= 0))
+            & (alb_name != "") & (fac_name != "")
+        )
+    )
+
+    # ── Fechas ──
+    alb_days = np.array([a.fecha_documento.toordinal() if a.fecha_documento else np.nan for a in albaranes])
+    fac_days = np.array([f.fecha_documento.toordinal() if f.fecha_documento else np.nan for f in facturas])
+    days = np.abs(alb_days[:, None] - fac_days[None, :])
+    date_bonus = np.nan_to_num(np.clip(MAX_DATE_DAYS - days, 0, MAX_DATE_DAYS))
+
+    scores = np.where(numbers > 0, numbers + W_PROVIDER * provider + date_bonus, 0.0)
+    return scores, provider, days
+
+
+def _reference_scores(numeros: list[str], refs: list[str]) -> np.ndarray:
+    """Puntuación de cada par (nº de albarán, referencia) según el nivel que casa."""
+    alb_norm = _column([_normalize(n) for n in numeros])
+    ref_norm = _row([_normalize(r) for r in refs])
+    alb_dig = _column([_extract_digits(n) for n in numeros])
+    ref_dig = _row([_extract_digits(r) for r in refs])
+    alb_norm_len, ref_norm_len = np.char.str_len(alb_norm), np.char.str_len(ref_norm)
+    alb_dig_len, ref_dig_len = np.char.str_len(alb_dig), np.char.str_len(ref_dig)
+
+    both_norm = (alb_norm_len > 0) & (ref_norm_len > 0)
+    exact = (alb_norm == ref_norm) & both_norm
+    digits = (
+        (alb_dig == ref_dig)
+        & (alb_dig_len >= FacturaIndex.MIN_DIGITS) & (ref_dig_len > 0)
+    )
+    partial = both_norm & (
+        (np.char.find(ref_norm, alb_norm) >= 0) | (np.char.find(alb_norm, ref_norm) >= 0)
+    )
+    partial_len = np.minimum(np.minimum(alb_norm_len, ref_norm_len), MAX_SCORED_CHARS)
+
+    # Dígitos en común: uno contenido en el otro, o sufijo común
+    both_dig = (alb_dig_len >= FacturaIndex.MIN_DIGITS) & (ref_dig_len > 0)
+    contained = both_dig & (
+        (np.char.find(ref_dig, alb_dig) >= 0) | (np.char.find(alb_dig, ref_dig) >= 0)
+    )
+    overlap = np.where(contained, np.minimum(alb_dig_len, ref_dig_len), 0)
+    overlap = np.maximum(overlap, np.where(both_dig, _common_suffix(alb_dig[:, 0], ref_dig[0]), 0))
+    overlap = np.where(overlap >= FacturaIndex.MIN_PARTIAL_DIGITS, np.minimum(overlap, MAX_SCORED_CHARS), 0)
+
+    return np.select(
+        [exact, digits, partial, overlap > 0],
+        [
+            W_EXACT,
+            W_DIGITS,
+            W_PARTIAL + W_OVERLAP_DIGIT * partial_len,
+            W_OVERLAP + W_OVERLAP_DIGIT * overlap,
+        ],
+        default=0.0,
+    )
+
+
+def _common_suffix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Longitud del sufijo común de cada par (a[i], b[j]) de cadenas de dígitos."""
+    width = max(int(np.char.str_len(a).max(initial=0)), int(np.char.str_len(b).max(initial=0)), 1)
+    # Cadenas invertidas y rellenas a la derecha: la posición k es el k-ésimo dígito por el final
+    ra = _char_matrix(a, width)
+    rb = _char_matrix(b, width)
+    same = (ra[:, None, :] == rb[None, :, :]) & (ra[:, None, :] != 0)
+    return np.cumprod(same, axis=2).sum(axis=2)
+
+
+def _char_matrix(values: np.ndarray, width: int) -> np.ndarray:
+    # Las cadenas de ancho fijo ya vienen rellenas con ceros
+    reversed_ = np.array([v[::-1] for v in values.tolist()], dtype=f"<U{width}")
+    return np.frombuffer(reversed_.tobytes(), dtype=np.uint32).reshape(len(values), width)
+
+
+def _column(values: list[str]) -> np.ndarray:
+    return np.array(values, dtype=str).reshape(-1, 1)
+
+
+def _row(values: list[str]) -> np.ndarray:
+    return np.array(values, dtype=str).reshape(1, -1)
@@ -45,26 +45,14 @@ def associate_delivery_notes(documents: list[Document]) -> list[Document]:
         else:
             logger.info(f"  Factura {f.numero_factura or '?'} sin albaranes referenciados")
 
+    index = FacturaIndex(facturas)
     asociados = 0
     for albaran in albaranes:
         if not albaran.numero_albaran:
             logger.info(f"  Albaran sin numero -> sin asociar")
             continue
 
-        # Nivel 1: Match exacto normalizado
-        match = _find_by_exact_match(albaran, facturas)
-        method = "match exacto"
-
-        # Nivel 2: Match solo por digitos
-        if not match:
-            match = _find_by_digits_match(albaran, facturas)
-            method = "match numerico"
-
-        # Nivel 3: Fallback por proveedor
-        if not match:
-            match = _find_by_provider(albaran, facturas)
-            method = "mismo proveedor"
-
+        match, method = index.find(albaran)
         if match:
             albaran.factura_asociada_id = match.id
             asociados += 1
@@ -93,127 +81,231 @@ def _extract_digits(num: str) -> str:
     return re.sub(r'[^0-9]', '', num)
 
 
-def _find_by_exact_match(
-    albaran: Document, facturas: list[Document]
-) -> Document | None:
-    """Busca factura que referencia este albaran (match exacto normalizado)."""
-    albaran_num = _normalize(albaran.numero_albaran or "")
-    if not albaran_num:
-        return None
-
-    for factura in facturas:
-        for ref in factura.numeros_albaran_ref:
-            if _normalize(ref) == albaran_num:
-                return factura
-
-    # Match parcial: el nº del albaran contiene la referencia o viceversa
-    for factura in facturas:
-        for ref in factura.numeros_albaran_ref:
-            ref_norm = _normalize(ref)
-            if ref_norm and (albaran_num in ref_norm or ref_norm in albaran_num):
-                return factura
+def reference_keys(num: str) -> tuple[str, str]:
+    """Claves de busqueda exacta de un nº de albaran: (normalizado, digitos).
 
-    return None
+    Las mismas que usan el match exacto y el numerico de `FacturaIndex`; los
+    digitos quedan vacios si son menos de `FacturaIndex.MIN_DIGITS`.
+    """
+    digits = _extract_digits(num)
+    return _normalize(num), digits if len(digits) >= FacturaIndex.MIN_DIGITS else ""
 
 
-def _find_by_digits_match(
-    albaran: Document, facturas: list[Document]
-) -> Document | None:
-    """Busca factura comparando solo los digitos del nº de albaran.
+class _GramIndex:
+    """Indice de n-gramas para buscar la primera cadena que contiene otra.
 
-    Esto resuelve el caso donde GPT lee "2770" en la factura pero el albaran
-    real es "27780" - los digitos pueden coincidir parcialmente.
+    Las listas de posiciones quedan ordenadas (se insertan en orden), asi que
+    la primera que verifica es la de menor posicion.
     """
-    alb_digits = _extract_digits(albaran.numero_albaran or "")
-    if not alb_digits or len(alb_digits) < 3:
+
+    def __init__(self, n: int):
+        self.n = n
+        self._texts: dict[int, str] = {}
+        self._postings: dict[str, list[int]] = {}
+
+    def add(self, pos: int, text: str) -> None:
+        self._texts[pos] = text
+        for g in range(1, self.n + 1):
+            for gram in {text[i:i + g] for i in range(len(text) - g + 1)}:
+                self._postings.setdefault(gram, []).append(pos)
+
+    def first_containing(self, query: str) -> int | None:
+        g = min(len(query), self.n)
+        grams = {query[i:i + g] for i in range(len(query) - g + 1)}
+        postings = [self._postings.get(gram, []) for gram in grams]
+        for pos in min(postings, key=len, default=[]):
+            if query in self._texts[pos]:
+                return pos
         return None
 
-    best_match = None
-    best_score = 0
-
-    for factura in facturas:
-        for ref in factura.numeros_albaran_ref:
-            ref_digits = _extract_digits(ref)
-            if not ref_digits:
-                continue
-
-            # Match exacto de digitos
-            if ref_digits == alb_digits:
-                return factura
-
-            # Match parcial: ref esta contenida en albaran o viceversa
-            # Pero requiere al menos 4 digitos en comun para evitar falsos positivos
-            if len(ref_digits) >= 4 and len(alb_digits) >= 4:
-                if ref_digits in alb_digits or alb_digits in ref_digits:
-                    score = min(len(ref_digits), len(alb_digits))
-                    if score > best_score:
-                        best_score = score
-                        best_match = factura
-
-            # Match por sufijo: los ultimos N digitos coinciden
-            # Ej: ref="2770" alb="27780" -> no
-            # Ej: ref="27820" alb="27820" -> si
-            # Util cuando GPT omite un digito del medio
-            common_suffix = _common_suffix_len(ref_digits, alb_digits)
-            if common_suffix >= 4:
-                score = common_suffix
-                if score > best_score:
-                    best_score = score
-                    best_match = factura
-
-    return best_match
-
-
-def _common_suffix_len(a: str, b: str) -> int:
-    """Longitud del sufijo comun mas largo entre dos strings."""
-    count = 0
-    for ca, cb in zip(reversed(a), reversed(b)):
-        if ca == cb:
-            count += 1
-        else:
-            break
-    return count
 
+class _SuffixNode:
+    """Nodo del trie de digitos invertidos (sufijos comunes)."""
+    __slots__ = ("children", "min_pos")
+
+    def __init__(self):
+        self.children: dict[str, _SuffixNode] = {}
+        self.min_pos: int | None = None
+
+
+class FacturaIndex:
+    """Indices de las facturas de un lote para asociar albaranes sin recorrerlas.
 
-def _find_by_provider(
-    albaran: Document, facturas: list[Document]
-) -> Document | None:
-    """Fallback: busca factura del mismo proveedor (por NIF o nombre).
+    Reproduce los 3 niveles de la asociacion (y sus desempates: gana la
+    primera factura/referencia en el orden del lote) con busquedas en tablas
+    hash construidas una sola vez:
 
-    Si hay multiples facturas del mismo proveedor, asocia con la que tenga
-    fecha mas cercana al albaran. Si no hay fechas, solo asocia si hay 1 factura.
+    - Referencias normalizadas, con indice de n-gramas (match exacto y parcial).
+    - Digitos de las referencias, con indice de 4-gramas (match numerico por
+      contencion).
+    - Trie de digitos invertidos (match por sufijo comun).
+    - Facturas por NIF y por nombre de proveedor.
+
+    Cada referencia se identifica por su posicion (factura, referencia) en el
+    orden del lote; los indices guardan la posicion minima.
     """
-    alb_nif = (albaran.proveedor_nif or "").strip().upper()
-    alb_nombre = (albaran.proveedor_nombre or "").strip().lower()
 
-    if not alb_nif and not alb_nombre:
+    MIN_DIGITS = 3
+    MIN_PARTIAL_DIGITS = 4
+
+    def __init__(self, facturas: list[Document]):
+        self.facturas = facturas
+        self._ref_factura: list[int] = []        # posicion de la referencia -> factura
+        self._exact: dict[str, int] = {}         # ref normalizada -> primera factura
+        self._norm_grams = _GramIndex(3)         # refs normalizadas por posicion
+        self._digits: dict[str, int] = {}        # digitos de la ref -> primera posicion
+        self._digit_grams = _GramIndex(self.MIN_PARTIAL_DIGITS)
+        self._suffixes = _SuffixNode()
+        self._by_nif: dict[str, list[int]] = {}
+        self._by_name: dict[str, list[int]] = {}
+
+        for fi, factura in enumerate(facturas):
+            for ref in factura.numeros_albaran_ref:
+                pos = len(self._ref_factura)
+                self._ref_factura.append(fi)
+                self._add_reference(fi, pos, ref)
+
+            nif = (factura.proveedor_nif or "").strip().upper()
+            if nif:
+                self._by_nif.setdefault(nif, []).append(fi)
+            nombre = (factura.proveedor_nombre or "").strip().lower()
+            if nombre:
+                self._by_name.setdefault(nombre, []).append(fi)
+
+    def _add_reference(self, fi: int, pos: int, ref: str) -> None:
+        norm = _normalize(ref)
+        if norm:
+            self._exact.setdefault(norm, fi)
+            self._norm_grams.add(pos, norm)
+
+        digits = _extract_digits(ref)
+        if not digits:
+            return
+        self._digits.setdefault(digits, pos)
+        if len(digits) >= self.MIN_PARTIAL_DIGITS:
+            self._digit_grams.add(pos, digits)
+
+        node = self._suffixes
+        for ch in reversed(digits):
+            node = node.children.setdefault(ch, _SuffixNode())
+            if node.min_pos is None:
+                node.min_pos = pos
+
+    def find(self, albaran: Document) -> tuple[Document | None, str]:
+        """Factura del albaran y nivel que la encontro ((None, "") si ninguno)."""
+        for method, finder in (
+            ("match exacto", self.find_by_exact_match),
+            ("match numerico", self.find_by_digits_match),
+            ("mismo proveedor", self.find_by_provider),
+        ):
+            match = finder(albaran)
+            if match:
+                return match, method
+        return None, ""
+
+    def find_by_exact_match(self, albaran: Document) -> Document | None:
+        """Factura que referencia este albaran (match exacto normalizado, luego parcial)."""
+        albaran_num = _normalize(albaran.numero_albaran or "")
+        if not albaran_num:
+            return None
+
+        fi = self._exact.get(albaran_num)
+        if fi is not None:
+            return self.facturas[fi]
+
+        # Match parcial: la referencia contiene el nº del albaran o esta contenida en el
+        pos = self._norm_grams.first_containing(albaran_num)
+        candidates = [self._ref_factura[pos]] if pos is not None else []
+        candidates += [self._exact.get(sub) for sub in _substrings(albaran_num, 1)]
+        candidates = [fi for fi in candidates if fi is not None]
+        return self.facturas[min(candidates)] if candidates else None
+
+    def find_by_digits_match(self, albaran: Document) -> Document | None:
+        """Factura comparando solo los digitos del nº de albaran.
+
+        Resuelve el caso donde GPT lee "2770" en la factura pero el albaran
+        real es "27780". Gana el match exacto de digitos; si no, la referencia
+        con mas digitos en comun (contenidos o como sufijo, minimo 4).
+        """
+        alb_digits = _extract_digits(albaran.numero_albaran or "")
+        if len(alb_digits) < self.MIN_DIGITS:
+            return None
+
+        pos = self._digits.get(alb_digits)
+        if pos is not None:
+            return self.facturas[self._ref_factura[pos]]
+
+        # (puntuacion, posicion): mayor puntuacion y, a igualdad, primera referencia
+        candidates: list[tuple[int, int]] = []
+        if len(alb_digits) >= self.MIN_PARTIAL_DIGITS:
+            # El albaran esta contenido en la referencia
+            pos = self._digit_grams.first_containing(alb_digits)
+            if pos is not None:
+                candidates.append((len(alb_digits), pos))
+            # La referencia esta contenida en el albaran
+            for sub in _substrings(alb_digits, self.MIN_PARTIAL_DIGITS):
+                pos = self._digits.get(sub)
+                if pos is not None:
+                    candidates.append((len(sub), pos))
+
+        # Sufijo comun: el nodo mas profundo del camino del albaran en el trie
+        node, depth = self._suffixes, 0
+        for ch in reversed(alb_digits):
+            node = node.children.get(ch)
+            if node is None:
+                break
+            depth += 1
+            if depth >= self.MIN_PARTIAL_DIGITS:
+                candidates.append((depth, node.min_pos))
+
+        if not candidates:
+            return None
+        _, pos = min(candidates, key=lambda c: (-c[0], c[1]))
+        return self.facturas[self._ref_factura[pos]]
+
+    def find_by_provider(self, albaran: Document) -> Document | None:
+        """Fallback: factura del mismo proveedor (por NIF o nombre).
+
+        Si hay multiples facturas del mismo proveedor, asocia con la que tenga
+        fecha mas cercana al albaran. Si no hay fechas, solo asocia si hay 1 factura.
+        """
+        alb_nif = (albaran.proveedor_nif or "").strip().upper()
+        alb_nombre = (albaran.proveedor_nombre or "").strip().lower()
+
+        if not alb_nif and not alb_nombre:
+            return None
+
+        found = set(self._by_nif.get(alb_nif, ())) if alb_nif else set()
+        if alb_nombre:
+            # Pocos proveedores distintos por lote: se recorren los nombres, no las facturas
+            for nombre, indices in self._by_name.items():
+                if alb_nombre == nombre or alb_nombre in nombre or nombre in alb_nombre:
+                    found.update(indices)
+        matches = [self.facturas[fi] for fi in sorted(found)]
+
+        if len(matches) == 1:
+            return matches[0]
+
+        # Si hay varias, intentar por fecha mas cercana
+        if len(matches) > 1 and albaran.fecha_documento:
+            best = None
+            best_diff = None
+            for fac in matches:
+                if fac.fecha_documento:
+                    diff = abs((fac.fecha_documento - albaran.fecha_documento).days)
+                    if best_diff is None or diff < best_diff:
+                        best_diff = diff
+                        best = fac
+            if best and best_diff is not None and best_diff <= 30:
+                return best
+
         return None
 
-    matches = []
-    for factura in facturas:
-        fac_nif = (factura.proveedor_nif or "").strip().upper()
-        fac_nombre = (factura.proveedor_nombre or "").strip().lower()
-
-        if alb_nif and fac_nif and alb_nif == fac_nif:
-            matches.append(factura)
-        elif alb_nombre and fac_nombre and (alb_nombre == fac_nombre or
-              alb_nombre in fac_nombre or fac_nombre in alb_nombre):
-            matches.append(factura)
-
-    if len(matches) == 1:
-        return matches[0]
-
-    # Si hay varias, intentar por fecha mas cercana
-    if len(matches) > 1 and albaran.fecha_documento:
-        best = None
-        best_diff = None
-        for fac in matches:
-            if fac.fecha_documento:
-                diff = abs((fac.fecha_documento - albaran.fecha_documento).days)
-                if best_diff is None or diff < best_diff:
-                    best_diff = diff
-                    best = fac
-        if best and best_diff is not None and best_diff <= 30:
-            return best
-
-    return None
+
+def _substrings(value: str, min_len: int) -> set[str]:
+    """Subcadenas de `value` de longitud >= min_len (incluida ella misma)."""
+    return {
+        value[i:j]
+        for i in range(len(value))
+        for j in range(i + min_len, len(value) + 1)
+    }
@@ -0,0 +1,143 @@
+"""Decodificación local de códigos QR y de barras de las páginas rasterizadas.
+
+- QR VeriFactu (AEAT) y TicketBAI (haciendas forales): la URL lleva NIF del
+  emisor, nº de factura, fecha e importe. Si se decodifica limpio, la página
+  se salta la fase 1; proveedor y albaranes referenciados, que el QR no
+  lleva, se leen después en la cascada.
+- Códigos de barras 1D (Code 128/39/93, 2 de 5): algunos albaranes llevan así
+  su número. No identifican ni proveedor ni tipo, así que solo rellenan el
+  nº de albarán si el modelo lo deja vacío.
+
+Usa pyzbar (requiere la librería del sistema libzbar). Es opcional: sin ella
+no se decodifica nada y el pipeline sigue igual.
+"""
+
+from __future__ import annotations
+import logging
+import re
+from dataclasses import dataclass, field
+from datetime import date
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+try:
+    from pyzbar.pyzbar import ZBarSymbol, decode as zbar_decode
+except ImportError:  # pyzbar no instalado o sin libzbar
+    zbar_decode = None
+
+from .text_layer import find_nif
+
+logger = logging.getLogger(__name__)
+
+# Confianza de una factura resuelta por su QR fiscal
+CODE_CONFIDENCE = 0.95
+
+_ALBARAN_CODE_RE = re.compile(r"^[A-Z0-9][A-Z0-9/\-]{2,14}$")
+_TBAI_ID_RE = re.compile(r"^TBAI-([0-9A-Z]{9})-(\d{2})(\d{2})(\d{2})-")
+
+if zbar_decode is not None:
+    _SYMBOLS = [
+        ZBarSymbol.QRCODE, ZBarSymbol.CODE128, ZBarSymbol.CODE39,
+        ZBarSymbol.CODE93, ZBarSymbol.I25,
+    ]
+
+
+@dataclass
+class PageCodes:
+    """Lo que se ha leído de los códigos de una página."""
+    fiscal: dict | None = None   # QR VeriFactu/TicketBAI, con las claves de la respuesta del modelo
+    albaran: str | None = None   # código de barras con aspecto de nº de albarán
+    raw: list[str] = field(default_factory=list)
+
+
+def codes_available() -> bool:
+    return zbar_decode is not None
+
+
+def read_page_codes(gray: np.ndarray) -> PageCodes | None:
+    """Decodifica los códigos de una página (gris h × w). None si no hay ninguno."""
+    if zbar_decode is None:
+        return None
+
+    pixels = np.ascontiguousarray(gray, dtype=np.uint8)
+    height, width = pixels.shape
+    symbols = zbar_decode((pixels.tobytes(), width, height), symbols=_SYMBOLS)
+    if not symbols:
+        return None
+
+    codes = PageCodes()
+    for symbol in symbols:
+        try:
+            value = symbol.data.decode("utf-8").strip()
+        except UnicodeDecodeError:
+            continue
+        codes.raw.append(value)
+        if symbol.type == "QRCODE":
+            codes.fiscal = codes.fiscal or parse_fiscal_qr(value)
+        elif codes.albaran is None and _ALBARAN_CODE_RE.match(value.upper()) and any(
+            ch.isdigit() for ch in value
+        ):
+            codes.albaran = value.upper()
+
+    if codes.fiscal is None and codes.albaran is None:
+        return None
+    return codes
+
+
+def parse_fiscal_qr(value: str) -> dict | None:
+    """Datos de factura de un QR VeriFactu o TicketBAI. None si no lo es o está incompleto."""
+    url = urlparse(value)
+    if url.scheme not in ("http", "https"):
+        return None
+    params = {key: values[0].strip() for key, values in parse_qs(url.query).items() if values}
+
+    if "agenciatributaria.gob.es" in url.netloc:
+        # VeriFactu: ?nif=...&numserie=...&fecha=dd-mm-aaaa&importe=...
+        nif = params.get("nif", "")
+        numero = params.get("numserie")
+        fecha = _parse_date(params.get("fecha", ""))
+    elif params.get("id", "").startswith("TBAI-"):
+        # TicketBAI: ?id=TBAI-<NIF>-<ddmmaa>-...&s=<serie>&nf=<número>&i=<importe>
+        match = _TBAI_ID_RE.match(params["id"])
+        if not match:
+            return None
+        nif = match.group(1)
+        day, month, year = match.group(2, 3, 4)
+        fecha = _parse_date(f"{day}-{month}-20{year}")
+        numero = params.get("nf")
+        if numero and params.get("s"):
+            numero = f"{params['s']}{numero}"
+    else:
+        return None
+
+    # find_nif valida el formato y descarta los NIFs de FMV
+    nif = find_nif(nif)
+    if not (nif and numero and fecha):
+        return None
+
+    return {
+        "tipo": "factura",
+        "proveedor": None,
+        "proveedor_nif": nif,
+        "numero_factura": numero,
+        "numero_albaran": None,
+        "numeros_albaran_referenciados": [],
+        "numero_pedido": None,
+        "fecha": fecha,
+        "es_continuacion_anterior": False,
+        "confianza": CODE_CONFIDENCE,
+        "importe": params.get("importe") or params.get("i"),
+    }
+
+
+def _parse_date(value: str) -> str | None:
+    """dd-mm-aaaa → ISO. None si no es una fecha válida."""
+    parts = value.split("-")
+    if len(parts) != 3 or not all(p.isdigit() for p in parts):
+        return None
+    day, month, year = (int(p) for p in parts)
+    try:
+        return date(year, month, day).isoformat()
+    except ValueError:
+        return None
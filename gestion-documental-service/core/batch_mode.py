@@ -0,0 +1,461 @@
+"""Modo diferido con la Batch API de OpenAI para el one-shot nocturno.
+
+Dos pasos, en ejecuciones separadas:
+
+1. `submit_batch_job`: renderiza los PDFs pendientes, escribe una línea JSONL
+   por cada página que necesita API y envía el trabajo. El estado (PDFs,
+   páginas resueltas en local, ids de los trabajos) queda en un manifiesto
+   JSON en `processing.batch_dir`.
+2. `poll_batch_jobs`: consulta los trabajos abiertos. Cada fase corresponde a
+   un paso de la cascada de modelos (`openai.cascade`): al terminar una, las
+   páginas que aún necesitan detalle se envían, también por Batch API, al
+   paso siguiente. Cuando termina todo, retoma group → associate → merge →
+   lookup → archive con `resume_batch`.
+
+La Batch API cuesta la mitad y no consume el límite de peticiones en línea, a
+cambio de entregar los resultados en horas. `openai.base_url` permite apuntar
+a un servidor local que implemente /v1/files y /v1/batches.
+"""
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import tempfile
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from uuid import uuid4
+
+from openai import AsyncOpenAI
+
+from .analyzer import (
+    build_high_detail_request,
+    build_page_request,
+    high_detail_from_answer,
+    needs_high_detail,
+    page_result_from_answer,
+    resolve_page_locally,
+)
+from .config import AppConfig
+from .image_store import PREVIEW, PageImageStore
+from .models import Batch
+from .pipeline import (
+    image_options, move_to_errors, move_to_processing, page_validator, resume_batch,
+)
+from .result_cache import result_from_dict, result_to_dict
+from .splitter import render_preview_png, split_pdf_to_images
+from .supplier_lookup import Supplier
+from .text_layer import extract_text_pages
+from .validators import PageValidator
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# Límites de un fichero de entrada de la Batch API (con margen)
+MAX_REQUESTS_PER_FILE = 50_000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+# Las fases siguientes son los pasos 2..n de la cascada
+FASE_PAGINAS = 1
+_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+
+
+def _client(config: AppConfig) -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=config.openai.api_key, base_url=config.openai.base_url)
+
+
+def _custom_id(pdf_index: int, page_number: int, fase: int) -> str:
+    return f"{pdf_index}:{page_number}:{fase}"
+
+
+def _request_line(custom_id: str, body: dict) -> str:
+    return json.dumps(
+        {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+        ensure_ascii=False,
+    ) + "\n"
+
+
+async def submit_batch_job(pdf_paths: list[Path], config: AppConfig) -> Path | None:
+    """Paso 1: prepara y envía las peticiones de fase 1 de todos los PDFs.
+
+    Returns:
+        Ruta del manifiesto del trabajo, o None si no había nada que enviar.
+    """
+    job_dir = Path(config.processing.batch_dir)
+    job_dir.mkdir(parents=True, exist_ok=True)
+    job_id = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid4().hex[:6]
+    manifest_path = job_dir / f"{job_id}.json"
+    requests_path = job_dir / f"{job_id}_fase1.jsonl"
+
+    pdfs: list[dict] = []
+    n_requests = 0
+    with open(requests_path, "w", encoding="utf-8") as out:
+        for pdf_path in pdf_paths:
+            # Las líneas de un PDF solo se escriben si se preparó entero: su
+            # índice en el manifiesto es el que llevan sus custom_id
+            prepared = await _prepare_pdf(Path(pdf_path), config, len(pdfs))
+            if prepared is not None:
+                entry, lines = prepared
+                out.writelines(lines)
+                pdfs.append(entry)
+                n_requests += entry["peticiones"]
+
+    if not pdfs:
+        requests_path.unlink(missing_ok=True)
+        logger.info("Batch API: ningún PDF que enviar")
+        return None
+
+    manifest = {
+        "job_id": job_id,
+        "creado": datetime.now().isoformat(timespec="seconds"),
+        "fase": FASE_PAGINAS,
+        "trabajos": [],
+        "pdfs": pdfs,
+    }
+    if n_requests:
+        manifest["trabajos"] = await _submit_requests(_client(config), requests_path)
+    else:
+        # Todo resuelto en local (blancas / nativas): se termina en el primer poll
+        requests_path.unlink(missing_ok=True)
+
+    _save_manifest(manifest_path, manifest)
+    logger.info(
+        f"Batch API: trabajo {job_id} con {len(pdfs)} PDFs y {n_requests} peticiones "
+        f"({len(manifest['trabajos'])} ficheros)"
+    )
+    return manifest_path
+
+
+async def _prepare_pdf(
+    pdf_path: Path, config: AppConfig, pdf_index: int,
+) -> tuple[dict, list[str]] | None:
+    """Renderiza un PDF y prepara sus peticiones: (entrada del manifiesto, líneas JSONL).
+
+    None si no se puede procesar (el PDF va a errores y no deja ninguna línea).
+    """
+    processing_path = move_to_processing(pdf_path.resolve(), config)
+    batch = Batch(fichero_origen=processing_path.name)
+    text_local_only = config.processing.text_layer_mode == "local"
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="gesdoc_") as temp_dir:
+            store = PageImageStore(batch.id, temp_dir, config.processing.image_store_mb)
+            try:
+                image_paths = await asyncio.to_thread(
+                    split_pdf_to_images,
+                    pdf_path=processing_path,
+                    output_dir=temp_dir,
+                    dpi=config.processing.dpi,
+                    workers=config.processing.split_workers,
+                    store=store,
+                    previews=False,
+                    single_render=config.processing.single_render,
+                    blank_ink_ratio=config.processing.blank_ink_ratio,
+                    image=image_options(config),
+                    codes=config.processing.decode_codes,
+                )
+                if not image_paths:
+                    logger.warning(f"{processing_path.name}: PDF sin páginas — moviendo a errores")
+                    move_to_errors(processing_path, config)
+                    return None
+
+                text_pages: dict[int, str] = {}
+                if config.processing.text_layer_mode != "off":
+                    text_pages = await asyncio.to_thread(
+                        extract_text_pages, processing_path, config.processing.text_min_chars,
+                    )
+
+                resultados: dict[str, dict] = {}
+                textos: dict[str, str] = {}
+                lines: list[str] = []
+                for page_number, image_path in enumerate(image_paths, start=1):
+                    text = text_pages.get(page_number)
+                    local = resolve_page_locally(page_number, None, store, text, text_local_only)
+                    if local is not None:
+                        resultados[str(page_number)] = result_to_dict(local)
+                        continue
+
+                    first = config.openai.cascade[0]
+                    model = first.model
+                    if text is not None:
+                        model = config.openai.text_model or model
+                        textos[str(page_number)] = text
+                    body = await build_page_request(
+                        page_number, image_path, model, store, text, first.detail,
+                    )
+                    lines.append(_request_line(_custom_id(pdf_index, page_number, FASE_PAGINAS), body))
+            finally:
+                store.clear()
+    except Exception as e:
+        logger.error(f"Error preparando {processing_path.name} para Batch API: {e}", exc_info=True)
+        move_to_errors(processing_path, config)
+        return None
+
+    logger.info(
+        f"{processing_path.name}: {len(image_paths)} páginas, {len(lines)} peticiones diferidas"
+    )
+    entry = {
+        "nombre": processing_path.name,
+        "ruta": str(processing_path),
+        "batch_id": batch.id,
+        "total_paginas": len(image_paths),
+        "peticiones": len(lines),
+        "textos": textos,
+        "resultados": resultados,
+        "terminado": False,
+    }
+    return entry, lines
+
+
+async def _submit_requests(client: AsyncOpenAI, requests_path: Path) -> list[str]:
+    """Sube el JSONL (partido si excede los límites) y crea un trabajo por fichero."""
+    job_ids = []
+    for part_path, n_lines in _split_requests(requests_path):
+        with open(part_path, "rb") as f:
+            uploaded = await client.files.create(file=f, purpose="batch")
+        job = await client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+        )
+        job_ids.append(job.id)
+        logger.info(f"Batch API: enviado {job.id} ({n_lines} peticiones)")
+        part_path.unlink(missing_ok=True)
+    requests_path.unlink(missing_ok=True)
+    return job_ids
+
+
+def _split_requests(requests_path: Path) -> list[tuple[Path, int]]:
+    """Parte el JSONL en ficheros que respeten los límites de la Batch API."""
+    parts: list[tuple[Path, int]] = []
+    out = None
+    n_lines = n_bytes = 0
+    with open(requests_path, "rb") as src:
+        for line in src:
+            if out is None or n_lines >= MAX_REQUESTS_PER_FILE or n_bytes + len(line) > MAX_BYTES_PER_FILE:
+                if out is not None:
+                    out.close()
+                    parts.append((part_path, n_lines))
+                part_path = requests_path.with_name(f"{requests_path.stem}_{len(parts) + 1}.jsonl")
+                out = open(part_path, "wb")
+                n_lines = n_bytes = 0
+            out.write(line)
+            n_lines += 1
+            n_bytes += len(line)
+    if out is not None:
+        out.close()
+        parts.append((part_path, n_lines))
+    return parts
+
+
+async def poll_batch_jobs(
+    config: AppConfig,
+    maestro: list[Supplier] | None = None,
+    supabase_sync=None,
+) -> int:
+    """Paso 2: avanza los trabajos abiertos y termina los lotes completos.
+
+    Returns:
+        Número de PDFs archivados en esta llamada.
+    """
+    job_dir = Path(config.processing.batch_dir)
+    manifests = sorted(job_dir.glob("*.json")) if job_dir.exists() else []
+    if not manifests:
+        logger.info("Batch API: no hay trabajos pendientes")
+        return 0
+
+    client = _client(config)
+    completed = 0
+    for manifest_path in manifests:
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            completed += await _advance_job(
+                client, manifest_path, manifest, config, maestro, supabase_sync,
+            )
+        except Exception as e:
+            logger.error(f"Error avanzando trabajo {manifest_path.name}: {e}", exc_info=True)
+    return completed
+
+
+async def _advance_job(
+    client: AsyncOpenAI,
+    manifest_path: Path,
+    manifest: dict,
+    config: AppConfig,
+    maestro: list[Supplier] | None,
+    supabase_sync,
+) -> int:
+    jobs = [await client.batches.retrieve(job_id) for job_id in manifest["trabajos"]]
+    running = [job for job in jobs if job.status not in _TERMINAL]
+    if running:
+        done = sum(job.request_counts.completed for job in jobs if job.request_counts)
+        total = sum(job.request_counts.total for job in jobs if job.request_counts)
+        logger.info(
+            f"Batch API: trabajo {manifest['job_id']} (fase {manifest['fase']}) en curso, "
+            f"{done}/{total} peticiones"
+        )
+        return 0
+
+    answers: dict[str, str | None] = {}
+    for job in jobs:
+        if job.status != "completed":
+            # Lo que no tenga respuesta se trata como llamada fallida
+            logger.warning(f"Batch API: trabajo {job.id} terminó como '{job.status}'")
+        for file_id in (job.output_file_id, job.error_file_id):
+            if file_id:
+                answers.update(await _read_answers(client, file_id))
+
+    fase = manifest["fase"]
+    if fase == FASE_PAGINAS:
+        _apply_page_answers(manifest, answers, config)
+    else:
+        _apply_escalation_answers(manifest, answers, fase, config)
+    _save_manifest(manifest_path, manifest)
+
+    # Subir por la cascada las páginas que aún lo necesiten
+    validator = page_validator(config, maestro)
+    for next_fase in range(fase + 1, len(config.openai.cascade) + 1):
+        if await _submit_escalation(client, manifest_path, manifest, next_fase, config, validator):
+            return 0
+
+    return await _finish_job(manifest_path, manifest, config, maestro, supabase_sync)
+
+
+async def _read_answers(client: AsyncOpenAI, file_id: str) -> dict[str, str | None]:
+    """custom_id → contenido de la respuesta (None si la petición falló)."""
+    content = await client.files.content(file_id)
+    answers: dict[str, str | None] = {}
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        raw = None
+        if response.get("status_code") == 200:
+            try:
+                raw = response["body"]["choices"][0]["message"]["content"] or ""
+            except (KeyError, IndexError, TypeError):
+                raw = None
+        answers[item["custom_id"]] = raw
+    return answers
+
+
+def _apply_page_answers(manifest: dict, answers: dict[str, str | None], config: AppConfig) -> None:
+    for pdf_index, pdf in enumerate(manifest["pdfs"]):
+        for page_number in range(1, pdf["total_paginas"] + 1):
+            if str(page_number) in pdf["resultados"]:
+                continue
+            raw = answers.get(_custom_id(pdf_index, page_number, FASE_PAGINAS))
+            text = pdf["textos"].get(str(page_number))
+            result = page_result_from_answer(raw, page_number, None, text, config.openai.cascade[0].model)
+            pdf["resultados"][str(page_number)] = result_to_dict(result)
+
+
+async def _submit_escalation(
+    client: AsyncOpenAI,
+    manifest_path: Path,
+    manifest: dict,
+    fase: int,
+    config: AppConfig,
+    validator: PageValidator | None = None,
+) -> bool:
+    """Envía al paso `fase` de la cascada las páginas que lo necesitan.
+
+    False si no hace falta ninguna.
+    """
+    step = config.openai.cascade[fase - 1]
+    requests_path = manifest_path.with_name(f"{manifest['job_id']}_fase{fase}.jsonl")
+    n_requests = 0
+    with open(requests_path, "w", encoding="utf-8") as out:
+        for pdf_index, pdf in enumerate(manifest["pdfs"]):
+            pending = [
+                result_from_dict(data) for data in pdf["resultados"].values()
+                if needs_high_detail(result_from_dict(data), validator)
+            ]
+            if not pending:
+                continue
+            with tempfile.TemporaryDirectory(prefix="gesdoc_") as temp_dir:
+                store = PageImageStore(pdf["batch_id"], temp_dir, config.processing.image_store_mb)
+                try:
+                    for result in pending:
+                        result.image_path = store.put_lazy(
+                            result.page_number, PREVIEW,
+                            partial(render_preview_png, pdf["ruta"], result.page_number, config.processing.dpi),
+                        )
+                        body = await build_high_detail_request(
+                            result, step.model, store, step.detail, image_options(config, step.detail),
+                        )
+                        custom_id = _custom_id(pdf_index, result.page_number, fase)
+                        out.write(_request_line(custom_id, body))
+                        n_requests += 1
+                finally:
+                    store.clear()
+
+    if not n_requests:
+        requests_path.unlink(missing_ok=True)
+        return False
+
+    manifest["trabajos"] = await _submit_requests(client, requests_path)
+    manifest["fase"] = fase
+    _save_manifest(manifest_path, manifest)
+    logger.info(
+        f"Batch API: trabajo {manifest['job_id']}, {n_requests} páginas enviadas al paso "
+        f"{fase} ({step.model}/{step.detail})"
+    )
+    return True
+
+
+def _apply_escalation_answers(
+    manifest: dict, answers: dict[str, str | None], fase: int, config: AppConfig,
+) -> None:
+    model = config.openai.cascade[fase - 1].model
+    for pdf_index, pdf in enumerate(manifest["pdfs"]):
+        for key, data in pdf["resultados"].items():
+            custom_id = _custom_id(pdf_index, int(key), fase)
+            if custom_id not in answers:
+                continue
+            result = high_detail_from_answer(result_from_dict(data), answers[custom_id], fase, model)
+            pdf["resultados"][key] = result_to_dict(result)
+
+
+async def _finish_job(
+    manifest_path: Path,
+    manifest: dict,
+    config: AppConfig,
+    maestro: list[Supplier] | None,
+    supabase_sync,
+) -> int:
+    """Retoma el pipeline de cada PDF del trabajo y cierra el manifiesto."""
+    completed = 0
+    for pdf in manifest["pdfs"]:
+        if pdf["terminado"]:
+            continue
+        results = sorted(
+            (result_from_dict(d) for d in pdf["resultados"].values()), key=lambda r: r.page_number,
+        )
+        batch = Batch(
+            id=pdf["batch_id"],
+            fichero_origen=pdf["nombre"],
+            total_paginas=pdf["total_paginas"],
+        )
+        try:
+            await resume_batch(batch, Path(pdf["ruta"]), results, config, maestro, supabase_sync)
+            completed += 1
+        except Exception:
+            # resume_batch ya lo ha registrado y movido a errores
+            pass
+        # Marcar antes de seguir: un fallo posterior no debe reprocesar este PDF
+        pdf["terminado"] = True
+        _save_manifest(manifest_path, manifest)
+
+    manifest_path.rename(manifest_path.with_suffix(".hecho"))
+    logger.info(f"Batch API: trabajo {manifest['job_id']} terminado ({completed} PDFs archivados)")
+    return completed
+
+
+def _save_manifest(manifest_path: Path, manifest: dict) -> None:
+    tmp = manifest_path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    tmp.replace(manifest_path)
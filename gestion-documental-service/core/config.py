@@ -19,6 +19,15 @@ class PathsConfig:
     errores: str = ""
 
 
+@dataclass
+class CascadeStep:
+    """Un paso de la cascada de modelos (ver `ModelRouter` en core.analyzer)."""
+    model: str
+    detail: str = "low"
+    max_concurrent: int = 5
+    timeout: int = 30
+
+
 @dataclass
 class OpenAIConfig:
     model: str = "gpt-4o"
@@ -27,6 +36,24 @@ class OpenAIConfig:
     max_concurrent: int = 10
     timeout: int = 30
     max_retries: int = 3
+    text_model: str | None = None
+    pages_per_request: int = 1
+    classify_first: bool = False  # clasificar antes de extraer (continuaciones sin extracción)
+    rpm_limit: int = 0  # 0 = sin límite
+    tpm_limit: int = 0
+    hedge_budget: float = 0.0  # fracción de llamadas que se pueden duplicar
+    hedge_percentile: float = 0.9
+    base_url: str | None = None  # None = API de OpenAI
+    cascade: list[CascadeStep] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.cascade:
+            # Modelo barato en low → barato en high → fallback_model en high
+            self.cascade = [
+                CascadeStep(self.model, "low", self.max_concurrent, self.timeout),
+                CascadeStep(self.model, "high", 3, self.timeout * 2),
+                CascadeStep(self.fallback_model, "high", 2, self.timeout * 2),
+            ]
 
 
 @dataclass
@@ -36,6 +63,32 @@ class ProcessingConfig:
     dpi: int = 200
     wait_stability_seconds: int = 5
     archive_poll_interval: int = 30
+    split_workers: int = 1
+    streaming: bool = False
+    stream_queue_size: int = 8
+    image_store_mb: int = 256
+    single_render: bool = False
+    render_previews: bool = True
+    blank_ink_ratio: float = 0.003
+    drop_blank_pages: bool = False
+    validate_pages: bool = False  # NIF, fechas, nºs y maestro deciden los reintentos junto con la confianza
+    vision_backend: str = "llm"  # llm | local-first | local (OCR con tesseract)
+    ocr_workers: int = 2
+    ocr_lang: str = "spa"
+    templates_path: str = ""  # plantillas por proveedor, relativa al config.yaml ("" = sin plantillas; requiere OCR local)
+    association_mode: str = "greedy"  # greedy (por niveles) | optimal (asignación óptima, requiere scipy)
+    associations_path: str = ""  # pendientes entre lotes, relativa al config.yaml ("" = solo dentro del lote; al unir modifica PDFs ya archivados)
+    associations_max_days: int = 180
+    downstream_workers: int = 4  # documentos en merge → lookup → archive a la vez
+    archive_retries: int = 3  # reintentos al archivar en el recurso compartido
+    optimize_images: bool = False
+    decode_codes: bool = False  # QR VeriFactu/TicketBAI y códigos de barras (requiere pyzbar)
+    image_mode: str = "color"  # color | gray | binary | auto (binario si es escaneada)
+    text_layer_mode: str = "llm"  # llm | local | off
+    text_min_chars: int = 200
+    cache_path: str = "page_cache.sqlite"  # "" = sin caché
+    cache_max_mb: int = 200
+    batch_dir: str = "batch_jobs"  # trabajos diferidos de la Batch API, relativa al config.yaml
 
 
 @dataclass
@@ -69,6 +122,9 @@ def load_config(config_path: str | Path | None = None) -> AppConfig:
     else:
         config_path = Path(config_path)
 
+    # Los ficheros de estado (cachés, índices) relativos van junto a la configuración
+    base_dir = config_path.resolve().parent
+
     raw: dict = {}
     if config_path.exists():
         with open(config_path, "r", encoding="utf-8") as f:
@@ -94,6 +150,15 @@ def load_config(config_path: str | Path | None = None) -> AppConfig:
             max_concurrent=openai_raw.get("max_concurrent", 10),
             timeout=openai_raw.get("timeout", 30),
             max_retries=openai_raw.get("max_retries", 3),
+            text_model=openai_raw.get("text_model"),
+            pages_per_request=openai_raw.get("pages_per_request", 1),
+            classify_first=openai_raw.get("classify_first", False),
+            rpm_limit=openai_raw.get("rpm_limit", 0),
+            tpm_limit=openai_raw.get("tpm_limit", 0),
+            hedge_budget=openai_raw.get("hedge_budget", 0.0),
+            hedge_percentile=openai_raw.get("hedge_percentile", 0.9),
+            base_url=openai_raw.get("base_url"),
+            cascade=[CascadeStep(**step) for step in openai_raw.get("cascade") or []],
         ),
         processing=ProcessingConfig(
             confidence_threshold=processing_raw.get("confidence_threshold", 0.80),
@@ -101,9 +166,42 @@ def load_config(config_path: str | Path | None = None) -> AppConfig:
             dpi=processing_raw.get("dpi", 200),
             wait_stability_seconds=processing_raw.get("wait_stability_seconds", 5),
             archive_poll_interval=processing_raw.get("archive_poll_interval", 30),
+            split_workers=processing_raw.get("split_workers", 1),
+            streaming=processing_raw.get("streaming", False),
+            stream_queue_size=processing_raw.get("stream_queue_size", 8),
+            image_store_mb=processing_raw.get("image_store_mb", 256),
+            single_render=processing_raw.get("single_render", False),
+            render_previews=processing_raw.get("render_previews", True),
+            blank_ink_ratio=processing_raw.get("blank_ink_ratio", 0.003),
+            drop_blank_pages=processing_raw.get("drop_blank_pages", False),
+            validate_pages=processing_raw.get("validate_pages", False),
+            vision_backend=processing_raw.get("vision_backend", "llm"),
+            ocr_workers=processing_raw.get("ocr_workers", 2),
+            ocr_lang=processing_raw.get("ocr_lang", "spa"),
+            templates_path=_relative_to(base_dir, processing_raw.get("templates_path", "")),
+            association_mode=processing_raw.get("association_mode", "greedy"),
+            associations_path=_relative_to(base_dir, processing_raw.get("associations_path", "")),
+            associations_max_days=processing_raw.get("associations_max_days", 180),
+            downstream_workers=processing_raw.get("downstream_workers", 4),
+            archive_retries=processing_raw.get("archive_retries", 3),
+            optimize_images=processing_raw.get("optimize_images", False),
+            decode_codes=processing_raw.get("decode_codes", False),
+            image_mode=processing_raw.get("image_mode", "color"),
+            text_layer_mode=processing_raw.get("text_layer_mode", "llm"),
+            text_min_chars=processing_raw.get("text_min_chars", 200),
+            cache_path=_relative_to(base_dir, processing_raw.get("cache_path", "page_cache.sqlite")),
+            cache_max_mb=processing_raw.get("cache_max_mb", 200),
+            batch_dir=_relative_to(base_dir, processing_raw.get("batch_dir", "batch_jobs")),
         ),
         supabase=SupabaseConfig(
             url=os.getenv("SUPABASE_URL", ""),
             service_key=os.getenv("SUPABASE_SERVICE_KEY", ""),
         ),
     )
+
+
+def _relative_to(base_dir: Path, path: str) -> str:
+    """Ruta del fichero resuelta contra `base_dir` si es relativa ("" = desactivado)."""
+    if not path or Path(path).is_absolute():
+        return path
+    return str(base_dir / path)
@@ -0,0 +1,154 @@
+"""Etapa final por documento: merge → lookup → archive.
+
+Cada documento recorre sus tres pasos por su cuenta en un pool de hilos
+acotado (`downstream_workers`), en vez de terminar cada paso para todo el
+lote antes de empezar el siguiente. La escritura en el recurso compartido
+(UNC) es lo lento: varios documentos se archivan a la vez.
+
+Los fallos quedan aislados por documento, sin tumbar el lote, y el documento
+y sus albaranes asociados quedan marcados para revisión:
+
+- Fallo en el lookup: el PDF ya está generado y se archiva igualmente, en
+  pendientes de revisión.
+- Fallo en el merge, o en el archivado tras reintentar con espera creciente
+  (`archive_retries`) los cortes de red: queda sin archivar (sus páginas
+  siguen en el original, que va a procesados).
+
+PyMuPDF no es thread-safe: la generación de los PDFs (local y rápida) se
+serializa con un lock; el lookup y el archivado van en paralelo.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+import time
+from collections.abc import Collection
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+from .archiver import archive_document
+from .config import AppConfig
+from .merger import attached_albaranes, merge_document
+from .models import Document, EstadoDocumento
+from .supplier_lookup import Supplier, lookup_supplier
+
+logger = logging.getLogger(__name__)
+
+# Espera antes del primer reintento de archivado (se dobla en cada intento)
+ARCHIVE_BACKOFF = 1.0
+
+
+@dataclass
+class DocumentFailure:
+    """Documento que no completó la etapa final."""
+    doc: Document
+    paso: str   # merge | lookup | archive
+    error: str
+
+
+async def process_documents(
+    documents: list[Document],
+    source_pdf_path: str | Path,
+    output_dir: str | Path,
+    config: AppConfig,
+    maestro: list[Supplier] | None = None,
+    looked_up: Collection[str] = (),
+) -> list[DocumentFailure]:
+    """Merge → lookup → archive de cada documento, en paralelo y con fallos aislados.
+
+    Args:
+        documents: Documentos con las asociaciones ya establecidas.
+        source_pdf_path: PDF original escaneado (en carpeta procesando).
+        output_dir: Directorio para los PDFs intermedios.
+        config: Configuración (rutas, umbral de lookup, hilos y reintentos).
+        maestro: Proveedores para el lookup. Si None, se salta el lookup.
+        looked_up: Ids de los documentos con el lookup ya hecho (agrupados
+                   en línea); el resto se busca aquí.
+
+    Returns:
+        Los documentos que fallaron, con el paso en que fallaron (los de
+        lookup quedan archivados en pendientes de revisión).
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    albaranes = attached_albaranes(documents)
+    year = str(datetime.now().year)
+    pdf_lock = threading.Lock()
+    source = fitz.open(str(source_pdf_path))
+
+    def fail(doc: Document, paso: str, error: Exception) -> DocumentFailure:
+        logger.error(
+            f"  Documento {doc.numero_factura or doc.numero_albaran or doc.id[:8]} "
+            f"(págs {doc.paginas}): fallo en {paso}: {error} — queda para revisión"
+        )
+        # Los albaranes unidos a la factura corren su misma suerte
+        for d in [doc, *albaranes.get(doc.id, [])]:
+            d.estado = EstadoDocumento.REVISAR
+        return DocumentFailure(doc, paso, str(error))
+
+    def run(doc: Document) -> tuple[bool | None, DocumentFailure | None]:
+        paso = "merge"
+        found = None
+        failure = None
+        try:
+            with pdf_lock:
+                merge_document(doc, albaranes, source, output_dir)
+            paso = "lookup"
+            if maestro and doc.id not in looked_up:
+                found = lookup_supplier(doc, maestro, config.processing.supplier_match_threshold)
+        except Exception as e:
+            failure = fail(doc, paso, e)
+            if not doc.pdf_path:
+                return found, failure
+
+        try:
+            # Con un fallo previo va a pendientes de revisión (estado REVISAR)
+            _archive_with_retries(doc, config, year)
+        except Exception as e:
+            failure = fail(doc, "archive", e)
+        return found, failure
+
+    loop = asyncio.get_running_loop()
+    workers = max(1, config.processing.downstream_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="downstream") as pool:
+            outcomes = await asyncio.gather(
+                *(loop.run_in_executor(pool, run, doc) for doc in documents)
+            )
+    finally:
+        source.close()
+
+    failures = [failure for _, failure in outcomes if failure is not None]
+    if maestro and len(looked_up) < len(documents):
+        logger.info(
+            f"Lookup completado: {sum(1 for f, _ in outcomes if f is True)} matches, "
+            f"{sum(1 for f, _ in outcomes if f is False)} sin match"
+        )
+    logger.info(
+        f"Archivado completado: {sum(1 for d in documents if d.ruta_destino)} documentos movidos "
+        f"({workers} hilos{f', {len(failures)} con error' if failures else ''})"
+    )
+    return failures
+
+
+def _archive_with_retries(doc: Document, config: AppConfig, year: str) -> None:
+    """Archiva reintentando los errores de E/S (cortes del recurso compartido)."""
+    retries = max(0, config.processing.archive_retries)
+    for attempt in range(retries + 1):
+        try:
+            archive_document(doc, config, year)
+            return
+        except OSError as e:
+            if attempt == retries:
+                raise
+            wait = ARCHIVE_BACKOFF * 2 ** attempt
+            logger.warning(
+                f"  Archivado de {Path(doc.pdf_path).name} falló ({e}), "
+                f"reintento {attempt + 1}/{retries} en {wait:.0f}s"
+            )
+            time.sleep(wait)
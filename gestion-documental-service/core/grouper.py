@@ -1,4 +1,13 @@
-"""Agrupa páginas en documentos lógicos basándose en el flag es_continuacion_anterior."""
+"""Agrupa páginas en documentos lógicos basándose en el flag es_continuacion_anterior.
+
+Las páginas en blanco se añaden al documento en curso (sin afectar a su
+confianza ni a sus datos) o se descartan con `drop_blank_pages`.
+
+`OnlineGrouper` agrupa en línea: consume las páginas en orden según se
+analizan y entrega cada documento en cuanto empieza el siguiente, sin
+esperar al final del lote. Antes de agrupar cada página corrige su flag de
+continuación con reglas locales (`settle_continuation`).
+"""
 
 from __future__ import annotations
 import logging
@@ -11,6 +20,7 @@ logger = logging.getLogger(__name__)
 def group_pages_into_documents(
     page_results: list[PageResult],
     confidence_threshold: float = 0.80,
+    drop_blank_pages: bool = False,
 ) -> list[Document]:
     """Agrupa páginas consecutivas en documentos lógicos.
 
@@ -20,6 +30,8 @@ def group_pages_into_documents(
     Args:
         page_results: Lista de PageResult ordenada por número de página.
         confidence_threshold: Umbral de confianza mínima para estado OK.
+        drop_blank_pages: Descartar las páginas en blanco en vez de
+                          mantenerlas como continuación.
 
     Returns:
         Lista de Document agrupados.
@@ -27,10 +39,48 @@ def group_pages_into_documents(
     if not page_results:
         return []
 
-    documents: list[Document] = []
-    current_doc: Document | None = None
-
+    grouper = OnlineGrouper(confidence_threshold, drop_blank_pages)
     for page in page_results:
+        grouper.add(page)
+    grouper.finish()
+    return grouper.documents
+
+
+class OnlineGrouper:
+    """Agrupador en línea: páginas en orden → documentos terminados.
+
+    `add` devuelve el documento que cierra la página (el anterior, cuando la
+    página empieza uno nuevo); `finish` cierra el último. Los documentos se
+    entregan ya con su estado (OK / revisar).
+    """
+
+    def __init__(self, confidence_threshold: float = 0.80, drop_blank_pages: bool = False):
+        self.confidence_threshold = confidence_threshold
+        self.drop_blank_pages = drop_blank_pages
+        self.documents: list[Document] = []
+        self._current: Document | None = None
+        self._scored_pages = 0  # páginas con contenido del documento actual (para el promedio)
+        self._prev_content: PageResult | None = None
+
+    def add(self, page: PageResult) -> Document | None:
+        """Añade la siguiente página; devuelve el documento que queda terminado, si alguno."""
+        current_doc = self._current
+
+        if page.es_blanco:
+            if self.drop_blank_pages or current_doc is None:
+                logger.debug(f"  Página {page.page_number} en blanco → descartada")
+            else:
+                current_doc.paginas.append(page.page_number)
+                if page.image_path:
+                    current_doc.page_images.append(page.image_path)
+                logger.debug(f"  Página {page.page_number} en blanco → continuación")
+            return None
+
+        # Las páginas en blanco no cuentan: se compara con la última página con contenido
+        if self._prev_content is not None:
+            settle_continuation(self._prev_content, page)
+        self._prev_content = page
+
         if page.es_continuacion_anterior and current_doc is not None:
             # Añadir página al documento actual
             current_doc.paginas.append(page.page_number)
@@ -38,7 +88,8 @@ def group_pages_into_documents(
                 current_doc.page_images.append(page.image_path)
 
             # Actualizar confianza (promedio)
-            n = len(current_doc.paginas)
+            self._scored_pages += 1
+            n = self._scored_pages
             current_doc.confianza = (
                 current_doc.confianza * (n - 1) + page.confianza
             ) / n
@@ -46,6 +97,11 @@ def group_pages_into_documents(
             # Rellenar campos vacíos con datos de esta página
             if not current_doc.proveedor_nombre and page.proveedor:
                 current_doc.proveedor_nombre = page.proveedor
+            if not current_doc.proveedor_nif and page.proveedor_nif:
+                current_doc.proveedor_nif = page.proveedor_nif
+            for ref in page.numeros_albaran_ref:
+                if ref not in current_doc.numeros_albaran_ref:
+                    current_doc.numeros_albaran_ref.append(ref)
             if not current_doc.numero_factura and page.numero_factura:
                 current_doc.numero_factura = page.numero_factura
             if not current_doc.numero_albaran and page.numero_albaran:
@@ -59,35 +115,56 @@ def group_pages_into_documents(
                 f"  Página {page.page_number} → continuación del documento "
                 f"(ahora {len(current_doc.paginas)} páginas)"
             )
-        else:
-            # Nueva página = nuevo documento
-            if current_doc is not None:
-                documents.append(current_doc)
-
-            current_doc = Document(
-                tipo=page.tipo,
-                proveedor_nombre=page.proveedor,
-                numero_factura=page.numero_factura,
-                numero_albaran=page.numero_albaran,
-                numero_pedido=page.numero_pedido,
-                fecha_documento=page.fecha,
-                paginas=[page.page_number],
-                page_images=[page.image_path] if page.image_path else [],
-                confianza=page.confianza,
-            )
-
-            logger.debug(
-                f"  Página {page.page_number} → nuevo documento: "
-                f"tipo={page.tipo.value}, proveedor={page.proveedor}"
-            )
-
-    # Añadir último documento
-    if current_doc is not None:
-        documents.append(current_doc)
-
-    # Determinar estado según confianza
-    for doc in documents:
-        if doc.confianza < confidence_threshold:
+            return None
+
+        # Nueva página = nuevo documento
+        finished = self._close()
+
+        self._scored_pages = 1
+        self._current = Document(
+            tipo=page.tipo,
+            proveedor_nombre=page.proveedor,
+            proveedor_nif=page.proveedor_nif,
+            numero_factura=page.numero_factura,
+            numero_albaran=page.numero_albaran,
+            numero_pedido=page.numero_pedido,
+            numeros_albaran_ref=list(page.numeros_albaran_ref),
+            fecha_documento=page.fecha,
+            paginas=[page.page_number],
+            page_images=[page.image_path] if page.image_path else [],
+            confianza=page.confianza,
+        )
+
+        logger.debug(
+            f"  Página {page.page_number} → nuevo documento: "
+            f"tipo={page.tipo.value}, proveedor={page.proveedor}"
+        )
+        return finished
+
+    def finish(self) -> Document | None:
+        """Cierra el último documento (fin del lote) y registra el resumen."""
+        finished = self._close()
+
+        documents = self.documents
+        facturas = sum(1 for d in documents if d.tipo == TipoDocumento.FACTURA)
+        albaranes = sum(1 for d in documents if d.tipo == TipoDocumento.ALBARAN)
+        desconocidos = sum(1 for d in documents if d.tipo == TipoDocumento.DESCONOCIDO)
+        revisar = sum(1 for d in documents if d.estado == EstadoDocumento.REVISAR)
+
+        logger.info(
+            f"Agrupación completada: {len(documents)} documentos "
+            f"({facturas} facturas, {albaranes} albaranes, {desconocidos} desconocidos, "
+            f"{revisar} para revisión)"
+        )
+        return finished
+
+    def _close(self) -> Document | None:
+        doc, self._current = self._current, None
+        if doc is None:
+            return None
+
+        # Determinar estado según confianza
+        if doc.confianza < self.confidence_threshold:
             doc.estado = EstadoDocumento.REVISAR
         elif doc.tipo == TipoDocumento.DESCONOCIDO:
             doc.estado = EstadoDocumento.REVISAR
@@ -98,15 +175,44 @@ def group_pages_into_documents(
         else:
             doc.estado = EstadoDocumento.OK
 
-    facturas = sum(1 for d in documents if d.tipo == TipoDocumento.FACTURA)
-    albaranes = sum(1 for d in documents if d.tipo == TipoDocumento.ALBARAN)
-    desconocidos = sum(1 for d in documents if d.tipo == TipoDocumento.DESCONOCIDO)
-    revisar = sum(1 for d in documents if d.estado == EstadoDocumento.REVISAR)
+        self.documents.append(doc)
+        return doc
+
+
+def settle_continuation(prev: PageResult, curr: PageResult) -> None:
+    """Refuerza la detección de continuación de `curr` frente a la página con contenido anterior.
 
-    logger.info(
-        f"Agrupación completada: {len(documents)} documentos "
-        f"({facturas} facturas, {albaranes} albaranes, {desconocidos} desconocidos, "
-        f"{revisar} para revisión)"
-    )
+    Si la página tiene es_continuacion_anterior=True pero tiene datos que la
+    hacen parecer un documento nuevo, se corrige.
 
-    return documents
+    Si la página NO tiene cabecera (sin proveedor, sin nº doc) y la anterior
+    sí tenía, se marca como continuación.
+    """
+    # Caso 1: GPT dice continuación pero tiene su propio nº de documento → NO es continuación
+    if curr.es_continuacion_anterior:
+        has_own_number = (
+            (curr.numero_factura and curr.numero_factura != prev.numero_factura) or
+            (curr.numero_albaran and curr.numero_albaran != prev.numero_albaran)
+        )
+        if has_own_number:
+            curr.es_continuacion_anterior = False
+            logger.debug(
+                f"  Página {curr.page_number}: corregido continuación→nuevo "
+                f"(tiene nº propio: fac={curr.numero_factura}, alb={curr.numero_albaran})"
+            )
+
+    # Caso 2: GPT dice NO continuación pero no tiene datos propios
+    # y el proveedor coincide → probablemente SÍ es continuación
+    if not curr.es_continuacion_anterior and prev.tipo != TipoDocumento.DESCONOCIDO:
+        no_own_data = (
+            not curr.numero_factura and
+            not curr.numero_albaran and
+            not curr.proveedor and
+            curr.tipo == prev.tipo
+        )
+        if no_own_data and curr.confianza < 0.7:
+            curr.es_continuacion_anterior = True
+            logger.debug(
+                f"  Página {curr.page_number}: corregido nuevo→continuación "
+                f"(sin datos propios, baja confianza)"
+            )
@@ -0,0 +1,95 @@
+"""Peticiones "hedged" para recortar la latencia de cola de las llamadas de visión.
+
+Si una llamada tarda más que el percentil configurado (p90 por defecto) de las
+latencias observadas en el lote, se lanza un duplicado y se usa la primera
+respuesta que llegue. Un presupuesto por lote (fracción de las llamadas
+hechas) acota el coste extra.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Latencias recientes que se usan para el percentil
+LATENCY_WINDOW = 100
+# Sin suficientes muestras no se duplica nada
+MIN_SAMPLES = 10
+
+
+class Hedger:
+    """Decide cuándo duplicar una llamada lenta y lleva la cuenta del presupuesto."""
+
+    def __init__(self, percentile: float = 0.9, budget: float = 0.1):
+        self.percentile = percentile
+        self.budget = budget
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def delay(self) -> float | None:
+        """Segundos a esperar antes de duplicar. None = no duplicar aún."""
+        if len(self._latencies) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(self.percentile * len(ordered)))
+        return ordered[index]
+
+    def _can_hedge(self) -> bool:
+        return self.hedges < self.budget * self.calls
+
+    async def run(self, make_call: Callable[[], Awaitable[T]], label: str = "") -> T:
+        """Ejecuta `make_call` y, si se retrasa, una copia en paralelo.
+
+        Devuelve el primer resultado correcto; si ambas fallan, propaga el
+        error de la última en terminar.
+        """
+        self.calls += 1
+        primary = asyncio.ensure_future(make_call())
+        tasks = [primary]
+        try:
+            delay = self.delay()
+            if delay is None:
+                return await primary
+
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._can_hedge():
+                return await primary
+
+            self.hedges += 1
+            logger.info(f"  {label}: sin respuesta en {delay:.1f}s, lanzando petición duplicada")
+            hedge = asyncio.ensure_future(make_call())
+            tasks.append(hedge)
+
+            pending = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def summary(self) -> str:
+        delay = self.delay()
+        p = f"{delay:.1f}s" if delay is not None else "-"
+        return (
+            f"p{int(self.percentile * 100)}={p}, duplicadas={self.hedges}/{self.calls}, "
+            f"ganadas por la copia={self.hedge_wins}"
+        )
@@ -0,0 +1,224 @@
+"""Optimiza las imágenes que se envían al modelo de visión.
+
+El coste de una imagen en detail:high depende de cuántos tiles de 512 px
+ocupa tras el reescalado de la API (encajar en 2048×2048 y dejar el lado
+corto en 768). En detail:low es fijo (85 tokens), pero la API la reduce a
+512×512: enviar más píxeles solo engorda la petición. Pasos:
+
+1. Recorte al contenido: fuera márgenes blancos (con un pequeño margen).
+2. Escala de grises, o binarizado (Otsu) en páginas escaneadas.
+3. Reescalado al tamaño con el que la API la va a procesar, ajustado a
+   frontera de tile cuando quitar una fila/columna de tiles cuesta poca
+   resolución.
+
+Trabaja sobre pixmaps de PyMuPDF (el splitter lo aplica al JPEG de análisis)
+o sobre bytes de imagen (reintentos de la cascada con el PNG de preview).
+"""
+
+from __future__ import annotations
+import math
+from dataclasses import dataclass, replace
+
+import fitz  # PyMuPDF
+import numpy as np
+
+# Modelo de tokens de visión (gpt-4o / gpt-4o-mini)
+TILE_SIZE = 512
+TILE_TOKENS = 170
+BASE_TOKENS = 85
+HIGH_MAX_SIDE = 2048
+HIGH_SHORT_SIDE = 768
+
+# Recorte: gris por debajo del cual un píxel cuenta como contenido
+CONTENT_LEVEL = 200
+# Fracción mínima de píxeles con contenido para que una fila/columna cuente (polvo)
+CONTENT_MIN_RATIO = 0.002
+# Bordes ignorados al buscar contenido (sombras del escáner)
+CROP_MARGIN = 0.02
+# Margen añadido alrededor del contenido
+CROP_PADDING = 0.02
+
+# Reducción máxima aceptada para ahorrarse una fila o columna de tiles
+MIN_TILE_SCALE = 0.85
+
+
+@dataclass
+class ImageOptions:
+    """Cómo optimizar las imágenes (viaja a los procesos del pool)."""
+    detail: str = "low"
+    mode: str = "auto"      # color | gray | binary | auto (binario si es escaneada)
+    crop: bool = True
+
+
+@dataclass
+class ImageStats:
+    """Tamaño y coste estimado de la imagen antes y después de optimizar."""
+    size_before: tuple[int, int]
+    size_after: tuple[int, int]
+    tokens_before: int
+    tokens_after: int
+    bytes_after: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def describe(self, detail: str) -> str:
+        (w0, h0), (w1, h1) = self.size_before, self.size_after
+        return (
+            f"{w0}×{h0} → {w1}×{h1}, {self.tokens_before} → {self.tokens_after} tokens "
+            f"({detail}, -{self.tokens_saved}), {self.bytes_after // 1024} KB"
+        )
+
+
+def vision_tokens(width: int, height: int, detail: str) -> int:
+    """Tokens que cobra la API por una imagen de `width`×`height` px."""
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = _api_size(width, height)
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def _api_size(width: int, height: int) -> tuple[int, int]:
+    """Tamaño al que la API reescala una imagen en detail:high/auto."""
+    scale = min(1.0, HIGH_MAX_SIDE / max(width, height))
+    short = min(width, height) * scale
+    if short > HIGH_SHORT_SIDE:
+        scale *= HIGH_SHORT_SIDE / short
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def tile_fit_size(width: int, height: int, detail: str) -> tuple[int, int]:
+    """Tamaño óptimo a enviar: el que procesará la API, ajustado a tiles si compensa."""
+    if detail == "low":
+        scale = min(1.0, TILE_SIZE / max(width, height))
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    width, height = _api_size(width, height)
+    cols = math.ceil(width / TILE_SIZE)
+    rows = math.ceil(height / TILE_SIZE)
+    tiles, scale = cols * rows, 1.0
+    for c, r in ((cols - 1, rows), (cols, rows - 1), (cols - 1, rows - 1)):
+        if c < 1 or r < 1:
+            continue
+        s = min(c * TILE_SIZE / width, r * TILE_SIZE / height)
+        if s >= MIN_TILE_SCALE and (c * r < tiles or (c * r == tiles and s > scale)):
+            tiles, scale = c * r, s
+    # floor: redondear hacia arriba podría volver a cruzar la frontera del tile
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def optimize_pixmap(
+    pix: fitz.Pixmap,
+    options: ImageOptions,
+    quality: int,
+    scanned: bool = False,
+) -> tuple[bytes, ImageStats]:
+    """Recorta, convierte y reescala un pixmap. Devuelve el JPEG y sus estadísticas.
+
+    Args:
+        pix: Pixmap de la página (RGB o gris, sin alfa).
+        options: Detail de destino, modo de color y recorte.
+        quality: Calidad JPEG.
+        scanned: La página es escaneada (sin capa de texto); en modo "auto"
+                 se binariza.
+    """
+    size_before = (pix.width, pix.height)
+    gray = to_gray(pix)
+
+    if options.crop:
+        x0, y0, x1, y1 = _content_box(gray)
+        if (x0, y0, x1, y1) != (0, 0, pix.width, pix.height):
+            gray = gray[y0:y1, x0:x1]
+            if options.mode == "color" and pix.n >= 3:
+                pix = crop_pixmap(pix, x0, y0, x1, y1)
+
+    if options.mode == "color" and pix.n >= 3:
+        out = pix
+    else:
+        if options.mode == "binary" or (options.mode == "auto" and scanned):
+            gray = _binarize(gray)
+        gray = np.ascontiguousarray(gray, dtype=np.uint8)
+        h, w = gray.shape
+        out = fitz.Pixmap(fitz.csGRAY, w, h, gray.tobytes(), False)
+
+    width, height = tile_fit_size(out.width, out.height, options.detail)
+    if (width, height) != (out.width, out.height):
+        out = fitz.Pixmap(out, width, height)
+
+    data = out.tobytes("jpeg", jpg_quality=quality)
+    stats = ImageStats(
+        size_before=size_before,
+        size_after=(out.width, out.height),
+        tokens_before=vision_tokens(*size_before, options.detail),
+        tokens_after=vision_tokens(out.width, out.height, options.detail),
+        bytes_after=len(data),
+    )
+    return data, stats
+
+
+def optimize_image_bytes(
+    data: bytes, options: ImageOptions, quality: int, detail: str | None = None,
+) -> tuple[bytes, ImageStats]:
+    """Como `optimize_pixmap` pero a partir de una imagen codificada (PNG/JPEG).
+
+    Sin información de capa de texto: en modo "auto" se usa escala de grises.
+    """
+    if detail is not None:
+        options = replace(options, detail=detail)
+    pix = fitz.Pixmap(data)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    return optimize_pixmap(pix, options, quality)
+
+
+def to_gray(pix: fitz.Pixmap) -> np.ndarray:
+    """Vista en escala de grises (h × w, uint8/float) de un pixmap."""
+    samples = np.frombuffer(pix.samples, dtype=np.uint8)
+    arr = samples.reshape(pix.height, pix.width, pix.n)
+    if pix.n >= 3:
+        return arr[..., :3].mean(axis=2)
+    return arr[..., 0]
+
+
+def _content_box(gray: np.ndarray) -> tuple[int, int, int, int]:
+    """Caja (x0, y0, x1, y1) del contenido, con margen. Toda la imagen si no hay."""
+    h, w = gray.shape
+    mh, mw = int(h * CROP_MARGIN), int(w * CROP_MARGIN)
+    inner = gray[mh:h - mh or None, mw:w - mw or None]
+    ink = inner < CONTENT_LEVEL
+
+    rows = np.flatnonzero(ink.mean(axis=1) > CONTENT_MIN_RATIO)
+    cols = np.flatnonzero(ink.mean(axis=0) > CONTENT_MIN_RATIO)
+    if not len(rows) or not len(cols):
+        return 0, 0, w, h
+
+    ph, pw = int(h * CROP_PADDING), int(w * CROP_PADDING)
+    y0 = max(0, mh + int(rows[0]) - ph)
+    y1 = min(h, mh + int(rows[-1]) + 1 + ph)
+    x0 = max(0, mw + int(cols[0]) - pw)
+    x1 = min(w, mw + int(cols[-1]) + 1 + pw)
+    return x0, y0, x1, y1
+
+
+def crop_pixmap(pix: fitz.Pixmap, x0: int, y0: int, x1: int, y1: int) -> fitz.Pixmap:
+    """Copia de la región [x0, x1) × [y0, y1) de un pixmap."""
+    arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    crop = np.ascontiguousarray(arr[y0:y1, x0:x1])
+    return fitz.Pixmap(pix.colorspace, x1 - x0, y1 - y0, crop.tobytes(), bool(pix.alpha))
+
+
+def _binarize(gray: np.ndarray) -> np.ndarray:
+    """Blanco y negro con umbral de Otsu."""
+    levels = np.clip(gray, 0, 255).astype(np.uint8)
+    hist = np.bincount(levels.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    weight_bg = np.cumsum(hist)
+    weight_fg = total - weight_bg
+    mean_cum = np.cumsum(hist * np.arange(256))
+    mean_bg = mean_cum / np.maximum(weight_bg, 1)
+    mean_fg = (mean_cum[-1] - mean_cum) / np.maximum(weight_fg, 1)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    threshold = int(np.argmax(between))
+    return np.where(levels > threshold, 255, 0).astype(np.uint8)
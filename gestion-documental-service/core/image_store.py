@@ -0,0 +1,173 @@
+"""Almacén en memoria de las imágenes de página de un lote.
+
+Sustituye el ciclo escribir PNG/JPEG en el temp dir → releerlo para codificar
+(fase 1, fase 2 y subida de previews). Las imágenes se guardan ya codificadas
+por (batch, página, variante) y solo se escriben a disco cuando se supera el
+presupuesto de memoria.
+
+Cada imagen se identifica también por su ruta "canónica" en el temp dir
+(page_001.png, page_001_api.jpg), que es la que circula en PageResult.image_path.
+Si la imagen se volcó a disco, el fichero existe en esa ruta.
+
+Una imagen puede registrarse como perezosa (`put_lazy`): solo se renderiza la
+primera vez que alguien la lee.
+
+El splitter anota también aquí las páginas que ha detectado en blanco y los
+códigos QR/de barras que ha decodificado.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from .barcodes import PageCodes
+
+logger = logging.getLogger(__name__)
+
+PREVIEW = "preview"
+API = "api"
+
+_SUFFIXES = {
+    PREVIEW: ".png",
+    API: "_api.jpg",
+}
+
+
+class PageImageStore:
+    """Imágenes codificadas de un lote, en memoria hasta `max_memory_mb`.
+
+    Es thread-safe: el splitter escribe desde su hilo/pool mientras el
+    analizador lee desde el event loop.
+    """
+
+    def __init__(self, batch_id: str, spill_dir: str | Path, max_memory_mb: int = 256):
+        self.batch_id = batch_id
+        self.spill_dir = Path(spill_dir)
+        self.max_memory_bytes = max(0, max_memory_mb) * 1024 * 1024
+        self._memory: dict[tuple[str, int, str], bytes] = {}
+        self._on_disk: dict[tuple[str, int, str], Path] = {}
+        self._lazy: dict[tuple[str, int, str], Callable[[], bytes]] = {}
+        self._keys_by_path: dict[str, tuple[str, int, str]] = {}
+        self._memory_bytes = 0
+        self._blank_pages: set[int] = set()
+        self._codes: dict[int, PageCodes] = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, page_number: int, kind: str) -> str:
+        """Ruta canónica de la imagen (exista o no en disco)."""
+        return str(self.spill_dir / f"page_{page_number:03d}{_SUFFIXES[kind]}")
+
+    def put(self, page_number: int, kind: str, data: bytes) -> str:
+        """Guarda una imagen codificada. Devuelve su ruta canónica."""
+        key = (self.batch_id, page_number, kind)
+        path = self.path_for(page_number, kind)
+
+        with self._lock:
+            self._keys_by_path[path] = key
+            fits = self._memory_bytes + len(data) <= self.max_memory_bytes
+            if fits:
+                self._memory[key] = data
+                self._memory_bytes += len(data)
+                return path
+
+        # Por encima del presupuesto: a disco (fuera del lock)
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        Path(path).write_bytes(data)
+        with self._lock:
+            self._on_disk[key] = Path(path)
+        logger.debug(f"  Página {page_number} ({kind}) volcada a disco: presupuesto de memoria agotado")
+        return path
+
+    def put_lazy(self, page_number: int, kind: str, render: Callable[[], bytes]) -> str:
+        """Registra una imagen que se generará con `render()` al leerla por primera vez."""
+        key = (self.batch_id, page_number, kind)
+        path = self.path_for(page_number, kind)
+        with self._lock:
+            self._keys_by_path[path] = key
+            self._lazy[key] = render
+        return path
+
+    def contains(self, path: str) -> bool:
+        """True si la ruta corresponde a una imagen del almacén."""
+        with self._lock:
+            key = self._keys_by_path.get(path)
+            return key is not None and (
+                key in self._memory or key in self._on_disk or key in self._lazy
+            )
+
+    def get(self, page_number: int, kind: str) -> bytes | None:
+        """Devuelve los bytes de una imagen (leyendo de disco si se volcó)."""
+        return self._read_key((self.batch_id, page_number, kind))
+
+    def read(self, path: str) -> bytes:
+        """Devuelve los bytes de la imagen con esa ruta canónica."""
+        with self._lock:
+            key = self._keys_by_path.get(path)
+        data = self._read_key(key) if key else None
+        if data is None:
+            raise FileNotFoundError(f"Imagen no encontrada en el almacén: {path}")
+        return data
+
+    async def aread(self, path: str) -> bytes:
+        """Como `read`, pero sin bloquear el event loop si hay que ir a disco."""
+        with self._lock:
+            key = self._keys_by_path.get(path)
+            data = self._memory.get(key) if key else None
+        if data is not None:
+            return data
+        return await asyncio.to_thread(self.read, path)
+
+    def _read_key(self, key: tuple[str, int, str]) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            disk_path = self._on_disk.get(key)
+            render = self._lazy.get(key)
+        if data is not None:
+            return data
+        if disk_path is not None:
+            return disk_path.read_bytes()
+        if render is not None:
+            data = render()
+            _, page_number, kind = key
+            self.put(page_number, kind, data)
+            with self._lock:
+                self._lazy.pop(key, None)
+            return data
+        return None
+
+    def mark_blank(self, page_number: int) -> None:
+        """Marca una página como en blanco (no requiere análisis)."""
+        with self._lock:
+            self._blank_pages.add(page_number)
+
+    def is_blank(self, page_number: int) -> bool:
+        with self._lock:
+            return page_number in self._blank_pages
+
+    def set_codes(self, page_number: int, codes: PageCodes) -> None:
+        """Anota los códigos decodificados de una página."""
+        with self._lock:
+            self._codes[page_number] = codes
+
+    def codes(self, page_number: int) -> PageCodes | None:
+        with self._lock:
+            return self._codes.get(page_number)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def clear(self) -> None:
+        """Libera la memoria (los ficheros volcados se borran con el temp dir)."""
+        with self._lock:
+            self._memory.clear()
+            self._on_disk.clear()
+            self._lazy.clear()
+            self._keys_by_path.clear()
+            self._blank_pages.clear()
+            self._codes.clear()
+            self._memory_bytes = 0
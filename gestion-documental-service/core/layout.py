@@ -0,0 +1,127 @@
+"""Análisis local de la maquetación de una página escaneada.
+
+Sirve para localizar la tabla de líneas de detalle de una factura (donde
+aparecen los nºs de albarán referenciados) y enviar a la API solo ese
+recorte en alta resolución, en vez de la página entera.
+
+Sin OCR: se trabaja sobre el perfil de tinta por filas del raster.
+1. Filetes horizontales: filas con mucha cobertura de tinta. La tabla es el
+   mayor hueco entre dos filetes, más la fila de cabecera de columnas.
+2. Si no hay filetes (tablas sin líneas): bloques de texto separados por
+   franjas en blanco; la tabla es el bloque con más líneas de texto.
+"""
+
+from __future__ import annotations
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from .image_optimizer import (
+    ImageOptions, ImageStats, crop_pixmap, optimize_pixmap, to_gray, vision_tokens,
+)
+
+# Gris por debajo del cual un píxel cuenta como tinta
+INK_LEVEL = 128
+# Fracción del ancho cubierta de tinta para considerar una fila parte de un filete
+RULE_MIN_COVERAGE = 0.35
+# Filas con algo de tinta (texto); por debajo es franja en blanco
+TEXT_MIN_COVERAGE = 0.005
+# Franja en blanco mínima (fracción de la altura) que separa dos bloques de texto
+BLOCK_GAP = 0.015
+# Altura de la cabecera de columnas que se añade por encima de la tabla
+HEADER_HEIGHT = 0.06
+# Límites de altura de una tabla plausible (fracción de la página)
+MIN_TABLE_HEIGHT = 0.10
+MAX_TABLE_HEIGHT = 0.90
+# Líneas de texto mínimas para que un bloque pase por tabla
+MIN_TABLE_LINES = 4
+# Margen vertical añadido al recorte
+REGION_PADDING = 0.01
+
+
+def find_line_items_box(gray: np.ndarray) -> tuple[int, int, int, int] | None:
+    """Caja (x0, y0, x1, y1) de la tabla de líneas. None si no se encuentra."""
+    h, w = gray.shape
+    coverage = (gray < INK_LEVEL).mean(axis=1)
+
+    span = _span_between_rules(coverage, h) or _largest_text_block(coverage, h)
+    if span is None:
+        return None
+
+    y0, y1 = span
+    pad = int(h * REGION_PADDING)
+    y0, y1 = max(0, y0 - pad), min(h, y1 + pad)
+    if not MIN_TABLE_HEIGHT * h <= y1 - y0 <= MAX_TABLE_HEIGHT * h:
+        return None
+    return 0, y0, w, y1
+
+
+def crop_line_items(
+    data: bytes, options: ImageOptions, quality: int,
+) -> tuple[bytes, ImageStats] | None:
+    """Recorte optimizado (JPEG) de la tabla de líneas de una imagen de página.
+
+    None si no se localiza la tabla: el llamante envía la página entera.
+    """
+    pix = fitz.Pixmap(data)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    box = find_line_items_box(to_gray(pix))
+    if box is None:
+        return None
+    data, stats = optimize_pixmap(crop_pixmap(pix, *box), options, quality)
+    # Comparar con la página entera, que es lo que se enviaba antes
+    stats.size_before = (pix.width, pix.height)
+    stats.tokens_before = vision_tokens(pix.width, pix.height, options.detail)
+    return data, stats
+
+
+def _runs(mask: np.ndarray, max_gap: int = 0) -> list[tuple[int, int]]:
+    """Tramos [inicio, fin) de True, uniendo huecos de hasta `max_gap` filas."""
+    runs: list[tuple[int, int]] = []
+    for index in np.flatnonzero(mask):
+        index = int(index)
+        if runs and index - runs[-1][1] <= max_gap:
+            runs[-1] = (runs[-1][0], index + 1)
+        else:
+            runs.append((index, index + 1))
+    return runs
+
+
+def _span_between_rules(coverage: np.ndarray, height: int) -> tuple[int, int] | None:
+    """Mayor hueco entre filetes horizontales consecutivos, con su cabecera."""
+    rules = _runs(coverage >= RULE_MIN_COVERAGE, max_gap=3)
+    if len(rules) < 2:
+        return None
+
+    gaps = [(rules[i + 1][0] - rules[i][1], i) for i in range(len(rules) - 1)]
+    size, index = max(gaps)
+    if size < MIN_TABLE_HEIGHT * height:
+        # Tabla con filete en cada fila: todo el bloque de filetes
+        return rules[0][0], rules[-1][1]
+
+    top = rules[index][0]
+    # Cabecera de columnas entre dos filetes justo encima del hueco
+    if index > 0 and top - rules[index - 1][0] <= HEADER_HEIGHT * height:
+        top = rules[index - 1][0]
+    return top, rules[index + 1][1]
+
+
+def _largest_text_block(coverage: np.ndarray, height: int) -> tuple[int, int] | None:
+    """Bloque de texto con más líneas, separando bloques por franjas en blanco."""
+    lines = _runs(coverage >= TEXT_MIN_COVERAGE)
+    if not lines:
+        return None
+
+    gap = int(height * BLOCK_GAP)
+    blocks: list[list[tuple[int, int]]] = [[lines[0]]]
+    for line in lines[1:]:
+        if line[0] - blocks[-1][-1][1] > gap:
+            blocks.append([line])
+        else:
+            blocks[-1].append(line)
+
+    best = max(blocks, key=len)
+    if len(best) < MIN_TABLE_LINES:
+        return None
+    return best[0][0], best[-1][1]
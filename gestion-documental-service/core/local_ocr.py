@@ -0,0 +1,115 @@
+"""Motor local de OCR para las páginas escaneadas (sin red).
+
+Alternativa a la visión de OpenAI cuando la API no está disponible o va
+lenta: Tesseract lee el texto de la página y los parsers de `text_layer`
+extraen los campos, igual que en las páginas nativas. El resultado es menos
+fino que el del modelo (no deduce la razón social) pero el rendimiento no
+depende de la red. Ver `vision_backend` en `analyzer.analyze_page_stream`.
+
+El OCR es CPU puro: corre en un pool de procesos propio para no bloquear el
+event loop ni competir con el GIL.
+
+Usa pytesseract (requiere el binario tesseract y el idioma `spa`). Es
+opcional: sin él, el pipeline sigue usando solo la API.
+"""
+
+from __future__ import annotations
+import asyncio
+import io
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+try:
+    import pytesseract
+except ImportError:  # pytesseract no instalado
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+
+# Idioma de Tesseract por defecto
+OCR_LANG = "spa"
+
+
+@dataclass
+class OcrWord:
+    """Palabra leída, con su línea y su caja en fracciones de la imagen (x0, y0, x1, y1)."""
+    text: str
+    line: tuple[int, int, int]
+    box: tuple[float, float, float, float]
+
+
+@dataclass
+class OcrPage:
+    """Texto leído de una página y confianza media del OCR (0-1)."""
+    text: str
+    confidence: float
+    words: list[OcrWord] = field(default_factory=list)
+
+
+def ocr_available() -> bool:
+    """True si pytesseract está instalado y encuentra el binario de tesseract."""
+    if pytesseract is None:
+        return False
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return False
+    return True
+
+
+def ocr_image(data: bytes, lang: str = OCR_LANG) -> OcrPage:
+    """OCR de una imagen codificada (PNG/JPEG). Se ejecuta en el pool de procesos."""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data)).convert("L")
+    width, height = image.size
+    words = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+
+    # Reconstruir las líneas (los parsers buscan cabeceras por línea)
+    lines: dict[tuple[int, int, int], list[str]] = {}
+    confidences: list[float] = []
+    boxes: list[OcrWord] = []
+    for i, word in enumerate(words["text"]):
+        word = word.strip()
+        if not word:
+            continue
+        key = (words["block_num"][i], words["par_num"][i], words["line_num"][i])
+        lines.setdefault(key, []).append(word)
+        left, top = words["left"][i], words["top"][i]
+        boxes.append(OcrWord(word, key, (
+            left / width, top / height,
+            (left + words["width"][i]) / width, (top + words["height"][i]) / height,
+        )))
+        conf = float(words["conf"][i])
+        if conf >= 0:
+            confidences.append(conf)
+
+    text = "\n".join(" ".join(line) for _, line in sorted(lines.items()))
+    confidence = sum(confidences) / len(confidences) / 100 if confidences else 0.0
+    return OcrPage(text=text, confidence=round(confidence, 2), words=boxes)
+
+
+class LocalOcrEngine:
+    """Pool de procesos que hace OCR de páginas.
+
+    `workers` es también el número de páginas en vuelo que admite el
+    analizador (ver `analyze_page_stream`).
+    """
+
+    def __init__(self, workers: int = 2, lang: str = OCR_LANG):
+        self.workers = max(1, workers)
+        self.lang = lang
+        self._pool: ProcessPoolExecutor | None = None
+
+    async def read(self, data: bytes) -> OcrPage:
+        """OCR de una imagen codificada sin bloquear el event loop."""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, ocr_image, data, self.lang)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -37,55 +37,10 @@ def merge_documents(
     output_dir.mkdir(parents=True, exist_ok=True)
 
     source_doc = fitz.open(str(source_pdf_path))
-
-    # Identificar albaranes ya asociados (no generan PDF propio)
-    associated_albaran_ids = {
-        d.factura_asociada_id
-        for d in documents
-        if d.factura_asociada_id
-    }
-    # Invertir: IDs de albaranes que están asociados a alguna factura
-    albaranes_asociados = {
-        d.id for d in documents if d.factura_asociada_id is not None
-    }
+    albaranes = attached_albaranes(documents)
 
     for doc in documents:
-        if doc.id in albaranes_asociados:
-            # Este albarán se incluirá en el PDF de su factura, no genera PDF propio
-            continue
-
-        # Recoger páginas: las del documento + las de sus albaranes asociados
-        pages: list[int] = list(doc.paginas)
-
-        if doc.tipo == TipoDocumento.FACTURA:
-            # Buscar albaranes asociados a esta factura
-            for other in documents:
-                if other.factura_asociada_id == doc.id:
-                    pages.extend(other.paginas)
-                    logger.debug(
-                        f"  Uniendo albarán {other.numero_albaran or '?'} "
-                        f"({len(other.paginas)} págs) a factura {doc.numero_factura or '?'}"
-                    )
-
-        # Generar PDF con las páginas seleccionadas
-        output_pdf = fitz.open()
-        for page_num in pages:
-            # page_num es 1-indexed, PyMuPDF usa 0-indexed
-            if 0 < page_num <= len(source_doc):
-                output_pdf.insert_pdf(source_doc, from_page=page_num - 1, to_page=page_num - 1)
-
-        # Nombre temporal (se renombrará en archiver)
-        temp_name = f"doc_{doc.id[:8]}.pdf"
-        output_path = output_dir / temp_name
-        output_pdf.save(str(output_path))
-        output_pdf.close()
-
-        doc.pdf_path = str(output_path)
-
-        logger.info(
-            f"  PDF generado: {temp_name} ({len(pages)} páginas) — "
-            f"tipo={doc.tipo.value}, proveedor={doc.proveedor_nombre}"
-        )
+        merge_document(doc, albaranes, source_doc, output_dir)
 
     source_doc.close()
 
@@ -94,3 +49,62 @@ def merge_documents(
     logger.info(f"Merge completado: {pdfs_generados} PDFs generados")
 
     return documents
+
+
+def attached_albaranes(documents: list[Document]) -> dict[str, list[Document]]:
+    """Albaranes asociados a cada factura (id de factura → albaranes, en orden)."""
+    albaranes: dict[str, list[Document]] = {}
+    for d in documents:
+        if d.factura_asociada_id is not None:
+            albaranes.setdefault(d.factura_asociada_id, []).append(d)
+    return albaranes
+
+
+def merge_document(
+    doc: Document,
+    albaranes: dict[str, list[Document]],
+    source_doc: fitz.Document,
+    output_dir: Path,
+) -> bool:
+    """Genera el PDF de un documento (factura + sus albaranes asociados).
+
+    Los albaranes asociados no generan PDF propio (van en el de su factura).
+
+    Returns:
+        True si se generó un PDF.
+    """
+    if doc.factura_asociada_id is not None:
+        # Este albarán se incluirá en el PDF de su factura, no genera PDF propio
+        return False
+
+    # Recoger páginas: las del documento + las de sus albaranes asociados
+    pages: list[int] = list(doc.paginas)
+
+    if doc.tipo == TipoDocumento.FACTURA:
+        for other in albaranes.get(doc.id, []):
+            pages.extend(other.paginas)
+            logger.debug(
+                f"  Uniendo albarán {other.numero_albaran or '?'} "
+                f"({len(other.paginas)} págs) a factura {doc.numero_factura or '?'}"
+            )
+
+    # Generar PDF con las páginas seleccionadas
+    output_pdf = fitz.open()
+    for page_num in pages:
+        # page_num es 1-indexed, PyMuPDF usa 0-indexed
+        if 0 < page_num <= len(source_doc):
+            output_pdf.insert_pdf(source_doc, from_page=page_num - 1, to_page=page_num - 1)
+
+    # Nombre temporal (se renombrará en archiver)
+    temp_name = f"doc_{doc.id[:8]}.pdf"
+    output_path = output_dir / temp_name
+    output_pdf.save(str(output_path))
+    output_pdf.close()
+
+    doc.pdf_path = str(output_path)
+
+    logger.info(
+        f"  PDF generado: {temp_name} ({len(pages)} páginas) — "
+        f"tipo={doc.tipo.value}, proveedor={doc.proveedor_nombre}"
+    )
+    return True
@@ -32,13 +32,19 @@ class PageResult:
     page_number: int
     tipo: TipoDocumento
     proveedor: str | None = None
+    proveedor_nif: str | None = None
     numero_factura: str | None = None
     numero_albaran: str | None = None
     numero_pedido: str | None = None
+    numeros_albaran_ref: list[str] = field(default_factory=list)
     fecha: date | None = None
     es_continuacion_anterior: bool = False
     confianza: float = 0.0
     image_path: str | None = None
+    es_blanco: bool = False
+    origen: str | None = None  # etapa que produjo el resultado: vision, texto, blanco...
+    paso_cascada: int | None = None  # paso de la cascada de modelos (1 = primera llamada)
+    modelo: str | None = None
 
 
 @dataclass
@@ -48,9 +54,11 @@ class Document:
     tipo: TipoDocumento = TipoDocumento.DESCONOCIDO
     proveedor_nombre: str | None = None
     proveedor_codigo: str | None = None
+    proveedor_nif: str | None = None
     numero_factura: str | None = None
     numero_albaran: str | None = None
     numero_pedido: str | None = None
+    numeros_albaran_ref: list[str] = field(default_factory=list)
     fecha_documento: date | None = None
     paginas: list[int] = field(default_factory=list)
     page_images: list[str] = field(default_factory=list)
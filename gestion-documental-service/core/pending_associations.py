@@ -0,0 +1,319 @@
+"""Asociación de albaranes y facturas entre lotes distintos.
+
+El asociador solo ve un lote, pero los proveedores suelen mandar los
+albaranes semanas antes que la factura: el albarán se archiva suelto
+(`ALB - xxx.pdf`) y nunca se une. Este índice persistente guarda:
+
+- Albaranes archivados sin factura.
+- Nºs de albarán referenciados por facturas que no se resolvieron en su lote.
+
+Con las mismas claves exactas del asociador (nº normalizado y dígitos, ver
+`associator.reference_keys`), cada lote nuevo consulta el índice con una
+búsqueda indexada por referencia. Un match añade las páginas del albarán al
+PDF ya archivado de la factura (guardado incremental) y borra el PDF suelto:
+no hay que reprocesar ni reanalizar ningún escaneo. Una entrada solo sale del
+índice cuando su PDF se ha unido; si la unión falla, sigue pendiente.
+
+Para no unir documentos de proveedores distintos con nºs cortos que se
+repiten, si ambos lados tienen NIF tiene que coincidir.
+
+Persistencia en SQLite, como la caché de páginas.
+"""
+
+from __future__ import annotations
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+from .associator import reference_keys
+from .models import Document, TipoDocumento
+from .validators import normalize_nif
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS pending_albaranes ("
+    " id TEXT PRIMARY KEY,"
+    " numero TEXT NOT NULL,"
+    " norm TEXT NOT NULL,"
+    " digits TEXT NOT NULL,"
+    " nif TEXT NOT NULL,"
+    " ruta TEXT NOT NULL,"
+    " added REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_pending_albaranes_norm ON pending_albaranes(norm)",
+    "CREATE INDEX IF NOT EXISTS idx_pending_albaranes_digits ON pending_albaranes(digits)",
+    "CREATE TABLE IF NOT EXISTS pending_refs ("
+    " factura_id TEXT NOT NULL,"
+    " ref TEXT NOT NULL,"
+    " norm TEXT NOT NULL,"
+    " digits TEXT NOT NULL,"
+    " nif TEXT NOT NULL,"
+    " numero_factura TEXT,"
+    " ruta TEXT NOT NULL,"
+    " added REAL NOT NULL,"
+    " PRIMARY KEY (factura_id, ref))",
+    "CREATE INDEX IF NOT EXISTS idx_pending_refs_norm ON pending_refs(norm)",
+    "CREATE INDEX IF NOT EXISTS idx_pending_refs_digits ON pending_refs(digits)",
+)
+
+# Misma condición de NIF para las dos tablas: iguales o alguno desconocido
+_NIF_MATCH = "(nif = '' OR ? = '' OR nif = ?)"
+
+
+@dataclass
+class LateLink:
+    """Albarán unido a una factura de otro lote."""
+    albaran_id: str
+    numero_albaran: str
+    factura_id: str
+    numero_factura: str | None
+    ruta: str   # PDF de la factura, que ya incluye el albarán
+
+
+class PendingAssociationStore:
+    """Albaranes sin factura y referencias sin albarán, en un fichero SQLite, thread-safe."""
+
+    def __init__(self, path: str | Path, max_days: int = 180):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._expire()
+
+    def add_albaran(self, albaran: Document) -> None:
+        """Registra un albarán archivado suelto."""
+        norm, digits = reference_keys(albaran.numero_albaran or "")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_albaranes (id, numero, norm, digits, nif, ruta, added) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (albaran.id, albaran.numero_albaran, norm, digits, _nif(albaran),
+                 albaran.ruta_destino, time.time()),
+            )
+            self._conn.commit()
+
+    def add_ref(self, factura: Document, ref: str) -> None:
+        """Registra un nº de albarán referenciado por una factura ya archivada."""
+        norm, digits = reference_keys(ref)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_refs "
+                "(factura_id, ref, norm, digits, nif, numero_factura, ruta, added) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (factura.id, ref, norm, digits, _nif(factura), factura.numero_factura,
+                 factura.ruta_destino, time.time()),
+            )
+            self._conn.commit()
+
+    def find_albaran(self, ref: str, nif: str) -> tuple[str, str, str] | None:
+        """Albarán pendiente con ese nº: (id, numero, ruta) o None.
+
+        Primero por nº normalizado, luego por dígitos; a igualdad, el más
+        antiguo. Las entradas cuyo PDF ya no existe se descartan. La entrada
+        sigue en el índice hasta `remove_albaran`.
+        """
+        def stale(row):
+            self._conn.execute("DELETE FROM pending_albaranes WHERE id = ?", (row[0],))
+
+        return self._find(
+            "SELECT id, numero, ruta FROM pending_albaranes WHERE {key} = ? AND "
+            f"{_NIF_MATCH} ORDER BY added LIMIT 1",
+            ref, nif, stale,
+        )
+
+    def find_ref(self, numero_albaran: str, nif: str) -> tuple[str, str | None, str, str] | None:
+        """Referencia pendiente a ese albarán: (factura_id, numero_factura, ruta, ref) o None."""
+        def stale(row):
+            self._conn.execute(
+                "DELETE FROM pending_refs WHERE factura_id = ? AND ref = ?", (row[0], row[3])
+            )
+
+        return self._find(
+            "SELECT factura_id, numero_factura, ruta, ref FROM pending_refs WHERE {key} = ? AND "
+            f"{_NIF_MATCH} ORDER BY added LIMIT 1",
+            numero_albaran, nif, stale,
+        )
+
+    def remove_albaran(self, albaran_id: str) -> None:
+        """Saca un albarán del índice (ya unido a su factura)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM pending_albaranes WHERE id = ?", (albaran_id,))
+            self._conn.commit()
+
+    def remove_ref(self, factura_id: str, ref: str) -> None:
+        """Saca una referencia del índice (su albarán ya está unido)."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM pending_refs WHERE factura_id = ? AND ref = ?", (factura_id, ref)
+            )
+            self._conn.commit()
+
+    def _find(self, query: str, num: str, nif: str, stale) -> tuple | None:
+        norm, digits = reference_keys(num)
+        with self._lock:
+            try:
+                for column, value in (("norm", norm), ("digits", digits)):
+                    if not value:
+                        continue
+                    while True:
+                        row = self._conn.execute(
+                            query.format(key=column), (value, nif, nif)
+                        ).fetchone()
+                        if row is None:
+                            break
+                        if Path(row[2]).exists():
+                            return row
+                        logger.info(f"  Pendiente {row[1]} descartado: {row[2]} ya no existe")
+                        stale(row)
+            finally:
+                self._conn.commit()
+        return None
+
+    def _expire(self) -> None:
+        """Olvida las entradas con más de `max_days` días."""
+        if self.max_days <= 0:
+            return
+        cutoff = time.time() - self.max_days * 86400
+        with self._lock:
+            albaranes = self._conn.execute("DELETE FROM pending_albaranes WHERE added < ?", (cutoff,)).rowcount
+            refs = self._conn.execute("DELETE FROM pending_refs WHERE added < ?", (cutoff,)).rowcount
+            self._conn.commit()
+        if albaranes or refs:
+            logger.info(f"Asociaciones pendientes caducadas: {albaranes} albaranes, {refs} referencias")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def link_across_batches(documents: list[Document], store: PendingAssociationStore) -> list[LateLink]:
+    """Une los documentos archivados de este lote con los pendientes de lotes anteriores.
+
+    - Facturas: cada referencia no resuelta en el lote busca un albarán
+      pendiente; si no lo hay, queda pendiente.
+    - Albaranes sueltos: buscan una referencia pendiente; si no la hay,
+      quedan pendientes.
+
+    Los albaranes de este lote unidos a una factura anterior quedan
+    actualizados (`factura_asociada_id`, ruta del PDF de la factura).
+
+    Returns:
+        Albaranes de lotes anteriores unidos a facturas de este lote (sus
+        registros en Supabase hay que actualizarlos aparte).
+    """
+    late: list[LateLink] = []
+    albaranes_lote = 0
+
+    # Claves de los albaranes ya unidos en el lote, por factura
+    resolved: dict[str, set[str]] = {}
+    for d in documents:
+        if d.factura_asociada_id and d.numero_albaran:
+            resolved.setdefault(d.factura_asociada_id, set()).update(
+                k for k in reference_keys(d.numero_albaran) if k
+            )
+
+    for factura in documents:
+        if factura.tipo != TipoDocumento.FACTURA or not factura.ruta_destino:
+            continue
+        for ref in factura.numeros_albaran_ref:
+            keys = [k for k in reference_keys(ref) if k]
+            if not keys or resolved.get(factura.id, set()).intersection(keys):
+                continue
+            found = store.find_albaran(ref, _nif(factura))
+            if found is None:
+                store.add_ref(factura, ref)
+                continue
+            albaran_id, numero, ruta = found
+            try:
+                append_pdf(factura.ruta_destino, ruta)
+            except Exception as e:
+                # El albarán sigue pendiente y suelto: nada se ha perdido
+                logger.error(
+                    f"  Albaran {numero} (lote anterior) -> Factura {factura.numero_factura or '?'}: "
+                    f"no se pudo unir el PDF: {e}"
+                )
+                continue
+            store.remove_albaran(albaran_id)
+            late.append(LateLink(albaran_id, numero, factura.id, factura.numero_factura, factura.ruta_destino))
+            logger.info(
+                f"  Albaran {numero} (lote anterior) -> Factura {factura.numero_factura or '?'}"
+            )
+
+    for albaran in documents:
+        if (
+            albaran.tipo != TipoDocumento.ALBARAN
+            or albaran.factura_asociada_id
+            or not albaran.numero_albaran
+            or not albaran.ruta_destino
+        ):
+            continue
+        found = store.find_ref(albaran.numero_albaran, _nif(albaran))
+        if found is None:
+            store.add_albaran(albaran)
+            continue
+        factura_id, numero_factura, ruta, ref = found
+        try:
+            append_pdf(ruta, albaran.ruta_destino)
+        except Exception as e:
+            logger.error(
+                f"  Albaran {albaran.numero_albaran} -> Factura {numero_factura or '?'} (lote anterior): "
+                f"no se pudo unir el PDF: {e}"
+            )
+            # Archivado suelto: queda pendiente como cualquier albarán sin factura
+            store.add_albaran(albaran)
+            continue
+        store.remove_ref(factura_id, ref)
+        albaran.factura_asociada_id = factura_id
+        albaran.ruta_destino = ruta
+        albaran.fichero_nombre = Path(ruta).name
+        albaranes_lote += 1
+        logger.info(
+            f"  Albaran {albaran.numero_albaran} -> Factura {numero_factura or '?'} (lote anterior)"
+        )
+
+    if late or albaranes_lote:
+        logger.info(
+            f"Asociacion entre lotes: {len(late)} albaranes anteriores unidos a facturas del lote, "
+            f"{albaranes_lote} albaranes del lote unidos a facturas anteriores"
+        )
+    return late
+
+
+def append_pdf(target: str | Path, source: str | Path) -> None:
+    """Añade las páginas de `source` al final de `target` y borra `source`.
+
+    Si falla, `source` sigue en su sitio.
+
+    Guardado incremental si el PDF lo admite (solo se escriben las páginas
+    nuevas); si no, se reescribe vía fichero temporal.
+    """
+    target, source = Path(target), Path(source)
+    tmp = None
+    with fitz.open(str(target)) as doc, fitz.open(str(source)) as extra:
+        doc.insert_pdf(extra)
+        if doc.can_save_incrementally():
+            doc.saveIncr()
+        else:
+            tmp = target.with_name(f".{target.name}.tmp")
+            doc.save(str(tmp), garbage=1)
+    if tmp is not None:
+        os.replace(tmp, target)
+    try:
+        source.unlink()
+    except OSError as e:
+        # Las páginas ya están en `target`: la unión cuenta como hecha
+        logger.warning(f"  No se pudo borrar {source.name} tras unirlo a {target.name}: {e}")
+
+
+def _nif(doc: Document) -> str:
+    return normalize_nif(doc.proveedor_nif) if doc.proveedor_nif else ""
@@ -5,17 +5,27 @@ import asyncio
 import logging
 import shutil
 import tempfile
+from functools import partial
 from pathlib import Path
 
 from .config import AppConfig
-from .models import Batch, Document, EstadoBatch, EstadoDocumento, TipoDocumento
-from .splitter import split_pdf_to_images
-from .analyzer import analyze_pages
-from .grouper import group_pages_into_documents
+from .models import Batch, Document, EstadoBatch, PageResult
+from .image_optimizer import ImageOptions
+from .image_store import PREVIEW, PageImageStore
+from .local_ocr import LocalOcrEngine, ocr_available
+from .result_cache import PageResultCache
+from .splitter import render_preview_png, split_pdf_to_images, stream_pdf_pages
+from .analyzer import BACKEND_LLM, analyze_pages, analyze_page_stream
+from .text_layer import extract_text_pages
+from .validators import PageValidator
+from .grouper import OnlineGrouper, group_pages_into_documents
 from .associator import associate_delivery_notes
-from .merger import merge_documents
-from .supplier_lookup import lookup_suppliers, Supplier
-from .archiver import archive_documents, move_original_to_processed
+from .assignment import assign_delivery_notes
+from .supplier_lookup import lookup_supplier, Supplier
+from .supplier_templates import TemplateStore, learn_templates
+from .pending_associations import PendingAssociationStore, link_across_batches
+from .archiver import move_original_to_processed
+from .downstream import process_documents
 
 logger = logging.getLogger(__name__)
 
@@ -43,116 +53,414 @@ async def process_pdf(
     batch = Batch(fichero_origen=pdf_path.name)
 
     # 1. Mover PDF a carpeta 'procesando' para evitar reprocesamiento
-    procesando_dir = Path(config.paths.procesando).resolve()
-    procesando_dir.mkdir(parents=True, exist_ok=True)
-    processing_path = procesando_dir / pdf_path.name
-
-    if pdf_path != processing_path:
-        shutil.move(str(pdf_path), str(processing_path))
-        logger.info(f"Movido a procesando: {processing_path}")
+    processing_path = move_to_processing(pdf_path, config)
 
     # Directorio temporal para imágenes y PDFs intermedios
     with tempfile.TemporaryDirectory(prefix="gesdoc_") as temp_dir:
+        # Imágenes de página en memoria (se vuelcan al temp dir solo si no caben)
+        store = PageImageStore(batch.id, temp_dir, config.processing.image_store_mb)
+        cache = ocr = templates = None
         try:
-            # 2. Split PDF en imágenes
-            image_paths = split_pdf_to_images(
-                pdf_path=processing_path,
-                output_dir=temp_dir,
-                dpi=config.processing.dpi,
+            # Caché persistente de resultados por página (reprocesar no repite llamadas)
+            if config.processing.cache_path:
+                cache = PageResultCache(config.processing.cache_path, config.processing.cache_max_mb)
+            # OCR local (motor de visión local y plantillas de proveedor)
+            backend, ocr, templates = local_engines(config)
+
+            # 2-3. Split PDF en imágenes + análisis de cada página con GPT-4o mini
+            image_paths, page_results, documents, looked_up = await _split_and_analyze(
+                processing_path, temp_dir, config, store, cache, supabase_sync, maestro,
+                backend, ocr, templates,
             )
             batch.total_paginas = len(image_paths)
 
             if not image_paths:
                 logger.warning("PDF sin páginas — moviendo a errores")
-                _move_to_errors(processing_path, config)
+                move_to_errors(processing_path, config)
                 batch.estado = EstadoBatch.ARCHIVADO
                 return batch
 
-            # 3. Analizar cada página con GPT-4o mini
-            page_results = await analyze_pages(
-                image_paths=image_paths,
-                api_key=config.openai.api_key,
-                model=config.openai.model,
-                max_concurrent=config.openai.max_concurrent,
-                timeout=config.openai.timeout,
-                max_retries=config.openai.max_retries,
+            await _finish_batch(
+                batch, processing_path, image_paths, page_results, temp_dir, store,
+                config, maestro, supabase_sync, ocr, templates, documents, looked_up,
             )
 
-            # 4. Agrupar páginas en documentos
-            documents = group_pages_into_documents(
-                page_results=page_results,
-                confidence_threshold=config.processing.confidence_threshold,
-            )
+        except Exception as e:
+            _fail_batch(batch, processing_path, config, supabase_sync, e)
+            raise
+
+        finally:
+            store.clear()
+            if cache is not None:
+                logger.info(f"Caché de páginas: {cache.hits} aciertos, {cache.misses} fallos")
+                cache.close()
+            if ocr is not None:
+                ocr.close()
+            if templates is not None:
+                templates.close()
+
+    return batch
 
-            # 5. Asociar albaranes con facturas
-            documents = associate_delivery_notes(documents)
 
-            # 6. Generar PDFs unificados (factura + albaranes)
-            merge_output_dir = Path(temp_dir) / "merged"
-            documents = merge_documents(
-                documents=documents,
-                source_pdf_path=processing_path,
-                output_dir=merge_output_dir,
+async def resume_batch(
+    batch: Batch,
+    processing_path: Path,
+    page_results: list[PageResult],
+    config: AppConfig,
+    maestro: list[Supplier] | None = None,
+    supabase_sync=None,
+) -> Batch:
+    """Termina un lote cuyas páginas ya se analizaron fuera de `process_pdf`.
+
+    Lo usa el modo Batch API: las páginas se analizaron de forma diferida y
+    aquí se retoma group → associate → merge → lookup → archive. Las previews
+    se renderizan bajo demanda desde el PDF en 'procesando'.
+    """
+    logger.info(f"=== Retomando lote: {processing_path.name} ===")
+    dpi = config.processing.dpi
+
+    with tempfile.TemporaryDirectory(prefix="gesdoc_") as temp_dir:
+        store = PageImageStore(batch.id, temp_dir, config.processing.image_store_mb)
+        try:
+            image_paths = [
+                store.put_lazy(n, PREVIEW, partial(render_preview_png, str(processing_path), n, dpi))
+                for n in range(1, batch.total_paginas + 1)
+            ]
+            for r in page_results:
+                r.image_path = image_paths[r.page_number - 1]
+
+            await _finish_batch(
+                batch, processing_path, image_paths, page_results, temp_dir, store,
+                config, maestro, supabase_sync,
             )
+        except Exception as e:
+            _fail_batch(batch, processing_path, config, supabase_sync, e)
+            raise
+        finally:
+            store.clear()
 
-            # 7. Lookup de proveedores (fuzzy match contra maestro)
-            if maestro:
-                documents = lookup_suppliers(
-                    documents=documents,
-                    maestro=maestro,
-                    match_threshold=config.processing.supplier_match_threshold,
-                )
+    return batch
 
-            # 8. Archivar: renombrar y mover a carpeta destino
-            documents = archive_documents(documents, config)
 
-            # 9. Mover original a procesados (backup)
-            move_original_to_processed(processing_path, config)
+async def _finish_batch(
+    batch: Batch,
+    processing_path: Path,
+    image_paths: list[str],
+    page_results: list[PageResult],
+    temp_dir: str,
+    store: PageImageStore,
+    config: AppConfig,
+    maestro: list[Supplier] | None,
+    supabase_sync,
+    ocr: LocalOcrEngine | None = None,
+    templates: TemplateStore | None = None,
+    documents: list[Document] | None = None,
+    looked_up: set[str] | None = None,
+) -> None:
+    """Pasos 4-10: group → associate → merge → lookup → archive → Supabase.
 
-            # Finalizar batch
-            batch.documents = documents
-            batch.total_documentos = len(documents)
-            batch.estado = EstadoBatch.PENDIENTE_REVISION
+    Merge, lookup y archivado van por documento en un pool de hilos
+    (`core.downstream`): un documento que falla queda para revisión sin
+    tumbar el lote.
 
-            # 9b. Subir previews a Supabase Storage (antes de borrar temp dir)
-            if supabase_sync:
-                try:
-                    preview_urls = supabase_sync.upload_previews(batch.id, image_paths)
-                    logger.info(f"Subidas {len(preview_urls)} previews a Supabase Storage")
-                except Exception as e:
-                    logger.error(f"Error subiendo previews: {e}")
+    Si se pasan `documents` (agrupados en línea durante el análisis), se
+    salta el paso 4, y el lookup de los que ya lo tienen hecho (`looked_up`).
+    """
+    grouped_online = documents is not None
+    # 4. Agrupar páginas en documentos
+    if not grouped_online:
+        documents = group_pages_into_documents(
+            page_results=page_results,
+            confidence_threshold=config.processing.confidence_threshold,
+            drop_blank_pages=config.processing.drop_blank_pages,
+        )
+
+    # 5. Asociar albaranes con facturas
+    if config.processing.association_mode == "optimal":
+        documents = assign_delivery_notes(documents)
+    else:
+        documents = associate_delivery_notes(documents)
+
+    # 6-8. Por documento: PDF unificado (factura + albaranes) → lookup de
+    # proveedor (fuzzy match contra maestro) → renombrar y mover a carpeta destino
+    failures = await process_documents(
+        documents=documents,
+        source_pdf_path=processing_path,
+        output_dir=Path(temp_dir) / "merged",
+        config=config,
+        maestro=maestro,
+        looked_up=looked_up or (),
+    )
+
+    # 7b. Aprender plantillas de maquetación de los documentos confirmados
+    if templates is not None and ocr is not None:
+        await learn_templates(documents, templates, ocr, store, config.processing.confidence_threshold)
+
+    # 8b. Unir con albaranes/facturas pendientes de lotes anteriores
+    late_links = []
+    if config.processing.associations_path:
+        pending = PendingAssociationStore(
+            config.processing.associations_path, config.processing.associations_max_days,
+        )
+        try:
+            late_links = link_across_batches(documents, pending)
+        except Exception as e:
+            logger.error(f"Error asociando con lotes anteriores: {e}", exc_info=True)
+        finally:
+            pending.close()
+
+    # 9. Mover original a procesados (backup)
+    move_original_to_processed(processing_path, config)
+
+    # Finalizar batch
+    batch.documents = documents
+    batch.total_documentos = len(documents)
+    batch.estado = EstadoBatch.PENDIENTE_REVISION
+
+    # 9b. Subir previews a Supabase Storage (antes de borrar temp dir)
+    if supabase_sync:
+        try:
+            preview_urls = await asyncio.to_thread(
+                supabase_sync.upload_previews, batch.id, image_paths, store,
+            )
+            logger.info(f"Subidas {len(preview_urls)} previews a Supabase Storage")
+        except Exception as e:
+            logger.error(f"Error subiendo previews: {e}")
 
-            # 10. Persistir en Supabase
-            if supabase_sync:
+    # 10. Persistir en Supabase
+    if supabase_sync:
+        try:
+            supabase_sync.save_batch(batch)
+            for link in late_links:
                 try:
-                    supabase_sync.save_batch(batch)
-                    supabase_sync.log(batch.id, "info",
-                        f"Procesado: {batch.total_documentos} docs de {batch.total_paginas} pags")
+                    supabase_sync.link_albaran(link.albaran_id, link.factura_id, link.ruta)
                 except Exception as e:
-                    logger.error(f"Error guardando en Supabase: {e}")
+                    # El PDF ya está unido: solo falta el registro
+                    logger.error(
+                        f"Error asociando en Supabase el albarán {link.numero_albaran} "
+                        f"({link.albaran_id}) a la factura {link.factura_id} ({link.ruta}): {e}"
+                    )
+            supabase_sync.log(batch.id, "info",
+                f"Procesado: {batch.total_documentos} docs de {batch.total_paginas} pags")
+            for failure in failures:
+                destino = "a revisión" if failure.doc.ruta_destino else "sin archivar"
+                supabase_sync.log(batch.id, "error",
+                    f"Documento págs {failure.doc.paginas} {destino} ({failure.paso}): {failure.error}")
+        except Exception as e:
+            logger.error(f"Error guardando en Supabase: {e}")
+
+    logger.info(
+        f"=== Lote completado: {batch.total_documentos} documentos "
+        f"de {batch.total_paginas} páginas ==="
+    )
+
+
+def _fail_batch(batch: Batch, processing_path: Path, config: AppConfig, supabase_sync, error: Exception) -> None:
+    """Deja constancia de un lote fallido y mueve el PDF a errores."""
+    logger.error(f"Error procesando {processing_path.name}: {error}", exc_info=True)
+    move_to_errors(processing_path, config)
+    batch.estado = EstadoBatch.ARCHIVADO
+
+    if supabase_sync:
+        try:
+            supabase_sync.log(batch.id, "error", str(error))
+        except Exception:
+            pass
+
+
+async def _split_and_analyze(
+    processing_path: Path,
+    temp_dir: str,
+    config: AppConfig,
+    store: PageImageStore,
+    cache: PageResultCache | None = None,
+    supabase_sync=None,
+    maestro: list[Supplier] | None = None,
+    backend: str = BACKEND_LLM,
+    ocr: LocalOcrEngine | None = None,
+    templates: TemplateStore | None = None,
+) -> tuple[list[str], list[PageResult], list[Document] | None, set[str]]:
+    """Split + análisis. En modo streaming ambas etapas se solapan.
+
+    En modo streaming las páginas se agrupan en línea según quedan
+    definitivas, y el lookup de proveedor de cada documento empieza en cuanto
+    el documento está terminado (solo el último espera al final del lote).
+
+    Returns:
+        (rutas PNG de preview ordenadas por página, resultados por página,
+        documentos ya agrupados o None si no es streaming, ids de los
+        documentos con el lookup hecho)
+    """
+    # El PNG de preview solo se usa para Supabase; sin él se genera bajo demanda
+    previews = config.processing.render_previews and supabase_sync is not None
+
+    # Vía rápida: páginas con capa de texto (PDF nativo) se analizan sin imagen
+    text_pages: dict[int, str] = {}
+    if config.processing.text_layer_mode != "off":
+        text_pages = await asyncio.to_thread(
+            extract_text_pages, processing_path, config.processing.text_min_chars,
+        )
+    analysis_options = dict(
+        pages_per_request=config.openai.pages_per_request,
+        classify_first=config.openai.classify_first,
+        rpm_limit=config.openai.rpm_limit,
+        tpm_limit=config.openai.tpm_limit,
+        hedge_budget=config.openai.hedge_budget,
+        hedge_percentile=config.openai.hedge_percentile,
+        base_url=config.openai.base_url,
+        cascade=config.openai.cascade,
+        image=image_options(config),
+        validator=page_validator(config, maestro),
+        text_pages=text_pages,
+        text_model=config.openai.text_model,
+        text_local_only=config.processing.text_layer_mode == "local",
+        vision_backend=backend,
+        ocr=ocr,
+        templates=templates,
+    )
+
+    if config.processing.streaming:
+        grouper = OnlineGrouper(
+            config.processing.confidence_threshold, config.processing.drop_blank_pages,
+        )
+        lookups: list[asyncio.Task] = []
+        looked_up: set[str] = set()
+
+        def lookup(doc: Document) -> bool | None:
+            try:
+                found = lookup_supplier(doc, maestro, config.processing.supplier_match_threshold)
+            except Exception as e:
+                # Se reintenta en la etapa final, que lo deja para revisión si vuelve a fallar
+                logger.warning(
+                    f"  Lookup de proveedor del documento (págs {doc.paginas}) falló: {e} "
+                    f"— se reintenta al archivar"
+                )
+                return None
+            looked_up.add(doc.id)
+            return found
+
+        def on_document(doc: Document | None) -> None:
+            if doc is not None and maestro:
+                lookups.append(asyncio.create_task(asyncio.to_thread(lookup, doc)))
 
+        page_results = await analyze_page_stream(
+            pages=stream_pdf_pages(
+                pdf_path=processing_path,
+                output_dir=temp_dir,
+                dpi=config.processing.dpi,
+                workers=config.processing.split_workers,
+                queue_size=config.processing.stream_queue_size,
+                store=store,
+                previews=previews,
+                single_render=config.processing.single_render,
+                blank_ink_ratio=config.processing.blank_ink_ratio,
+                image=image_options(config),
+                codes=config.processing.decode_codes,
+            ),
+            api_key=config.openai.api_key,
+            model=config.openai.model,
+            max_concurrent=config.openai.max_concurrent,
+            timeout=config.openai.timeout,
+            max_retries=config.openai.max_retries,
+            store=store,
+            cache=cache,
+            on_page=lambda page: on_document(grouper.add(page)),
+            **analysis_options,
+        )
+        on_document(grouper.finish())
+        found = await asyncio.gather(*lookups)
+        if maestro:
             logger.info(
-                f"=== Lote completado: {batch.total_documentos} documentos "
-                f"de {batch.total_paginas} páginas ==="
+                f"Lookup completado: {sum(1 for f in found if f is True)} matches, "
+                f"{sum(1 for f in found if f is False)} sin match"
             )
+        image_paths = [r.image_path for r in page_results if r.image_path]
+        return image_paths, page_results, grouper.documents, looked_up
 
-        except Exception as e:
-            logger.error(f"Error procesando {pdf_path.name}: {e}", exc_info=True)
-            _move_to_errors(processing_path, config)
-            batch.estado = EstadoBatch.ARCHIVADO
+    image_paths = await asyncio.to_thread(
+        split_pdf_to_images,
+        pdf_path=processing_path,
+        output_dir=temp_dir,
+        dpi=config.processing.dpi,
+        workers=config.processing.split_workers,
+        store=store,
+        previews=previews,
+        single_render=config.processing.single_render,
+        blank_ink_ratio=config.processing.blank_ink_ratio,
+        image=image_options(config),
+        codes=config.processing.decode_codes,
+    )
+    if not image_paths:
+        return [], [], None, set()
 
-            if supabase_sync:
-                try:
-                    supabase_sync.log(batch.id, "error", str(e))
-                except Exception:
-                    pass
+    page_results = await analyze_pages(
+        image_paths=image_paths,
+        api_key=config.openai.api_key,
+        model=config.openai.model,
+        max_concurrent=config.openai.max_concurrent,
+        timeout=config.openai.timeout,
+        max_retries=config.openai.max_retries,
+        store=store,
+        cache=cache,
+        **analysis_options,
+    )
+    return image_paths, page_results, None, set()
 
-            raise
 
-    return batch
+def image_options(config: AppConfig, detail: str | None = None) -> ImageOptions | None:
+    """Optimización de imágenes configurada, para `detail` (por defecto el del paso 1)."""
+    if not config.processing.optimize_images:
+        return None
+    return ImageOptions(
+        detail=detail or config.openai.cascade[0].detail,
+        mode=config.processing.image_mode,
+    )
+
+
+def local_engines(config: AppConfig) -> tuple[str, LocalOcrEngine | None, TemplateStore | None]:
+    """Motor de las páginas escaneadas, OCR local y plantillas de proveedor.
+
+    Sin tesseract: solo la API de visión y sin plantillas.
+    """
+    backend = config.processing.vision_backend
+    templates_path = config.processing.templates_path
+    if backend == BACKEND_LLM and not templates_path:
+        return backend, None, None
+    if not ocr_available():
+        logger.warning(
+            f"OCR local no disponible (pytesseract/tesseract) — se usa solo la API de visión"
+            f"{', sin plantillas de proveedor' if templates_path else ''}"
+        )
+        return BACKEND_LLM, None, None
+    ocr = LocalOcrEngine(config.processing.ocr_workers, config.processing.ocr_lang)
+    try:
+        templates = TemplateStore(templates_path) if templates_path else None
+    except Exception:
+        ocr.close()
+        raise
+    return backend, ocr, templates
+
+
+def page_validator(config: AppConfig, maestro: list[Supplier] | None = None) -> PageValidator | None:
+    """Validador local que decide qué páginas suben por la cascada (None = solo confianza)."""
+    if not config.processing.validate_pages:
+        return None
+    return PageValidator(maestro, config.processing.supplier_match_threshold)
+
+
+def move_to_processing(pdf_path: Path, config: AppConfig) -> Path:
+    """Mueve un PDF a la carpeta 'procesando'. Devuelve su nueva ruta."""
+    procesando_dir = Path(config.paths.procesando).resolve()
+    procesando_dir.mkdir(parents=True, exist_ok=True)
+    processing_path = procesando_dir / pdf_path.name
+
+    if pdf_path != processing_path:
+        shutil.move(str(pdf_path), str(processing_path))
+        logger.info(f"Movido a procesando: {processing_path}")
+    return processing_path
 
 
-def _move_to_errors(pdf_path: Path, config: AppConfig) -> None:
+def move_to_errors(pdf_path: Path, config: AppConfig) -> None:
     """Mueve un PDF problemático a la carpeta de errores."""
     errores_dir = Path(config.paths.errores)
     errores_dir.mkdir(parents=True, exist_ok=True)
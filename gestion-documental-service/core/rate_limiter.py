@@ -0,0 +1,240 @@
+"""Control adaptativo de concurrencia para las llamadas a la API de OpenAI.
+
+AIMD (aumento aditivo, reducción multiplicativa): el número de llamadas en
+vuelo sube poco a poco mientras la latencia y la tasa de errores son sanas,
+y se reduce a la mitad ante un 429 (a 3/4 ante un timeout). Además:
+
+- Respeta `Retry-After`: tras un 429 nadie envía hasta que pasa la espera.
+- Presupuestos por minuto de peticiones (RPM) y de tokens (TPM), con ventana
+  deslizante de 60 s. 0 = sin límite.
+
+Hay una instancia por modelo (ver `ModelRouter` en core.analyzer), compartida
+por todas las fases que usan ese modelo.
+"""
+
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+# Factores de reducción
+RATE_LIMIT_FACTOR = 0.5
+TIMEOUT_FACTOR = 0.75
+# Espera por defecto tras un 429 sin cabecera Retry-After
+DEFAULT_RETRY_AFTER = 2.0
+# No se amplía si la tasa de errores reciente supera este valor
+MAX_HEALTHY_ERROR_RATE = 0.1
+# Peso de cada observación en las medias móviles
+EWMA_ALPHA = 0.2
+
+
+class AdaptiveLimiter:
+    """Limitador AIMD de llamadas concurrentes con presupuestos RPM/TPM.
+
+    `acquire`/`release` controlan las llamadas en vuelo (una por página o
+    grupo de páginas). Los huecos se conceden por prioridad (menor = antes)
+    y, a igual prioridad, por orden de llegada. `wait_budget` se llama antes
+    de cada intento HTTP y `on_success`/`on_timeout`/`on_error` alimentan el
+    ajuste.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial: int | None = None,
+        rpm: int = 0,
+        tpm: int = 0,
+        latency_target: float = 15.0,
+    ):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        start = initial if initial is not None else max(self.min_limit, self.max_limit // 2)
+        self.limit = float(min(max(start, self.min_limit), self.max_limit))
+        self.rpm = rpm
+        self.tpm = tpm
+        self.latency_target = latency_target
+
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # heap
+        self._seq = itertools.count()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._window: deque[tuple[float, int]] = deque()  # (instante, tokens)
+        self._window_tokens = 0
+        self._budget_lock: asyncio.Lock | None = None
+
+        self.latency_ewma: float | None = None
+        self.error_rate = 0.0
+        self.rate_limited = 0
+        self.timeouts = 0
+
+    # ── Concurrencia ──
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self, priority: int = 0) -> None:
+        """Espera a que haya hueco según el límite actual."""
+        if not self._waiters and self._in_flight < int(self.limit):
+            self._in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Ya se nos había concedido el hueco: devolverlo
+                self.release()
+            # Si no, _wake lo descarta al llegar a él
+            raise
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self._in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+    # ── Presupuestos por minuto y Retry-After ──
+
+    async def wait_budget(self, tokens: int = 0) -> None:
+        """Espera a que la llamada quepa en RPM/TPM y no haya bloqueo por 429.
+
+        Reserva la llamada en la ventana antes de volver.
+        """
+        if self._budget_lock is None:
+            self._budget_lock = asyncio.Lock()
+
+        # Un solo proceso decide a la vez: las esperas salen en orden de llegada
+        async with self._budget_lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+
+                self._prune(now)
+                wait = 0.0
+                if self.rpm and len(self._window) >= self.rpm:
+                    wait = self._window[0][0] + WINDOW_SECONDS - now
+                elif self.tpm and self._window and self._window_tokens + tokens > self.tpm:
+                    wait = self._window[0][0] + WINDOW_SECONDS - now
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                self._window.append((now, tokens))
+                self._window_tokens += tokens
+                return
+
+    def _prune(self, now: float) -> None:
+        while self._window and self._window[0][0] <= now - WINDOW_SECONDS:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    # ── Ajuste AIMD ──
+
+    def on_success(self, latency: float, tokens_used: int | None = None, tokens_reserved: int = 0) -> None:
+        """Registra una llamada correcta y amplía el límite si todo va bien."""
+        if tokens_used is not None and tokens_used != tokens_reserved:
+            # Corregir la estimación con el consumo real
+            self._window.append((time.monotonic(), tokens_used - tokens_reserved))
+            self._window_tokens += tokens_used - tokens_reserved
+
+        self.latency_ewma = latency if self.latency_ewma is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency_ewma
+        )
+        self.error_rate *= 1 - EWMA_ALPHA
+
+        healthy = (
+            self.latency_ewma <= self.latency_target
+            and self.error_rate <= MAX_HEALTHY_ERROR_RATE
+        )
+        if healthy and self.limit < self.max_limit:
+            # +1 por cada "ventana" completa de llamadas correctas
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def on_timeout(self) -> None:
+        self.timeouts += 1
+        self._register_error()
+        self._decrease(TIMEOUT_FACTOR, "timeout")
+
+    def on_error(self, error: Exception) -> None:
+        """Registra un error de la API. Los 429 reducen el límite y bloquean."""
+        self._register_error()
+        if not is_rate_limit(error):
+            return
+
+        self.rate_limited += 1
+        wait = retry_after_seconds(error) or DEFAULT_RETRY_AFTER
+        self._blocked_until = max(self._blocked_until, time.monotonic() + wait)
+        self._decrease(RATE_LIMIT_FACTOR, f"429, esperando {wait:.1f}s")
+
+    def _register_error(self) -> None:
+        self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        now = time.monotonic()
+        # Varias llamadas en vuelo fallan a la vez por la misma causa: reducir una vez
+        cooldown = self.latency_ewma or 1.0
+        if now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+
+        previous = self.limit
+        self.limit = max(self.min_limit, self.limit * factor)
+        if int(self.limit) < int(previous):
+            logger.info(f"Concurrencia {int(previous)} → {int(self.limit)} ({reason})")
+
+    def summary(self) -> str:
+        latency = f"{self.latency_ewma:.1f}s" if self.latency_ewma is not None else "-"
+        return (
+            f"concurrencia={int(self.limit)}/{self.max_limit}, latencia={latency}, "
+            f"429={self.rate_limited}, timeouts={self.timeouts}"
+        )
+
+
+def is_rate_limit(error: Exception) -> bool:
+    """True si el error es un 429 de la API."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    """Segundos de espera que indica la API (Retry-After), si los hay."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            # Formato fecha HTTP: no merece la pena, se usa la espera por defecto
+            return None
+    return None
@@ -0,0 +1,150 @@
+"""Caché persistente (SQLite) de resultados de análisis por página.
+
+La clave es un hash del contenido enviado al modelo (imagen o texto) + modelo
++ versión del prompt + variante de la llamada. Así, reprocesar un lote que
+falló tras la fase 1, o un escaneo subido dos veces, no vuelve a pagar las
+llamadas a la API.
+
+Desalojo por tamaño: al superar `max_mb` se borran las entradas usadas hace
+más tiempo.
+"""
+
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, replace
+from datetime import date
+from pathlib import Path
+
+from .models import PageResult, TipoDocumento
+
+logger = logging.getLogger(__name__)
+
+# Subir si cambia el formato serializado de PageResult
+CACHE_SCHEMA = 1
+
+
+class PageResultCache:
+    """Caché clave → PageResult en un fichero SQLite, thread-safe."""
+
+    def __init__(self, path: str | Path, max_mb: int = 200):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS page_results ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_page_results_last_used ON page_results(last_used)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(content: str | bytes, model: str, prompt_version: str, variant: str) -> str:
+        """Clave de caché: hash del contenido enviado + parámetros de la llamada."""
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        h = hashlib.sha256(f"{CACHE_SCHEMA}|{model}|{prompt_version}|{variant}|".encode("utf-8"))
+        h.update(content)
+        return h.hexdigest()
+
+    def get(self, key: str, page_number: int, image_path: str | None) -> PageResult | None:
+        """Devuelve el resultado cacheado, adaptado a la página actual."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM page_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE page_results SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+
+        result = _deserialize(row[0])
+        return replace(result, page_number=page_number, image_path=image_path)
+
+    def put(self, key: str, result: PageResult) -> None:
+        """Guarda un resultado y desaloja si se supera el tamaño máximo."""
+        value = _serialize(result)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_results (key, value, size, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    async def aget(self, key: str, page_number: int, image_path: str | None) -> PageResult | None:
+        return await asyncio.to_thread(self.get, key, page_number, image_path)
+
+    async def aput(self, key: str, result: PageResult) -> None:
+        await asyncio.to_thread(self.put, key, result)
+
+    def _evict(self) -> None:
+        """Borra las entradas menos usadas hasta quedar por debajo del 90% del máximo."""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM page_results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        target = self.max_bytes * 0.9
+        removed = 0
+        rows = self._conn.execute(
+            "SELECT key, size FROM page_results ORDER BY last_used ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= target:
+                break
+            self._conn.execute("DELETE FROM page_results WHERE key = ?", (key,))
+            total -= size
+            removed += 1
+        logger.info(f"Caché de páginas: {removed} entradas desalojadas por tamaño")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def result_to_dict(result: PageResult) -> dict:
+    """PageResult → dict serializable en JSON."""
+    data = asdict(result)
+    data["tipo"] = result.tipo.value
+    data["fecha"] = result.fecha.isoformat() if result.fecha else None
+    return data
+
+
+def result_from_dict(data: dict) -> PageResult:
+    """Inversa de `result_to_dict`."""
+    data = dict(data)
+    data["tipo"] = TipoDocumento(data["tipo"])
+    data["fecha"] = date.fromisoformat(data["fecha"]) if data.get("fecha") else None
+    data.setdefault("page_number", 0)
+    return PageResult(**data)
+
+
+def _serialize(result: PageResult) -> str:
+    data = result_to_dict(result)
+    # Dependen del lote, no del contenido
+    data.pop("page_number", None)
+    data.pop("image_path", None)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _deserialize(value: str) -> PageResult:
+    return result_from_dict(json.loads(value))
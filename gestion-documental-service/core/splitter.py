@@ -3,14 +3,50 @@
 Genera dos versiones:
 - PNG a DPI completo para previews (subida a Supabase)
 - JPEG comprimido a DPI reducido para análisis con OpenAI (más rápido y barato)
+
+Ambas se codifican directamente con PyMuPDF (`Pixmap.tobytes`). Si se pasa un
+`PageImageStore` las imágenes se quedan en memoria; si no, se escriben en
+`output_dir` como siempre.
+
+Con `single_render` cada página se rasteriza una sola vez (a DPI de preview) y
+el JPEG de análisis se obtiene reescalando ese mismo pixmap. Con
+`previews=False` (sin Supabase) no se genera el PNG: se rasteriza solo a
+150 DPI y, si hay almacén, la preview queda registrada como perezosa para la
+fase 2.
+
+Con `workers > 1` el renderizado se reparte por rangos de páginas entre varios
+procesos (cada uno abre su propio documento fitz).
+
+Con `codes` se decodifican los QR fiscales y códigos de barras de cada página
+(ver core.barcodes) y se anotan en el almacén.
+
+Con `image` (ver core.image_optimizer) el JPEG de análisis se recorta al
+contenido, se pasa a grises (o se binariza si es escaneada) y se reescala a
+frontera de tile del modelo de visión; cada página registra los tokens que
+se ahorra.
+
+`stream_pdf_pages` es la versión productor: entrega las páginas según se
+renderizan, a través de una cola acotada, para que el análisis empiece con la
+página 1 sin esperar al resto.
 """
 
 from __future__ import annotations
+import asyncio
+import concurrent.futures
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
+from typing import AsyncIterator, Iterator
 
 import fitz  # PyMuPDF
-from PIL import Image
+
+from .barcodes import PageCodes, codes_available, read_page_codes
+from .image_optimizer import ImageOptions, ImageStats, optimize_pixmap, to_gray
+from .image_store import API, PREVIEW, PageImageStore
 
 logger = logging.getLogger(__name__)
 
@@ -18,11 +54,48 @@ logger = logging.getLogger(__name__)
 ANALYSIS_DPI = 150
 JPEG_QUALITY = 80
 
+# Detección de páginas en blanco (sobre el pixmap de 150 DPI)
+BLANK_INK_LEVEL = 160   # gris (0-255) por debajo del cual un píxel cuenta como tinta
+BLANK_MAX_STD = 6.0     # página casi uniforme (p.ej. separador de color) → blanca
+BLANK_MARGIN = 0.04     # se ignora este % de cada borde (sombras del escáner)
+
+# Páginas por tarea en el pool de procesos (limita lo que viaja de vuelta al padre)
+POOL_CHUNK_PAGES = 8
+
+
+@dataclass
+class RenderOptions:
+    """Qué y cómo renderizar (viaja a los procesos del pool)."""
+    dpi: int = 200
+    previews: bool = True
+    single_render: bool = False
+    blank_ink_ratio: float = 0.0   # 0 = sin detección de páginas en blanco
+    image: ImageOptions | None = None   # None = JPEG de análisis sin optimizar
+    codes: bool = False   # decodificar QR / códigos de barras
+
+
+@dataclass
+class RenderedPage:
+    """Imágenes ya codificadas de una página."""
+    page_number: int
+    preview_png: bytes | None
+    api_jpeg: bytes
+    is_blank: bool = False
+    image_stats: ImageStats | None = None
+    codes: PageCodes | None = None
+
 
 def split_pdf_to_images(
     pdf_path: str | Path,
     output_dir: str | Path,
     dpi: int = 200,
+    workers: int = 1,
+    store: PageImageStore | None = None,
+    previews: bool = True,
+    single_render: bool = False,
+    blank_ink_ratio: float = 0.0,
+    image: ImageOptions | None = None,
+    codes: bool = False,
 ) -> list[str]:
     """Convierte cada página del PDF en imágenes.
 
@@ -34,6 +107,18 @@ def split_pdf_to_images(
         pdf_path: Ruta al PDF de entrada.
         output_dir: Directorio donde guardar las imágenes.
         dpi: Resolución de las imágenes de preview.
+        workers: Procesos de renderizado. 1 = modo serie (sin pool).
+        store: Almacén en memoria. Si se pasa, las imágenes no se escriben a
+               disco (salvo que se supere su presupuesto).
+        previews: Generar el PNG de preview. Si False y hay almacén, la
+                  preview se renderiza bajo demanda; sin almacén se devuelven
+                  las rutas de los JPEG de análisis.
+        single_render: Rasterizar una sola vez y derivar el JPEG reescalando.
+        blank_ink_ratio: Fracción de tinta por debajo de la cual la página se
+                         considera en blanco (se marca en el almacén). 0 = off.
+        image: Optimización del JPEG de análisis (recorte, grises, tiles).
+               None = JPEG a 150 DPI tal cual.
+        codes: Decodificar QR fiscales y códigos de barras (requiere pyzbar).
 
     Returns:
         Lista de rutas a las imágenes PNG (previews), ordenadas por página.
@@ -45,37 +130,355 @@ def split_pdf_to_images(
     if not pdf_path.exists():
         raise FileNotFoundError(f"PDF no encontrado: {pdf_path}")
 
-    doc = fitz.open(str(pdf_path))
+    with fitz.open(str(pdf_path)) as doc:
+        page_count = len(doc)
+
+    options = RenderOptions(
+        dpi=dpi, previews=previews, single_render=single_render, blank_ink_ratio=blank_ink_ratio,
+        image=image,
+        codes=codes and _codes_enabled(),
+    )
+
+    logger.info(
+        f"Procesando {pdf_path.name}: {page_count} páginas "
+        f"({_describe(options)}, {max(1, workers)} proceso/s)"
+    )
+
     image_paths: list[str] = []
+    blank = 0
+    saved = 0
+    for rendered in _iter_pages(str(pdf_path), options, page_count, workers, POOL_CHUNK_PAGES):
+        image_paths.append(_store_rendered_page(rendered, output_dir, store, str(pdf_path), options))
+        blank += rendered.is_blank
+        if rendered.image_stats is not None:
+            saved += rendered.image_stats.tokens_saved
+
+    logger.info(
+        f"Split completado: {len(image_paths)} páginas generadas ({blank} en blanco"
+        f"{f', {saved} tokens de imagen ahorrados' if options.image is not None else ''})"
+    )
+
+    return image_paths
+
+
+async def stream_pdf_pages(
+    pdf_path: str | Path,
+    output_dir: str | Path,
+    dpi: int = 200,
+    workers: int = 1,
+    queue_size: int = 8,
+    store: PageImageStore | None = None,
+    previews: bool = True,
+    single_render: bool = False,
+    blank_ink_ratio: float = 0.0,
+    image: ImageOptions | None = None,
+    codes: bool = False,
+) -> AsyncIterator[tuple[int, str]]:
+    """Renderiza el PDF en segundo plano y entrega las páginas en orden según salen.
+
+    El renderizado corre en un hilo (o en un pool de procesos si `workers > 1`)
+    y deja las páginas en una cola de `queue_size` elementos. Si el consumidor
+    va más lento, el productor se bloquea: como mucho hay `queue_size` páginas
+    renderizadas por delante de lo que se ha consumido.
+
+    Args:
+        pdf_path: Ruta al PDF de entrada.
+        output_dir: Directorio donde guardar las imágenes.
+        dpi: Resolución de las imágenes de preview.
+        workers: Procesos de renderizado. 1 = un solo hilo.
+        queue_size: Máximo de páginas renderizadas pendientes de consumir.
+        store: Almacén en memoria (ver `split_pdf_to_images`).
+        previews: Generar el PNG de preview (ver `split_pdf_to_images`).
+        single_render: Rasterizar una sola vez y derivar el JPEG reescalando.
+        blank_ink_ratio: Umbral de página en blanco (ver `split_pdf_to_images`).
+        image: Optimización del JPEG de análisis (ver `split_pdf_to_images`).
+        codes: Decodificar QR y códigos de barras (ver `split_pdf_to_images`).
+
+    Yields:
+        Tuplas (nº de página 1-indexed, ruta del PNG de preview).
+    """
+    pdf_path = Path(pdf_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if not pdf_path.exists():
+        raise FileNotFoundError(f"PDF no encontrado: {pdf_path}")
+
+    with fitz.open(str(pdf_path)) as doc:
+        page_count = len(doc)
 
-    zoom_preview = dpi / 72
+    options = RenderOptions(
+        dpi=dpi, previews=previews, single_render=single_render, blank_ink_ratio=blank_ink_ratio,
+        image=image,
+        codes=codes and _codes_enabled(),
+    )
+
+    logger.info(
+        f"Procesando {pdf_path.name} en streaming: {page_count} páginas "
+        f"({_describe(options)}, cola={queue_size})"
+    )
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
+    done = object()
+    saved = 0
+
+    def put(item) -> bool:
+        """Encola desde el hilo productor; se rinde si el consumidor ha parado."""
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+
+    def produce() -> None:
+        nonlocal saved
+        try:
+            pages = _iter_pages(
+                str(pdf_path), options, page_count, workers,
+                chunk_size=max(1, queue_size // max(1, workers)),
+            )
+            for rendered in pages:
+                if stop.is_set():
+                    return
+                path = _store_rendered_page(rendered, output_dir, store, str(pdf_path), options)
+                if rendered.image_stats is not None:
+                    saved += rendered.image_stats.tokens_saved
+                if not put((rendered.page_number, path)):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    producer = loop.run_in_executor(None, produce)
+    generated = 0
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            generated += 1
+            yield item
+    finally:
+        stop.set()
+        await producer
+
+    logger.info(
+        f"Split completado: {generated} páginas generadas"
+        f"{f' ({saved} tokens de imagen ahorrados)' if options.image is not None else ''}"
+    )
+
+
+def render_preview_png(pdf_path: str, page_number: int, dpi: int) -> bytes:
+    """Renderiza bajo demanda el PNG de preview de una página (1-indexed)."""
+    zoom = dpi / 72
+    with fitz.open(pdf_path) as doc:
+        pix = doc[page_number - 1].get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return pix.tobytes("png")
+
+
+def _describe(options: RenderOptions) -> str:
+    if not options.previews:
+        return f"API={ANALYSIS_DPI}DPI, sin previews{_describe_image(options)}"
+    mode = "1 render" if options.single_render else "2 renders"
+    return f"preview={options.dpi}DPI, API={ANALYSIS_DPI}DPI, {mode}{_describe_image(options)}"
+
+
+def _codes_enabled() -> bool:
+    if not codes_available():
+        logger.warning("pyzbar/libzbar no disponible: sin decodificación de QR y códigos de barras")
+        return False
+    return True
+
+
+def _describe_image(options: RenderOptions) -> str:
+    if options.image is None:
+        return ""
+    return f", imagen {options.image.mode}/{options.image.detail}"
+
+
+def _store_rendered_page(
+    rendered: RenderedPage,
+    output_dir: Path,
+    store: PageImageStore | None,
+    pdf_path: str,
+    options: RenderOptions,
+) -> str:
+    """Guarda las imágenes de una página (almacén o disco). Devuelve la ruta del PNG."""
+    page_number = rendered.page_number
+    if rendered.image_stats is not None:
+        logger.info(f"  Pág {page_number} imagen: {rendered.image_stats.describe(options.image.detail)}")
+
+    if store is not None:
+        if rendered.is_blank:
+            store.mark_blank(page_number)
+        if rendered.codes is not None:
+            store.set_codes(page_number, rendered.codes)
+        store.put(page_number, API, rendered.api_jpeg)
+        if rendered.preview_png is not None:
+            return store.put(page_number, PREVIEW, rendered.preview_png)
+        # Preview perezosa: solo se renderiza si alguien la pide (retry fase 2)
+        return store.put_lazy(
+            page_number, PREVIEW, partial(render_preview_png, pdf_path, page_number, options.dpi),
+        )
+
+    jpg_path = output_dir / f"page_{page_number:03d}_api.jpg"
+    jpg_path.write_bytes(rendered.api_jpeg)
+    if rendered.preview_png is None:
+        return str(jpg_path)
+
+    png_path = output_dir / f"page_{page_number:03d}.png"
+    png_path.write_bytes(rendered.preview_png)
+    return str(png_path)
+
+
+def _iter_pages(
+    pdf_path: str,
+    options: RenderOptions,
+    page_count: int,
+    workers: int,
+    chunk_size: int,
+) -> Iterator[RenderedPage]:
+    """Renderiza todas las páginas en orden, en serie o en un pool de procesos."""
+    if workers <= 1 or page_count <= 1:
+        return _iter_rendered_pages(pdf_path, options, 0, page_count)
+    return _iter_pool_rendered_pages(pdf_path, options, page_count, workers, chunk_size)
+
+
+def _iter_pool_rendered_pages(
+    pdf_path: str,
+    options: RenderOptions,
+    page_count: int,
+    workers: int,
+    chunk_size: int,
+) -> Iterator[RenderedPage]:
+    """Renderiza en un pool de procesos por bloques, entregando en orden de página.
+
+    Solo hay `workers` bloques en vuelo a la vez, para no adelantarse
+    indefinidamente al consumidor.
+    """
+    chunks = iter([
+        (start, min(start + chunk_size, page_count))
+        for start in range(0, page_count, chunk_size)
+    ])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque = deque()
+        for start, end in chunks:
+            pending.append(pool.submit(_render_page_range, pdf_path, options, start, end))
+            if len(pending) >= workers:
+                break
+
+        while pending:
+            future = pending.popleft()
+            rendered_pages = future.result()
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                pending.append(pool.submit(_render_page_range, pdf_path, options, *next_chunk))
+            yield from rendered_pages
+
+
+def _render_page_range(
+    pdf_path: str,
+    options: RenderOptions,
+    start: int,
+    end: int,
+) -> list[RenderedPage]:
+    """Renderiza las páginas [start, end) del PDF. Ejecutable en un proceso hijo.
+
+    Abre su propio documento fitz (los documentos no se pueden compartir
+    entre procesos).
+    """
+    return list(_iter_rendered_pages(pdf_path, options, start, end))
+
+
+def _iter_rendered_pages(
+    pdf_path: str,
+    options: RenderOptions,
+    start: int,
+    end: int,
+) -> Iterator[RenderedPage]:
+    """Renderiza las páginas [start, end) una a una."""
+    zoom_preview = options.dpi / 72
     zoom_api = ANALYSIS_DPI / 72
     matrix_preview = fitz.Matrix(zoom_preview, zoom_preview)
     matrix_api = fitz.Matrix(zoom_api, zoom_api)
 
-    logger.info(f"Procesando {pdf_path.name}: {len(doc)} páginas (preview={dpi}DPI, API={ANALYSIS_DPI}DPI)")
+    with fitz.open(pdf_path) as doc:
+        total = len(doc)
+        for page_num in range(start, end):
+            page = doc[page_num]
+            pix_preview = None
 
-    for page_num in range(len(doc)):
-        page = doc[page_num]
+            if not options.previews:
+                # Sin previews: un único render directamente a 150 DPI
+                pix_api = page.get_pixmap(matrix=matrix_api)
+            elif options.single_render:
+                # Un único render a DPI de preview; el JPEG sale reescalando
+                pix_preview = page.get_pixmap(matrix=matrix_preview)
+                pix_api = _downscale(pix_preview, ANALYSIS_DPI / options.dpi)
+            else:
+                # PNG para preview (calidad completa)
+                pix_preview = page.get_pixmap(matrix=matrix_preview)
+                # JPEG para API de OpenAI (comprimido, menor resolución)
+                pix_api = page.get_pixmap(matrix=matrix_api)
 
-        # PNG para preview (calidad completa)
-        pix_preview = page.get_pixmap(matrix=matrix_preview)
-        png_name = f"page_{page_num + 1:03d}.png"
-        png_path = output_dir / png_name
-        pix_preview.save(str(png_path))
-        image_paths.append(str(png_path))
+            is_blank = bool(options.blank_ink_ratio) and _is_blank(pix_api, options.blank_ink_ratio)
 
-        # JPEG para API de OpenAI (comprimido, menor resolución)
-        pix_api = page.get_pixmap(matrix=matrix_api)
-        jpg_name = f"page_{page_num + 1:03d}_api.jpg"
-        jpg_path = output_dir / jpg_name
-        # Convertir pixmap a PIL Image para guardar como JPEG con compresión
-        img = Image.frombytes("RGB", [pix_api.width, pix_api.height], pix_api.samples)
-        img.save(str(jpg_path), "JPEG", quality=JPEG_QUALITY, optimize=True)
+            codes = None
+            if options.codes and not is_blank:
+                codes = read_page_codes(to_gray(pix_api))
 
-        logger.debug(f"  Página {page_num + 1}/{len(doc)} → {png_name} + {jpg_name}")
+            image_stats = None
+            if options.image is not None and not is_blank:
+                # Sin capa de texto = escaneada (en modo "auto" se binariza)
+                scanned = options.image.mode == "auto" and not page.get_text("text").strip()
+                api_jpeg, image_stats = optimize_pixmap(pix_api, options.image, JPEG_QUALITY, scanned)
+            else:
+                api_jpeg = pix_api.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
 
-    doc.close()
-    logger.info(f"Split completado: {len(image_paths)} páginas generadas")
+            logger.debug(
+                f"  Página {page_num + 1}/{total} renderizada{' (en blanco)' if is_blank else ''}"
+            )
+            yield RenderedPage(
+                page_number=page_num + 1,
+                preview_png=pix_preview.tobytes("png") if pix_preview is not None else None,
+                api_jpeg=api_jpeg,
+                is_blank=is_blank,
+                image_stats=image_stats,
+                codes=codes,
+            )
 
-    return image_paths
+
+def _is_blank(pix: fitz.Pixmap, max_ink_ratio: float) -> bool:
+    """Clasifica una página como en blanco por cobertura de tinta o varianza.
+
+    - Cobertura de tinta: fracción de píxeles más oscuros que BLANK_INK_LEVEL.
+      Un reverso en blanco con algo de polvo queda muy por debajo de 0.3%.
+    - Varianza: una hoja separadora de color es uniforme aunque sea oscura.
+    """
+    gray = to_gray(pix)
+    h, w = gray.shape
+    mh, mw = int(h * BLANK_MARGIN), int(w * BLANK_MARGIN)
+    if h - 2 * mh > 0 and w - 2 * mw > 0:
+        gray = gray[mh:h - mh, mw:w - mw]
+
+    if float(gray.std()) < BLANK_MAX_STD:
+        return True
+    ink = float((gray < BLANK_INK_LEVEL).mean())
+    return ink < max_ink_ratio
+
+
+def _downscale(pix: fitz.Pixmap, factor: float) -> fitz.Pixmap:
+    """Copia reescalada de un pixmap (sin volver a rasterizar la página)."""
+    if factor >= 1:
+        return pix
+    width = max(1, round(pix.width * factor))
+    height = max(1, round(pix.height * factor))
+    return fitz.Pixmap(pix, width, height)
@@ -3,6 +3,7 @@
 from __future__ import annotations
 import logging
 from dataclasses import dataclass
+from pathlib import Path
 
 from thefuzz import process as fuzz_process
 
@@ -15,6 +16,7 @@ logger = logging.getLogger(__name__)
 class Supplier:
     codigo: str
     nombre: str
+    nif: str | None = None
 
 
 def lookup_suppliers(
@@ -44,39 +46,64 @@ def lookup_suppliers(
     unmatched = 0
 
     for doc in documents:
-        if not doc.proveedor_nombre:
-            continue
-
-        result = fuzz_process.extractOne(
-            doc.proveedor_nombre.strip(),
-            nombres_maestro,
-        )
-
-        if result is None:
-            unmatched += 1
-            continue
-
-        best_match, score = result[0], result[1]
-
-        if score >= match_threshold:
-            supplier = nombre_to_supplier[best_match]
-            doc.proveedor_codigo = supplier.codigo
+        found = _match_supplier(doc, nombres_maestro, nombre_to_supplier, match_threshold)
+        if found is True:
             matched += 1
-            logger.debug(
-                f"  '{doc.proveedor_nombre}' → {supplier.codigo} - {supplier.nombre} "
-                f"(score: {score})"
-            )
-        else:
+        elif found is False:
             unmatched += 1
-            logger.info(
-                f"  '{doc.proveedor_nombre}' → sin match (mejor: '{best_match}' "
-                f"score: {score} < {match_threshold})"
-            )
 
     logger.info(f"Lookup completado: {matched} matches, {unmatched} sin match")
     return documents
 
 
+def lookup_supplier(doc: Document, maestro: list[Supplier], match_threshold: int = 80) -> bool | None:
+    """Lookup de un solo documento (p.ej. en cuanto el agrupador en línea lo termina).
+
+    Returns:
+        True si hay match, False si no, None si el documento no tiene proveedor.
+    """
+    if not maestro:
+        return None
+    return _match_supplier(
+        doc, [s.nombre for s in maestro], {s.nombre: s for s in maestro}, match_threshold,
+    )
+
+
+def _match_supplier(
+    doc: Document,
+    nombres_maestro: list[str],
+    nombre_to_supplier: dict[str, Supplier],
+    match_threshold: int,
+) -> bool | None:
+    if not doc.proveedor_nombre:
+        return None
+
+    result = fuzz_process.extractOne(
+        doc.proveedor_nombre.strip(),
+        nombres_maestro,
+    )
+
+    if result is None:
+        return False
+
+    best_match, score = result[0], result[1]
+
+    if score >= match_threshold:
+        supplier = nombre_to_supplier[best_match]
+        doc.proveedor_codigo = supplier.codigo
+        logger.debug(
+            f"  '{doc.proveedor_nombre}' → {supplier.codigo} - {supplier.nombre} "
+            f"(score: {score})"
+        )
+        return True
+
+    logger.info(
+        f"  '{doc.proveedor_nombre}' → sin match (mejor: '{best_match}' "
+        f"score: {score} < {match_threshold})"
+    )
+    return False
+
+
 async def load_maestro_from_supabase(supabase_client) -> list[Supplier]:
     """Carga el maestro de proveedores desde la tabla 'proveedores' de Supabase.
 
@@ -84,15 +111,69 @@ async def load_maestro_from_supabase(supabase_client) -> list[Supplier]:
         supabase_client: Cliente de Supabase inicializado.
 
     Returns:
-        Lista de Supplier con código y nombre.
+        Lista de Supplier con código, nombre y NIF (si la tabla lo tiene).
     """
-    response = supabase_client.table("proveedores").select("codigo, nombre").execute()
+    response = supabase_client.table("proveedores").select("*").execute()
+    maestro = suppliers_from_rows(response.data)
+
+    logger.info(f"Maestro cargado: {len(maestro)} proveedores desde Supabase")
+    return maestro
 
-    maestro = [
-        Supplier(codigo=row["codigo"], nombre=row["nombre"])
-        for row in response.data
+
+def suppliers_from_rows(rows: list[dict]) -> list[Supplier]:
+    """Supplier a partir de filas de la tabla 'proveedores' (NIF en 'nif' o 'cif')."""
+    return [
+        Supplier(
+            codigo=str(row["codigo"]),
+            nombre=row["nombre"],
+            nif=row.get("nif") or row.get("cif") or None,
+        )
+        for row in rows
         if row.get("codigo") and row.get("nombre")
     ]
 
-    logger.info(f"Maestro cargado: {len(maestro)} proveedores desde Supabase")
+
+def load_maestro_from_excel(path: str | Path) -> list[Supplier]:
+    """Carga el maestro de proveedores desde un Excel (primera hoja).
+
+    Si la primera fila tiene cabeceras (código, nombre, NIF/CIF) se usan esas
+    columnas; si no, se asume A = código, B = nombre, C = NIF.
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = list(workbook.worksheets[0].iter_rows(values_only=True))
+    finally:
+        workbook.close()
+    if not rows:
+        return []
+
+    header = [str(cell or "").strip().lower() for cell in rows[0]]
+    columns = {"codigo": 0, "nombre": 1, "nif": 2}
+    found = {
+        key: index for index, name in enumerate(header)
+        for key, names in (
+            ("codigo", ("codigo", "código", "cod")),
+            ("nombre", ("nombre", "razon social", "razón social", "proveedor")),
+            ("nif", ("nif", "cif", "nif/cif")),
+        )
+        if name in names
+    }
+    if "codigo" in found and "nombre" in found:
+        columns.update(found)
+        if "nif" not in found:
+            columns["nif"] = None
+        rows = rows[1:]
+
+    maestro = []
+    for row in rows:
+        codigo, nombre = _cell(row, columns["codigo"]), _cell(row, columns["nombre"])
+        if codigo and nombre:
+            maestro.append(Supplier(codigo=codigo, nombre=nombre, nif=_cell(row, columns["nif"]) or None))
     return maestro
+
+
+def _cell(row: tuple, index: int | None) -> str:
+    value = row[index] if index is not None and index < len(row) else None
+    return str(value).strip() if value is not None else ""
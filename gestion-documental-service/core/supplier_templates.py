@@ -0,0 +1,383 @@
+"""Plantillas de maquetación por proveedor, aprendidas de documentos confirmados.
+
+Las facturas y albaranes de un mismo proveedor salen siempre del mismo ERP:
+el nº de documento, la fecha y los albaranes referenciados están en las
+mismas zonas de la página. Tras unos cuantos documentos confirmados (lookup
+de proveedor correcto y datos válidos) se guarda, por código de proveedor y
+tipo, la región de cada campo. Las páginas siguientes de ese proveedor que
+no salen bien a la primera se releen con OCR local solo en esas regiones,
+en vez de subir la página entera por la cascada de visión.
+
+Aprendizaje: OCR local de la primera página del documento, se buscan las
+cajas de las palabras que forman cada valor confirmado. Una región se activa
+cuando aparece en `MIN_SAMPLES` muestras y no se mueve más de
+`MAX_REGION_SPREAD`.
+
+Invalidación: si la lectura con plantilla falla (campos ilegibles o que no
+validan) `MAX_FAILURES` veces seguidas, el proveedor cambió de formato: la
+plantilla se descarta, sube de versión y se vuelve a aprender.
+
+Persistencia en SQLite, como la caché de páginas. Requiere el OCR local
+(`core.local_ocr`).
+"""
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import date
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+from .image_optimizer import crop_pixmap
+from .image_store import PageImageStore
+from .local_ocr import LocalOcrEngine, OcrPage
+from .models import Document, EstadoDocumento, TipoDocumento
+from .text_layer import find_albaran_refs, find_date, find_document_number
+from .validators import normalize_nif, plausible_date, valid_document_number, valid_nif
+
+logger = logging.getLogger(__name__)
+
+# Subir si cambia el formato de las regiones (invalida todas las plantillas)
+TEMPLATE_SCHEMA = 1
+
+# Campos que se localizan en la página
+CAMPO_NUMERO = "numero"
+CAMPO_FECHA = "fecha"
+CAMPO_REFS = "albaranes_ref"
+
+# Muestras necesarias para activar una región y muestras que se conservan
+MIN_SAMPLES = 3
+MAX_SAMPLES = 10
+# Desplazamiento máximo (fracción de página) de una región entre muestras
+MAX_REGION_SPREAD = 0.05
+# Margen alrededor de la región aprendida
+REGION_PADDING = 0.015
+# Lecturas fallidas seguidas que invalidan la plantilla
+MAX_FAILURES = 3
+
+Box = tuple[float, float, float, float]
+
+
+@dataclass
+class SupplierTemplate:
+    """Regiones de los campos de un proveedor para un tipo de documento."""
+    codigo: str
+    tipo: str
+    nif: str | None = None
+    version: int = 1
+    regions: dict[str, Box] = field(default_factory=dict)   # vacío = aún aprendiendo
+    samples: list[dict[str, Box]] = field(default_factory=list)
+    failures: int = 0
+    hits: int = 0
+
+    @property
+    def active(self) -> bool:
+        return bool(self.regions)
+
+
+class TemplateStore:
+    """Plantillas por (código de proveedor, tipo) en SQLite, thread-safe.
+
+    Se cargan todas en memoria al abrir (son pocas); las escrituras van a disco.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS supplier_templates ("
+            " codigo TEXT NOT NULL,"
+            " tipo TEXT NOT NULL,"
+            " schema INTEGER NOT NULL,"
+            " value TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (codigo, tipo))"
+        )
+        self._conn.commit()
+
+        self._templates: dict[tuple[str, str], SupplierTemplate] = {}
+        self._by_nif: dict[tuple[str, str], SupplierTemplate] = {}
+        rows = self._conn.execute(
+            "SELECT value FROM supplier_templates WHERE schema = ?", (TEMPLATE_SCHEMA,)
+        ).fetchall()
+        for (value,) in rows:
+            data = json.loads(value)
+            data["regions"] = {k: tuple(v) for k, v in data["regions"].items()}
+            data["samples"] = [{k: tuple(v) for k, v in s.items()} for s in data["samples"]]
+            self._index(SupplierTemplate(**data))
+
+        active = sum(1 for t in self._templates.values() if t.active)
+        logger.info(f"Plantillas de proveedor: {active} activas, {len(self._templates) - active} aprendiendo")
+
+    def get(self, nif: str | None, tipo: TipoDocumento) -> SupplierTemplate | None:
+        """Plantilla activa del proveedor con ese NIF para ese tipo de documento."""
+        if not nif:
+            return None
+        template = self._by_nif.get((normalize_nif(nif), tipo.value))
+        return template if template is not None and template.active else None
+
+    def wants_samples(self, codigo: str, tipo: TipoDocumento) -> bool:
+        """True si la plantilla de ese proveedor y tipo aún se está aprendiendo."""
+        template = self._templates.get((codigo, tipo.value))
+        return template is None or not template.active
+
+    def learn(self, codigo: str, tipo: TipoDocumento, nif: str | None, boxes: dict[str, Box]) -> None:
+        """Añade una muestra (cajas de los campos en un documento confirmado)."""
+        with self._lock:
+            template = self._templates.get((codigo, tipo.value))
+            if template is None:
+                template = SupplierTemplate(codigo=codigo, tipo=tipo.value)
+            if template.active:
+                return
+            template.nif = normalize_nif(nif) if nif else template.nif
+            template.samples = (template.samples + [boxes])[-MAX_SAMPLES:]
+            template.regions = _regions_from_samples(template.samples)
+            if template.active:
+                logger.info(
+                    f"Plantilla {codigo}/{tipo.value} v{template.version} activada: "
+                    f"{', '.join(template.regions)}"
+                )
+            self._index(template)
+            self._save(template)
+
+    def record(self, template: SupplierTemplate, ok: bool) -> None:
+        """Anota el resultado de una lectura con plantilla; invalida tras varios fallos."""
+        with self._lock:
+            if ok:
+                template.hits += 1
+                template.failures = 0
+            else:
+                template.failures += 1
+                if template.failures >= MAX_FAILURES:
+                    logger.warning(
+                        f"Plantilla {template.codigo}/{template.tipo} v{template.version} "
+                        f"invalidada tras {template.failures} lecturas fallidas — se vuelve a aprender"
+                    )
+                    template.version += 1
+                    template.regions = {}
+                    template.samples = []
+                    template.failures = 0
+            self._save(template)
+
+    async def arecord(self, template: SupplierTemplate, ok: bool) -> None:
+        await asyncio.to_thread(self.record, template, ok)
+
+    def _index(self, template: SupplierTemplate) -> None:
+        self._templates[(template.codigo, template.tipo)] = template
+        if template.nif:
+            self._by_nif[(template.nif, template.tipo)] = template
+
+    def _save(self, template: SupplierTemplate) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO supplier_templates (codigo, tipo, schema, value, updated) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (template.codigo, template.tipo, TEMPLATE_SCHEMA, json.dumps(asdict(template)), time.time()),
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# ── Aprendizaje ──
+
+
+async def learn_templates(
+    documents: list[Document],
+    templates: TemplateStore,
+    ocr: LocalOcrEngine,
+    store: PageImageStore,
+    confidence_threshold: float = 0.8,
+) -> int:
+    """Añade a las plantillas las muestras de los documentos confirmados del lote.
+
+    Args:
+        documents: Documentos ya con lookup de proveedor.
+        templates: Almacén de plantillas.
+        ocr: Motor de OCR local.
+        store: Almacén con las imágenes de página del lote.
+        confidence_threshold: Confianza mínima del documento.
+
+    Returns:
+        Nº de muestras añadidas.
+    """
+    learned = 0
+    for doc in documents:
+        if not _is_confirmed(doc, confidence_threshold) or not doc.page_images:
+            continue
+        if not templates.wants_samples(doc.proveedor_codigo, doc.tipo):
+            continue
+        try:
+            path = doc.page_images[0]
+            if store.contains(path):
+                data = await store.aread(path)
+            else:
+                data = await asyncio.to_thread(Path(path).read_bytes)
+            page = await ocr.read(data)
+        except Exception as e:
+            logger.warning(f"  Plantillas: OCR de {doc.fichero_nombre or doc.id} falló: {e}")
+            continue
+        boxes = locate_fields(page, _document_values(doc))
+        if boxes:
+            await asyncio.to_thread(templates.learn, doc.proveedor_codigo, doc.tipo, doc.proveedor_nif, boxes)
+            learned += 1
+    if learned:
+        logger.info(f"Plantillas: {learned} muestras aprendidas de documentos confirmados")
+    return learned
+
+
+def _is_confirmed(doc: Document, confidence_threshold: float) -> bool:
+    if doc.estado != EstadoDocumento.OK or not doc.proveedor_codigo or doc.confianza < confidence_threshold:
+        return False
+    number = doc.numero_factura if doc.tipo == TipoDocumento.FACTURA else doc.numero_albaran
+    return (
+        doc.tipo != TipoDocumento.DESCONOCIDO
+        and valid_nif(doc.proveedor_nif)
+        and valid_document_number(number)
+        and plausible_date(doc.fecha_documento)
+    )
+
+
+def _document_values(doc: Document) -> dict[str, list[str]]:
+    """Textos de cada campo tal como pueden aparecer en la página (normalizados)."""
+    number = doc.numero_factura if doc.tipo == TipoDocumento.FACTURA else doc.numero_albaran
+    values = {CAMPO_NUMERO: [_normalize(number)]}
+    if doc.fecha_documento is not None:
+        values[CAMPO_FECHA] = _date_variants(doc.fecha_documento)
+    if doc.tipo == TipoDocumento.FACTURA and doc.numeros_albaran_ref:
+        values[CAMPO_REFS] = [_normalize(ref) for ref in doc.numeros_albaran_ref]
+    return values
+
+
+def locate_fields(page: OcrPage, values: dict[str, list[str]]) -> dict[str, Box]:
+    """Caja de cada campo: la de las palabras consecutivas de una línea que lo forman.
+
+    Para los albaranes referenciados, la unión de las cajas de todos los encontrados.
+    """
+    lines: dict[tuple[int, int, int], list] = {}
+    for word in page.words:
+        lines.setdefault(word.line, []).append(word)
+
+    boxes: dict[str, Box] = {}
+    for campo, targets in values.items():
+        found = [box for target in targets if target for box in [_find_span(lines, target)] if box]
+        if campo == CAMPO_REFS:
+            if found:
+                boxes[campo] = _union(found)
+        elif found:
+            boxes[campo] = found[0]
+    return boxes
+
+
+def _find_span(lines: dict, target: str) -> Box | None:
+    """Caja del tramo más corto de palabras consecutivas que contiene `target`."""
+    for words in lines.values():
+        for start in range(len(words)):
+            text = ""
+            for end in range(start, len(words)):
+                text += _normalize(words[end].text)
+                if target in text:
+                    # Quitar por la izquierda las palabras que sobran (etiquetas)
+                    while start < end and target in "".join(_normalize(w.text) for w in words[start + 1:end + 1]):
+                        start += 1
+                    return _union([w.box for w in words[start:end + 1]])
+                if len(text) > len(target) + 12:
+                    break
+    return None
+
+
+def _regions_from_samples(samples: list[dict[str, Box]]) -> dict[str, Box]:
+    """Regiones estables: presentes en MIN_SAMPLES muestras y sin moverse."""
+    regions: dict[str, Box] = {}
+    for campo in (CAMPO_NUMERO, CAMPO_FECHA, CAMPO_REFS):
+        boxes = [s[campo] for s in samples if campo in s]
+        if len(boxes) < MIN_SAMPLES:
+            continue
+        # La tabla de líneas crece según el nº de líneas: solo se exige estable el borde superior
+        edges = (1,) if campo == CAMPO_REFS else (0, 1, 2, 3)
+        if any(max(b[i] for b in boxes) - min(b[i] for b in boxes) > MAX_REGION_SPREAD for i in edges):
+            continue
+        x0, y0, x1, y1 = _union(boxes)
+        regions[campo] = (
+            max(0.0, x0 - REGION_PADDING), max(0.0, y0 - REGION_PADDING),
+            min(1.0, x1 + REGION_PADDING), min(1.0, y1 + REGION_PADDING),
+        )
+    return regions
+
+
+# ── Lectura con plantilla ──
+
+
+async def read_template_fields(
+    template: SupplierTemplate, data: bytes, ocr: LocalOcrEngine,
+) -> dict | None:
+    """OCR de las regiones de la plantilla sobre una imagen de página.
+
+    Devuelve los campos con las claves de PageResult, o None si alguno de
+    los de la plantilla no se lee con un formato válido.
+    """
+    campos = list(template.regions)
+    crops = await asyncio.to_thread(lambda: [crop_region(data, template.regions[c]) for c in campos])
+    pages = await asyncio.gather(*(ocr.read(crop) for crop in crops))
+
+    values: dict = {}
+    for campo, page in zip(campos, pages):
+        if campo == CAMPO_NUMERO:
+            number = find_document_number(page.text)
+            if not valid_document_number(number):
+                return None
+            key = "numero_factura" if template.tipo == TipoDocumento.FACTURA.value else "numero_albaran"
+            values[key] = number
+        elif campo == CAMPO_FECHA:
+            fecha = find_date(page.text)
+            if fecha is None or not plausible_date(date.fromisoformat(fecha)):
+                return None
+            values["fecha"] = date.fromisoformat(fecha)
+        elif campo == CAMPO_REFS:
+            refs = find_albaran_refs(page.text)
+            if not refs:
+                return None
+            values["numeros_albaran_ref"] = refs
+    return values
+
+
+def crop_region(data: bytes, box: Box) -> bytes:
+    """PNG de la región `box` (fracciones de página) de una imagen codificada."""
+    pix = fitz.Pixmap(data)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    x0, y0, x1, y1 = box
+    return crop_pixmap(
+        pix,
+        int(x0 * pix.width), int(y0 * pix.height),
+        max(int(x0 * pix.width) + 1, int(x1 * pix.width)),
+        max(int(y0 * pix.height) + 1, int(y1 * pix.height)),
+    ).tobytes("png")
+
+
+def _normalize(value: str | None) -> str:
+    return re.sub(r"[^A-Z0-9]", "", (value or "").upper())
+
+
+def _date_variants(value: date) -> list[str]:
+    d, m, y = value.day, value.month, value.year
+    return list(dict.fromkeys([
+        f"{d:02d}{m:02d}{y}", f"{d}{m}{y}", f"{d:02d}{m:02d}{y % 100:02d}", f"{d}{m}{y % 100:02d}",
+    ]))
+
+
+def _union(boxes: list[Box]) -> Box:
+    return (
+        min(b[0] for b in boxes), min(b[1] for b in boxes),
+        max(b[2] for b in boxes), max(b[3] for b in boxes),
+    )
@@ -0,0 +1,164 @@
+"""Vía rápida para PDFs nativos (con capa de texto): sin rasterizar para la API.
+
+Muchas facturas llegan por email como PDF generado por el ERP del proveedor.
+Para esas páginas el texto se extrae con PyMuPDF y se analiza con parsers
+locales (nº factura, nº albarán, NIF, fecha) o con una llamada solo-texto,
+mucho más barata que la de visión.
+"""
+
+from __future__ import annotations
+import logging
+import re
+from datetime import date
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+# NIFs de FMV (comprador): nunca son el proveedor
+_FMV_NIFS = {"B80652688", "B67803304"}
+
+_NIF_RE = re.compile(
+    r"\b(?:ES[\s\-]?)?([A-HJNP-SUVW][\s\-]?\d{7}[\s\-]?[0-9A-J]|\d{8}[\s\-]?[A-Z]|[XYZ][\s\-]?\d{7}[\s\-]?[A-Z])\b"
+)
+_FACTURA_HEADER_RE = re.compile(r"\b(FACTURA|FRA\.|INVOICE)\b", re.IGNORECASE)
+_ALBARAN_HEADER_RE = re.compile(r"\b(ALBAR[AÁ]N|NOTA DE ENTREGA|DELIVERY NOTE)\b", re.IGNORECASE)
+_NUM_LABEL = r"\s*(?:N[º°o]\.?|N[ÚU]M(?:ERO)?\.?|NO\.?)?\s*[:#]?\s*"
+_NUM_VALUE = r"([A-Z0-9][A-Z0-9/\-\.]*\d[A-Z0-9/\-\.]*)"
+_FACTURA_NUM_RE = re.compile(r"\b(?:FACTURA|FRA\.?)" + _NUM_LABEL + _NUM_VALUE, re.IGNORECASE)
+_ALBARAN_NUM_RE = re.compile(
+    r"\b(?:ALBAR[AÁ]N|ALB\.?|N/A)" + _NUM_LABEL + _NUM_VALUE, re.IGNORECASE
+)
+_BARE_NUM_RE = re.compile(r"(?<![A-Z0-9])" + _NUM_VALUE, re.IGNORECASE)
+_PEDIDO_NUM_RE = re.compile(r"\b(?:PEDIDO|PED\.)" + _NUM_LABEL + _NUM_VALUE, re.IGNORECASE)
+_DATE_RE = re.compile(r"\b(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4}|\d{2})\b")
+_PAGE_N_RE = re.compile(r"\b(?:P[AÁ]GINA|P[AÁ]G\.?|HOJA)\s*(\d+)\s*(?:DE|/)\s*(\d+)", re.IGNORECASE)
+
+# Líneas de cabecera donde se busca el tipo de documento
+_HEADER_LINES = 15
+
+
+def extract_text_pages(pdf_path: str | Path, min_chars: int = 200) -> dict[int, str]:
+    """Devuelve el texto de las páginas que tienen capa de texto utilizable.
+
+    Args:
+        pdf_path: Ruta al PDF.
+        min_chars: Mínimo de caracteres no blancos para considerar la página
+                   como nativa (un escaneo sin OCR devuelve texto vacío).
+
+    Returns:
+        {nº de página 1-indexed: texto}
+    """
+    pages: dict[int, str] = {}
+    with fitz.open(str(pdf_path)) as doc:
+        for page_num in range(len(doc)):
+            text = doc[page_num].get_text("text")
+            if len("".join(text.split())) >= min_chars:
+                pages[page_num + 1] = text
+
+        if pages:
+            logger.info(
+                f"Capa de texto: {len(pages)}/{len(doc)} páginas con texto extraíble "
+                f"(vía rápida sin visión)"
+            )
+    return pages
+
+
+def parse_document_text(text: str) -> dict:
+    """Extrae los campos clave de una página con parsers locales.
+
+    Devuelve un dict con las mismas claves que la respuesta JSON del modelo
+    (ver `analyzer.SYSTEM_PROMPT`), para poder usar el mismo `_to_page_result`.
+    El proveedor (razón social) no se intenta deducir localmente.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    header = "\n".join(lines[:_HEADER_LINES])
+
+    if _FACTURA_HEADER_RE.search(header):
+        tipo = "factura"
+    elif _ALBARAN_HEADER_RE.search(header):
+        tipo = "albaran"
+    elif _FACTURA_HEADER_RE.search(text):
+        tipo = "factura"
+    elif _ALBARAN_HEADER_RE.search(text):
+        tipo = "albaran"
+    else:
+        tipo = "desconocido"
+
+    numero_factura = _first_group(_FACTURA_NUM_RE, text) if tipo == "factura" else None
+    albaran_nums = _all_groups(_ALBARAN_NUM_RE, text)
+    numero_albaran = albaran_nums[0] if tipo == "albaran" and albaran_nums else None
+    refs = albaran_nums if tipo == "factura" else []
+
+    # Continuación: "Página 2 de 3" sin nº de documento propio
+    es_continuacion = False
+    page_match = _PAGE_N_RE.search(text)
+    if page_match and int(page_match.group(1)) > 1 and not (numero_factura or numero_albaran):
+        es_continuacion = True
+
+    found = [tipo != "desconocido", bool(numero_factura or numero_albaran), bool(find_nif(text))]
+    confianza = 0.4 + 0.15 * sum(found)
+
+    return {
+        "tipo": tipo,
+        "proveedor": None,
+        "proveedor_nif": find_nif(text),
+        "numero_factura": numero_factura,
+        "numero_albaran": numero_albaran,
+        "numeros_albaran_referenciados": refs,
+        "numero_pedido": _first_group(_PEDIDO_NUM_RE, text),
+        "fecha": find_date(text),
+        "es_continuacion_anterior": es_continuacion,
+        "confianza": round(confianza, 2),
+    }
+
+
+def find_nif(text: str) -> str | None:
+    """Primer NIF/CIF del texto que no sea de FMV, normalizado (sin separadores)."""
+    for match in _NIF_RE.finditer(text.upper()):
+        nif = re.sub(r"[\s\-]", "", match.group(1))
+        if nif not in _FMV_NIFS:
+            return nif
+    return None
+
+
+def find_document_number(text: str) -> str | None:
+    """Nº de factura/albarán en un recorte: el etiquetado o, si no, el token con dígitos más largo."""
+    labelled = _first_group(_FACTURA_NUM_RE, text) or _first_group(_ALBARAN_NUM_RE, text)
+    if labelled:
+        return labelled
+    tokens = _all_groups(_BARE_NUM_RE, text)
+    return max(tokens, key=len) if tokens else None
+
+
+def find_albaran_refs(text: str) -> list[str]:
+    """Nºs de albarán etiquetados del texto (p.ej. las líneas de una factura)."""
+    return _all_groups(_ALBARAN_NUM_RE, text)
+
+
+def find_date(text: str) -> str | None:
+    """Primera fecha dd/mm/aaaa válida, en formato ISO."""
+    for match in _DATE_RE.finditer(text):
+        day, month, year = (int(g) for g in match.groups())
+        if year < 100:
+            year += 2000
+        try:
+            return date(year, month, day).isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def _first_group(pattern: re.Pattern, text: str) -> str | None:
+    match = pattern.search(text)
+    return match.group(1).strip(".-/") if match else None
+
+
+def _all_groups(pattern: re.Pattern, text: str) -> list[str]:
+    seen: list[str] = []
+    for match in pattern.finditer(text):
+        value = match.group(1).strip(".-/")
+        if value and value not in seen:
+            seen.append(value)
+    return seen
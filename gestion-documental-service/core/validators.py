@@ -0,0 +1,144 @@
+"""Validación local de los datos extraídos de una página.
+
+Decide, junto con la confianza del modelo, si merece la pena subir una página
+por la cascada (reintento en alta):
+
+- Datos inválidos (NIF con dígito de control incorrecto, fecha imposible, nº
+  de documento con formato raro): se reintenta aunque la confianza sea alta.
+- Datos completos y verificados (proveedor en el maestro por NIF o nombre,
+  nº de documento y fecha correctos): no se reintenta aunque la confianza sea
+  baja.
+"""
+
+from __future__ import annotations
+import re
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+
+from thefuzz import process as fuzz_process
+
+from .models import PageResult, TipoDocumento
+from .supplier_lookup import Supplier
+
+_DNI_LETTERS = "TRWAGMYFPDXBNJZSQVHLCKE"
+_CIF_LETTERS = "JABCDEFGHI"
+
+_DNI_RE = re.compile(r"^\d{8}[A-Z]$")
+_NIE_RE = re.compile(r"^[XYZ]\d{7}[A-Z]$")
+_KLM_RE = re.compile(r"^[KLM]\d{7}[A-Z]$")
+_CIF_RE = re.compile(r"^[ABCDEFGHJNPQRSUVW]\d{7}[0-9A-J]$")
+
+# Nº de documento: alfanumérico con separadores habituales y al menos un dígito
+_DOC_NUMBER_RE = re.compile(r"^[A-Z0-9][A-Z0-9/\-\._ º°ª#]{0,29}$", re.IGNORECASE)
+# Prefijo que a veces se copia con el nº: "Nº", "N.º", "No.", "Núm.", "Número:", "#"
+_DOC_NUMBER_PREFIX_RE = re.compile(r"^(?:N\.?\s?[º°ª]|NO\.|N\.|N[ÚU]M(?:ERO)?[.:\s]|#)[\s.:]*", re.IGNORECASE)
+
+# Fechas plausibles de un documento recibido
+MAX_DOCUMENT_AGE_DAYS = 3 * 365
+MAX_FUTURE_DAYS = 7
+
+
+def normalize_nif(value: str) -> str:
+    """NIF en mayúsculas, sin separadores ni prefijo de país."""
+    nif = re.sub(r"[\s\-\.]", "", value.upper())
+    return nif[2:] if nif.startswith("ES") and len(nif) == 11 else nif
+
+
+def valid_nif(value: str | None) -> bool:
+    """Comprueba el dígito/letra de control de un NIF, NIE o CIF español."""
+    if not value:
+        return False
+    nif = normalize_nif(value)
+
+    if _DNI_RE.match(nif):
+        return _DNI_LETTERS[int(nif[:8]) % 23] == nif[8]
+    if _NIE_RE.match(nif):
+        number = str("XYZ".index(nif[0])) + nif[1:8]
+        return _DNI_LETTERS[int(number) % 23] == nif[8]
+    if _KLM_RE.match(nif):
+        return _DNI_LETTERS[int(nif[1:8]) % 23] == nif[8]
+    if _CIF_RE.match(nif):
+        digits = nif[1:8]
+        even = sum(int(d) for d in digits[1::2])
+        odd = sum(sum(divmod(int(d) * 2, 10)) for d in digits[0::2])
+        control = (10 - (even + odd) % 10) % 10
+        if nif[0] in "NPQRSW":
+            return nif[8] == _CIF_LETTERS[control]
+        if nif[0] in "ABEH":
+            return nif[8] == str(control)
+        return nif[8] in (str(control), _CIF_LETTERS[control])
+    return False
+
+
+def valid_document_number(value: str | None) -> bool:
+    """Nº de documento con formato plausible, admitiendo prefijos como "Nº" o "#"."""
+    if not value:
+        return False
+    number = _DOC_NUMBER_PREFIX_RE.sub("", value.strip())
+    return bool(_DOC_NUMBER_RE.match(number)) and any(ch.isdigit() for ch in number)
+
+
+def plausible_date(value: date | None, today: date | None = None) -> bool:
+    if value is None:
+        return False
+    today = today or date.today()
+    return today - timedelta(days=MAX_DOCUMENT_AGE_DAYS) <= value <= today + timedelta(days=MAX_FUTURE_DAYS)
+
+
+@dataclass
+class ValidationReport:
+    """Resultado de validar una página."""
+    errors: list[str] = field(default_factory=list)   # datos presentes pero inválidos
+    complete: bool = False   # todos los campos clave presentes y verificados
+
+
+class PageValidator:
+    """Valida los PageResult de visión contra reglas locales y el maestro de proveedores."""
+
+    def __init__(self, maestro: list[Supplier] | None = None, match_threshold: int = 80):
+        self.match_threshold = match_threshold
+        self._nifs = {normalize_nif(s.nif): s.nombre for s in maestro or [] if s.nif}
+        self._names = [s.nombre for s in maestro or [] if s.nombre]
+
+    def check(self, result: PageResult, today: date | None = None) -> ValidationReport:
+        report = ValidationReport()
+
+        if result.proveedor_nif and not valid_nif(result.proveedor_nif):
+            report.errors.append(f"NIF {result.proveedor_nif} con control incorrecto")
+        if result.fecha is not None and not plausible_date(result.fecha, today):
+            report.errors.append(f"fecha {result.fecha.isoformat()} fuera de rango")
+        for label, value in (
+            ("factura", result.numero_factura),
+            ("albarán", result.numero_albaran),
+            ("pedido", result.numero_pedido),
+        ):
+            if value and not valid_document_number(value):
+                report.errors.append(f"nº de {label} '{value}' con formato no válido")
+        bad_refs = [ref for ref in result.numeros_albaran_ref if not valid_document_number(ref)]
+        if bad_refs:
+            report.errors.append(f"albaranes referenciados no válidos: {bad_refs}")
+
+        if report.errors or result.tipo == TipoDocumento.DESCONOCIDO:
+            return report
+
+        number = result.numero_factura if result.tipo == TipoDocumento.FACTURA else result.numero_albaran
+        report.complete = (
+            self._known_supplier(result)
+            and valid_document_number(number)
+            and plausible_date(result.fecha, today)
+        )
+        return report
+
+    def supplier_name(self, nif: str | None) -> str | None:
+        """Nombre del proveedor del maestro con ese NIF (para resultados sin razón social)."""
+        return self._nifs.get(normalize_nif(nif)) if nif else None
+
+    def _known_supplier(self, result: PageResult) -> bool:
+        """Proveedor identificado: NIF en el maestro, nombre en el maestro o, sin maestro, NIF válido."""
+        if result.proveedor_nif and normalize_nif(result.proveedor_nif) in self._nifs:
+            return True
+        if result.proveedor and self._names:
+            match = fuzz_process.extractOne(result.proveedor.strip(), self._names)
+            if match is not None and match[1] >= self.match_threshold:
+                return True
+        return not self._nifs and not self._names and valid_nif(result.proveedor_nif)
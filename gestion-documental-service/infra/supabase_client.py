@@ -6,6 +6,7 @@ from pathlib import Path
 
 from supabase import create_client, Client
 
+from core.image_store import PageImageStore
 from core.models import Batch, Document, EstadoBatch
 
 logger = logging.getLogger(__name__)
@@ -52,10 +53,16 @@ class SupabaseSync:
 
         logger.info(f"Batch {batch.id[:8]} guardado en Supabase ({batch.total_documentos} docs)")
 
-    def upload_previews(self, batch_id: str, image_paths: list[str]) -> list[str]:
+    def upload_previews(
+        self,
+        batch_id: str,
+        image_paths: list[str],
+        store: PageImageStore | None = None,
+    ) -> list[str]:
         """Sube las imágenes de preview a Supabase Storage.
 
         Solo sube los PNGs de preview (ignora los _api.jpg que son para OpenAI).
+        Si se pasa el almacén de imágenes del lote, los PNG se leen de memoria.
 
         Returns:
             Lista de URLs públicas de las imágenes.
@@ -71,12 +78,16 @@ class SupabaseSync:
 
             storage_path = f"{batch_id}/{path.name}"
 
-            with open(image_path, "rb") as f:
-                self.client.storage.from_(bucket).upload(
-                    storage_path,
-                    f.read(),
-                    file_options={"content-type": "image/png"},
-                )
+            if store is not None and store.contains(image_path):
+                data = store.read(image_path)
+            else:
+                data = path.read_bytes()
+
+            self.client.storage.from_(bucket).upload(
+                storage_path,
+                data,
+                file_options={"content-type": "image/png"},
+            )
 
             url = self.client.storage.from_(bucket).get_public_url(storage_path)
             urls.append(url)
@@ -84,6 +95,14 @@ class SupabaseSync:
         logger.info(f"Subidas {len(urls)} previews para batch {batch_id[:8]}")
         return urls
 
+    def link_albaran(self, albaran_id: str, factura_id: str, ruta_destino: str) -> None:
+        """Asocia un albarán ya guardado a una factura de un lote posterior."""
+        self.client.table("doc_documents").update({
+            "factura_asociada_id": factura_id,
+            "ruta_destino": ruta_destino,
+            "fichero_nombre": Path(ruta_destino).name,
+        }).eq("id", albaran_id).execute()
+
     def log(self, batch_id: str, nivel: str, mensaje: str) -> None:
         """Inserta una entrada en el log de procesamiento."""
         self.client.table("doc_processing_log").insert({
@@ -106,7 +125,7 @@ class SupabaseSync:
         """Carga el maestro de proveedores."""
         response = (
             self.client.table("proveedores")
-            .select("codigo, nombre")
+            .select("*")
             .execute()
         )
         return response.data
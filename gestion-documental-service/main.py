@@ -2,10 +2,13 @@
 
 Modo one-shot: descarga PDFs pendientes de Supabase, los procesa y se cierra.
 Modo servicio (--watch): vigila continuamente carpeta local + Supabase.
+Modo diferido (--batch-submit / --batch-poll): one-shot con la Batch API de OpenAI.
 
 Uso:
   python main.py --config config.local.yaml          # one-shot: procesa pendientes y sale
   python main.py --config config.local.yaml --watch   # servicio continuo (como antes)
+  python main.py --config config.local.yaml --batch-submit  # envía pendientes a la Batch API
+  python main.py --config config.local.yaml --batch-poll    # recoge resultados y archiva
 """
 
 from __future__ import annotations
@@ -17,10 +20,11 @@ import time
 import threading
 from pathlib import Path
 
+from core.batch_mode import poll_batch_jobs, submit_batch_job
 from core.config import load_config
 from core.pipeline import process_pdf
 from core.watcher import start_watcher
-from core.supplier_lookup import Supplier, load_maestro_from_excel
+from core.supplier_lookup import Supplier, load_maestro_from_excel, suppliers_from_rows
 from infra.supabase_client import SupabaseSync
 
 # Configurar logging
@@ -43,6 +47,7 @@ def _parse_args():
     """Parsea argumentos de línea de comandos."""
     config_path = None
     watch_mode = False
+    batch_step = None  # "submit" | "poll"
 
     args = sys.argv[1:]
     i = 0
@@ -53,10 +58,16 @@ def _parse_args():
         elif args[i] == "--watch":
             watch_mode = True
             i += 1
+        elif args[i] == "--batch-submit":
+            batch_step = "submit"
+            i += 1
+        elif args[i] == "--batch-poll":
+            batch_step = "poll"
+            i += 1
         else:
             i += 1
 
-    return config_path, watch_mode
+    return config_path, watch_mode, batch_step
 
 
 def _load_maestro(config, supabase_sync) -> list[Supplier]:
@@ -73,11 +84,7 @@ def _load_maestro(config, supabase_sync) -> list[Supplier]:
 
     if not maestro and supabase_sync:
         try:
-            raw = supabase_sync.load_maestro_proveedores()
-            maestro = [
-                Supplier(codigo=r["codigo"], nombre=r["nombre"])
-                for r in raw if r.get("codigo") and r.get("nombre")
-            ]
+            maestro = suppliers_from_rows(supabase_sync.load_maestro_proveedores())
             logger.info(f"Maestro de proveedores: {len(maestro)} cargados desde Supabase")
         except Exception as e:
             logger.warning(f"Error cargando maestro: {e}")
@@ -93,20 +100,15 @@ def _create_folders(config):
             path.mkdir(parents=True, exist_ok=True)
 
 
-async def process_pending(config, supabase_sync, maestro) -> int:
-    """Descarga PDFs pendientes de Supabase y los procesa.
-
-    Returns:
-        Número de PDFs procesados.
-    """
+def _download_pending(config, supabase_sync) -> list[Path]:
+    """Descarga los PDFs pendientes de Supabase Storage a la carpeta de entrada."""
     entrada_dir = Path(config.paths.entrada).resolve()
-    processed = 0
+    downloaded = []
 
-    # 1. Descargar PDFs pendientes de Supabase Storage
     pending = supabase_sync.list_pending_uploads()
     if not pending:
         logger.info("No hay PDFs pendientes en Supabase")
-        return 0
+        return downloaded
 
     logger.info(f"Encontrados {len(pending)} PDFs pendientes en Supabase")
 
@@ -125,6 +127,22 @@ async def process_pending(config, supabase_sync, maestro) -> int:
 
         # Eliminar del bucket para no reprocesar
         supabase_sync.delete_upload(storage_path)
+        downloaded.append(local_path)
+
+    return downloaded
+
+
+async def process_pending(config, supabase_sync, maestro) -> int:
+    """Descarga PDFs pendientes de Supabase y los procesa.
+
+    Returns:
+        Número de PDFs procesados.
+    """
+    processed = 0
+
+    # 1. Descargar PDFs pendientes de Supabase Storage
+    for local_path in _download_pending(config, supabase_sync):
+        name = local_path.name
 
         # 2. Procesar el PDF
         try:
@@ -173,6 +191,28 @@ def run_oneshot(config, supabase_sync, maestro):
     return count
 
 
+def run_batch_submit(config, supabase_sync):
+    """Modo diferido, paso 1: envía pendientes (Supabase + entrada local) a la Batch API."""
+    logger.info("=== Batch API: enviando pendientes ===")
+
+    entrada_dir = Path(config.paths.entrada).resolve()
+    local_pdfs = list(entrada_dir.glob("*.pdf"))
+    downloaded = _download_pending(config, supabase_sync) if supabase_sync else []
+    pdfs = downloaded + [pdf for pdf in local_pdfs if pdf not in downloaded]
+
+    manifest = asyncio.run(submit_batch_job(pdfs, config))
+    if manifest:
+        logger.info(f"=== Trabajo enviado: {manifest.name}. Recoger con --batch-poll ===")
+
+
+def run_batch_poll(config, supabase_sync, maestro):
+    """Modo diferido, paso 2: recoge resultados de la Batch API y termina los lotes."""
+    logger.info("=== Batch API: recogiendo resultados ===")
+    count = asyncio.run(poll_batch_jobs(config, maestro, supabase_sync))
+    logger.info(f"=== Finalizado: {count} PDFs procesados ===")
+    return count
+
+
 def poll_supabase_uploads(supabase_sync: SupabaseSync, entrada_dir: Path, interval: int = 10):
     """Hilo que comprueba Supabase Storage cada N segundos."""
     logger.info(f"Poller de uploads iniciado (cada {interval}s)")
@@ -261,7 +301,7 @@ def run_watch(config, supabase_sync, maestro):
 
 
 def main():
-    config_path, watch_mode = _parse_args()
+    config_path, watch_mode, batch_step = _parse_args()
     config = load_config(config_path)
 
     if not config.openai.api_key:
@@ -280,7 +320,11 @@ def main():
     maestro = _load_maestro(config, supabase_sync)
     _create_folders(config)
 
-    if watch_mode:
+    if batch_step == "submit":
+        run_batch_submit(config, supabase_sync)
+    elif batch_step == "poll":
+        run_batch_poll(config, supabase_sync, maestro)
+    elif watch_mode:
         run_watch(config, supabase_sync, maestro)
     else:
         # One-shot: procesar y salir
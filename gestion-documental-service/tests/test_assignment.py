@@ -0,0 +1,85 @@
+"""Asignación óptima de albaranes a facturas (modo `optimal`)."""
+
+from datetime import date
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from core.assignment import (  # noqa: E402
+    W_DIGITS, W_EXACT, W_OVERLAP, W_PARTIAL, _reference_scores, assign_delivery_notes,
+)
+from core.models import Document, TipoDocumento  # noqa: E402
+
+
+def _factura(numero, refs, nif="B12345674", fecha=None):
+    return Document(
+        tipo=TipoDocumento.FACTURA, numero_factura=numero, numeros_albaran_ref=refs,
+        proveedor_nif=nif, fecha_documento=fecha,
+    )
+
+
+def _albaran(numero, nif="B12345674", fecha=None):
+    return Document(
+        tipo=TipoDocumento.ALBARAN, numero_albaran=numero, proveedor_nif=nif, fecha_documento=fecha,
+    )
+
+
+def test_reference_score_tiers():
+    scores = _reference_scores(
+        ["ALB-27780", "27780", "2778", "1234567"],
+        ["alb 27780", "X27780", "ALB27780/B1", "9934567"],
+    )
+    assert scores[0, 0] == W_EXACT                # exacto normalizado
+    assert scores[1, 1] == W_DIGITS               # mismos dígitos
+    assert W_PARTIAL < scores[0, 2] < W_DIGITS    # contenido en la referencia
+    assert W_OVERLAP < scores[3, 3] < W_PARTIAL   # sufijo de dígitos en común (5)
+    assert scores[2, 3] == 0
+
+
+def test_long_numbers_do_not_jump_tiers():
+    long_number = "PEDIDO-" + "7" * 60
+    scores = _reference_scores(
+        [long_number, "1" * 60],
+        [long_number + "-B1", "9" + "1" * 59, "1" * 60 + "X"],
+    )
+    partial, overlap = scores[0, 0], scores[1, 1]
+    assert W_PARTIAL < partial < W_DIGITS
+    assert W_OVERLAP < overlap < W_PARTIAL
+    assert scores[1, 2] == W_DIGITS
+
+
+def test_optimal_assignment_avoids_greedy_steal():
+    # El voraz da "2778" a la primera factura que lo contiene, aunque su
+    # única referencia es la del albarán 27780
+    f1 = _factura("F-1", ["27780"])
+    f2 = _factura("F-2", ["99-2778"])
+    a_partial = _albaran("2778")
+    a_exact = _albaran("27780")
+
+    assign_delivery_notes([f1, f2, a_partial, a_exact])
+
+    assert a_exact.factura_asociada_id == f1.id
+    assert a_partial.factura_asociada_id == f2.id
+
+
+def test_each_reference_takes_one_albaran():
+    factura = _factura("F-1", ["5001"])
+    first, second = _albaran("5001"), _albaran("5001")
+    audit = []
+
+    assign_delivery_notes([factura, first, second], audit)
+
+    assert [pair.metodo for pair in audit] == ["numero", "mismo proveedor"]
+
+
+def test_provider_fallback_uses_nearest_date():
+    cerca = _factura("F-1", [], fecha=date(2024, 3, 10))
+    lejos = _factura("F-2", [], fecha=date(2024, 1, 5))
+    otro = _factura("F-3", [], nif="A58818501", fecha=date(2024, 3, 12))
+    albaran = _albaran("9999", fecha=date(2024, 3, 12))
+
+    assign_delivery_notes([cerca, lejos, otro, albaran])
+
+    assert albaran.factura_asociada_id == cerca.id
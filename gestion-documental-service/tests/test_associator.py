@@ -0,0 +1,82 @@
+"""Asociación de albaranes con facturas por niveles (`FacturaIndex`)."""
+
+from datetime import date
+
+from core.associator import FacturaIndex, associate_delivery_notes, reference_keys
+from core.models import Document, TipoDocumento
+
+
+def _factura(numero, refs=(), nif=None, nombre=None, fecha=None):
+    return Document(
+        tipo=TipoDocumento.FACTURA, numero_factura=numero, numeros_albaran_ref=list(refs),
+        proveedor_nif=nif, proveedor_nombre=nombre, fecha_documento=fecha,
+    )
+
+
+def _albaran(numero, nif=None, nombre=None, fecha=None):
+    return Document(
+        tipo=TipoDocumento.ALBARAN, numero_albaran=numero,
+        proveedor_nif=nif, proveedor_nombre=nombre, fecha_documento=fecha,
+    )
+
+
+def _find(facturas, albaran):
+    match, method = FacturaIndex(facturas).find(albaran)
+    return (match.numero_factura if match else None), method
+
+
+def test_exact_match_ignores_separators_and_case():
+    facturas = [_factura("F-1", ["9999"]), _factura("F-2", ["alb 2024/0015"])]
+    assert _find(facturas, _albaran("ALB-2024-0015")) == ("F-2", "match exacto")
+
+
+def test_partial_match_takes_first_factura():
+    facturas = [_factura("F-1", ["X-27780-B"]), _factura("F-2", ["27780-C"])]
+    assert _find(facturas, _albaran("27780")) == ("F-1", "match exacto")
+    # La referencia contenida en el nº del albarán
+    assert _find([_factura("F-3", ["A1"]), _factura("F-4", ["B77"])], _albaran("XB77Y")) == ("F-4", "match exacto")
+
+
+def test_digits_match():
+    facturas = [_factura("F-1", ["ALB 555"]), _factura("F-2", ["Nº 27780"])]
+    assert _find(facturas, _albaran("27_780")) == ("F-2", "match numerico")
+
+
+def test_digits_match_by_containment_and_suffix():
+    facturas = [_factura("F-1", ["12-2770"]), _factura("F-2", ["9-127780"])]
+    # Dígitos del albarán contenidos en la referencia
+    assert _find(facturas, _albaran("X127780")) == ("F-2", "match numerico")
+    # Sufijo común de al menos 4 dígitos; gana el más largo
+    assert _find(facturas, _albaran("Z-8812770")) == ("F-1", "match numerico")
+    assert _find([_factura("F-3", ["A-55-1234"])], _albaran("Z-991234")) == ("F-3", "match numerico")
+
+
+def test_short_numbers_do_not_match_by_digits():
+    assert _find([_factura("F-1", ["ZZ-12"])], _albaran("A-12")) == (None, "")
+
+
+def test_provider_fallback():
+    facturas = [
+        _factura("F-1", nif="B12345674", fecha=date(2024, 1, 5)),
+        _factura("F-2", nombre="Suministros Norte SL", fecha=date(2024, 3, 10)),
+    ]
+    assert _find(facturas, _albaran("9999", nif="b12345674 ")) == ("F-1", "mismo proveedor")
+    assert _find(facturas, _albaran("9999", nombre="suministros norte")) == ("F-2", "mismo proveedor")
+    # Varias facturas del proveedor: la de fecha más cercana (máximo 30 días)
+    facturas.append(_factura("F-3", nombre="Suministros Norte SL", fecha=date(2024, 1, 20)))
+    assert _find(facturas, _albaran("9999", nombre="Suministros Norte SL", fecha=date(2024, 3, 1)))[0] == "F-2"
+    assert _find(facturas, _albaran("9999", nombre="Suministros Norte SL", fecha=date(2024, 6, 1)))[0] is None
+    assert _find(facturas, _albaran("9999", nombre="Suministros Norte SL"))[0] is None
+
+
+def test_associate_delivery_notes_sets_factura():
+    factura = _factura("F-1", ["27780"])
+    albaran, sin_numero = _albaran("27780"), _albaran(None)
+    associate_delivery_notes([factura, albaran, sin_numero])
+    assert albaran.factura_asociada_id == factura.id
+    assert sin_numero.factura_asociada_id is None
+
+
+def test_reference_keys():
+    assert reference_keys("alb-2024/15") == ("ALB202415", "202415")
+    assert reference_keys("A-12") == ("A12", "")
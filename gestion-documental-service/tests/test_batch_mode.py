@@ -0,0 +1,84 @@
+"""Preparación del JSONL de la Batch API (custom_id por PDF y página)."""
+
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("fitz")
+
+from core import batch_mode  # noqa: E402
+from core.config import AppConfig  # noqa: E402
+
+
+@pytest.fixture
+def errores():
+    return []
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch, errores):
+    config = AppConfig()
+    config.processing.batch_dir = str(tmp_path / "batch_jobs")
+    config.processing.text_layer_mode = "off"
+
+    monkeypatch.setattr(batch_mode, "move_to_processing", lambda path, config: path)
+    monkeypatch.setattr(batch_mode, "move_to_errors", lambda path, config: errores.append(path.name))
+    monkeypatch.setattr(
+        batch_mode, "split_pdf_to_images",
+        lambda pdf_path, output_dir, **kwargs: [f"{output_dir}/{pdf_path.stem}_{n}.jpg" for n in (1, 2, 3)],
+    )
+    monkeypatch.setattr(batch_mode, "resolve_page_locally", lambda *args: None)
+    monkeypatch.setattr(batch_mode, "_client", lambda config: None)
+    return config
+
+
+def _submit(config, monkeypatch, pdf_names, fail_on):
+    """Envía los PDFs y devuelve (manifiesto, custom_ids del JSONL enviado)."""
+    async def build_page_request(page_number, image_path, *args):
+        if image_path.endswith(fail_on):
+            raise RuntimeError("página ilegible")
+        return {"image": image_path}
+
+    sent = []
+
+    async def submit_requests(client, requests_path):
+        with open(requests_path, encoding="utf-8") as f:
+            sent.extend(json.loads(line) for line in f)
+        return ["batch_1"]
+
+    monkeypatch.setattr(batch_mode, "build_page_request", build_page_request)
+    monkeypatch.setattr(batch_mode, "_submit_requests", submit_requests)
+
+    manifest_path = asyncio.run(batch_mode.submit_batch_job(pdf_names, config))
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f), sent
+
+
+def test_failed_pdf_leaves_no_requests(tmp_path, config, errores, monkeypatch):
+    pdfs = [tmp_path / f"{name}.pdf" for name in ("a", "roto", "c")]
+    # El PDF roto falla en su última página, con dos líneas ya preparadas
+    manifest, sent = _submit(config, monkeypatch, pdfs, fail_on="roto_3.jpg")
+
+    assert errores == ["roto.pdf"]
+    assert [pdf["nombre"] for pdf in manifest["pdfs"]] == ["a.pdf", "c.pdf"]
+
+    custom_ids = [line["custom_id"] for line in sent]
+    assert len(custom_ids) == len(set(custom_ids)) == 6
+    # Cada custom_id apunta al PDF del manifiesto del que salió su imagen
+    for line in sent:
+        pdf_index, page_number, fase = map(int, line["custom_id"].split(":"))
+        assert fase == batch_mode.FASE_PAGINAS
+        assert line["body"]["image"].endswith(
+            f"{manifest['pdfs'][pdf_index]['nombre'][:-4]}_{page_number}.jpg"
+        )
+
+
+def test_request_count_matches_lines(tmp_path, config, monkeypatch):
+    pdfs = [tmp_path / f"{name}.pdf" for name in ("a", "b")]
+    manifest, sent = _submit(config, monkeypatch, pdfs, fail_on="nunca")
+
+    assert [pdf["peticiones"] for pdf in manifest["pdfs"]] == [3, 3]
+    assert len(sent) == 6
+    assert manifest["trabajos"] == ["batch_1"]
@@ -0,0 +1,70 @@
+"""Clasificar primero: huecos del limitador y continuaciones sin extracción."""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("fitz")
+pytest.importorskip("openai")
+
+from core import analyzer  # noqa: E402
+from core.models import PageResult, TipoDocumento  # noqa: E402
+from core.rate_limiter import AdaptiveLimiter  # noqa: E402
+
+
+def _page(page_number, origen, continuation=False, refs=()):
+    return PageResult(
+        page_number=page_number,
+        tipo=TipoDocumento.FACTURA,
+        proveedor="Suministros Norte SL",
+        numeros_albaran_ref=list(refs),
+        es_continuacion_anterior=continuation,
+        confianza=0.95,
+        origen=origen,
+    )
+
+
+def test_classified_continuation_is_not_escalated():
+    assert not analyzer.needs_high_detail(_page(2, analyzer.ORIGEN_CLASIFICACION, continuation=True))
+    # Una factura extraída sin albaranes sí sube
+    assert analyzer.needs_high_detail(_page(1, analyzer.ORIGEN_VISION))
+    assert not analyzer.needs_high_detail(_page(1, analyzer.ORIGEN_VISION, refs=["A-1"]))
+
+
+def test_one_limiter_slot_per_request(monkeypatch):
+    limiter = AdaptiveLimiter(max_limit=1, initial=1)
+    in_flight = []
+
+    async def classify_pages(client, pages, *args):
+        in_flight.append(limiter.in_flight)
+        return [
+            _page(n, analyzer.ORIGEN_CLASIFICACION, continuation=(n == 2))
+            for n, _ in pages
+        ]
+
+    async def analyze_single_page(client, image_path, page_number, *args, **kwargs):
+        in_flight.append(limiter.in_flight)
+        await asyncio.sleep(0)
+        return _page(page_number, analyzer.ORIGEN_VISION, refs=["A-1"])
+
+    monkeypatch.setattr(analyzer, "_classify_pages", classify_pages)
+    monkeypatch.setattr(analyzer, "_analyze_single_page", analyze_single_page)
+
+    async def run():
+        # Como flush_vision: se entra con el hueco de la clasificación tomado
+        await limiter.acquire()
+        pages = [(n, f"p{n}.png") for n in (1, 2, 3)]
+        return await asyncio.wait_for(
+            analyzer._classify_then_extract(None, pages, "gpt-4o-mini", 30, 1, limiter=limiter),
+            timeout=5,
+        )
+
+    results = asyncio.run(run())
+
+    # Clasificación + una extracción por tramo (págs 1 y 3), cada una con su hueco
+    assert in_flight == [1, 1, 1]
+    assert limiter.in_flight == 0
+    assert [r.origen for r in results] == [
+        analyzer.ORIGEN_VISION, analyzer.ORIGEN_CLASIFICACION, analyzer.ORIGEN_VISION,
+    ]
@@ -0,0 +1,46 @@
+"""Carga de la configuración: rutas de los ficheros de estado."""
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+from core.config import load_config  # noqa: E402
+
+
+def _load(tmp_path, processing: str):
+    config_dir = tmp_path / "servicio"
+    config_dir.mkdir(exist_ok=True)
+    config_path = config_dir / "config.yaml"
+    config_path.write_text(f"processing:\n{processing}", encoding="utf-8")
+    return load_config(config_path), config_dir
+
+
+def test_relative_paths_resolve_next_to_the_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config, config_dir = _load(
+        tmp_path,
+        '  cache_path: "estado/page_cache.sqlite"\n'
+        '  templates_path: "estado/supplier_templates.sqlite"\n'
+        '  associations_path: "estado/pending_associations.sqlite"\n',
+    )
+    assert config.processing.cache_path == str(config_dir / "estado" / "page_cache.sqlite")
+    assert config.processing.templates_path == str(config_dir / "estado" / "supplier_templates.sqlite")
+    assert config.processing.associations_path == str(config_dir / "estado" / "pending_associations.sqlite")
+
+
+def test_default_paths_resolve_next_to_the_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config, config_dir = _load(tmp_path, "  dpi: 200\n")
+    assert config.processing.cache_path == str(config_dir / "page_cache.sqlite")
+    assert config.processing.templates_path == ""
+    assert config.processing.associations_path == ""
+    assert config.processing.batch_dir == str(config_dir / "batch_jobs")
+
+
+def test_absolute_and_disabled_paths_are_kept(tmp_path):
+    absolute = tmp_path / "otra" / "page_cache.sqlite"
+    config, _ = _load(tmp_path, f'  cache_path: "{absolute.as_posix()}"\n')
+    assert config.processing.cache_path == str(absolute)
+
+    config, _ = _load(tmp_path, '  cache_path: ""\n')
+    assert config.processing.cache_path == ""
@@ -0,0 +1,144 @@
+"""Etapa final por documento: fallos aislados y marcados para revisión."""
+
+import asyncio
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("thefuzz")
+
+from core import archiver, downstream  # noqa: E402
+from core.config import AppConfig, PathsConfig, ProcessingConfig  # noqa: E402
+from core.models import Document, EstadoDocumento, TipoDocumento  # noqa: E402
+from core.supplier_lookup import Supplier  # noqa: E402
+
+MAESTRO = [Supplier("P001", "Suministros Norte SL")]
+
+
+@pytest.fixture
+def scan(tmp_path):
+    path = tmp_path / "scan.pdf"
+    with fitz.open() as doc:
+        for _ in range(6):
+            doc.new_page()
+        doc.save(str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def lookup(monkeypatch):
+    """Lookup exacto por nombre; `failing` lo hace fallar para esos documentos."""
+    def lookup_supplier(doc, maestro, threshold):
+        if doc in lookup_supplier.failing:
+            raise RuntimeError("maestro corrupto")
+        codes = {s.nombre: s.codigo for s in maestro}
+        doc.proveedor_codigo = codes.get(doc.proveedor_nombre)
+        return doc.proveedor_codigo is not None
+
+    lookup_supplier.failing = []
+    monkeypatch.setattr(downstream, "lookup_supplier", lookup_supplier)
+    return lookup_supplier
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.setattr(downstream, "ARCHIVE_BACKOFF", 0)
+    return AppConfig(
+        paths=PathsConfig(salida=str(tmp_path / "salida"), pendientes=str(tmp_path / "pendientes")),
+        processing=ProcessingConfig(downstream_workers=2, archive_retries=1),
+    )
+
+
+def _batch():
+    factura = Document(
+        tipo=TipoDocumento.FACTURA, numero_factura="F-1", proveedor_nombre="Suministros Norte SL",
+        paginas=[1, 2], estado=EstadoDocumento.OK,
+    )
+    albaran = Document(
+        tipo=TipoDocumento.ALBARAN, numero_albaran="27780", paginas=[3],
+        factura_asociada_id=factura.id, estado=EstadoDocumento.OK,
+    )
+    suelto = Document(
+        tipo=TipoDocumento.ALBARAN, numero_albaran="31000", proveedor_nombre="Suministros Norte SL",
+        paginas=[4, 5], estado=EstadoDocumento.OK,
+    )
+    return factura, albaran, suelto
+
+
+def _process(docs, scan, tmp_path, config):
+    return asyncio.run(downstream.process_documents(
+        docs, scan, tmp_path / "merged", config, maestro=MAESTRO,
+    ))
+
+
+def test_all_documents_archived(scan, tmp_path, config):
+    factura, albaran, suelto = _batch()
+    assert _process([factura, albaran, suelto], scan, tmp_path, config) == []
+
+    assert factura.proveedor_codigo == "P001"
+    with fitz.open(factura.ruta_destino) as pdf:
+        assert pdf.page_count == 3
+    assert suelto.ruta_destino.startswith(config.paths.salida)
+    assert albaran.ruta_destino is None
+
+
+def test_lookup_failure_archives_for_review(scan, tmp_path, config, lookup):
+    factura, albaran, suelto = _batch()
+    lookup.failing.append(factura)
+    failures = _process([factura, albaran, suelto], scan, tmp_path, config)
+
+    assert [(f.doc, f.paso) for f in failures] == [(factura, "lookup")]
+    assert factura.ruta_destino.startswith(config.paths.pendientes)
+    assert factura.estado == albaran.estado == EstadoDocumento.REVISAR
+    assert suelto.estado == EstadoDocumento.OK
+
+
+def test_merge_failure_marks_attached_albaranes(scan, tmp_path, config, monkeypatch):
+    factura, albaran, suelto = _batch()
+    real_merge = downstream.merge_document
+
+    def merge(doc, *args):
+        if doc is factura:
+            raise RuntimeError("página dañada")
+        return real_merge(doc, *args)
+
+    monkeypatch.setattr(downstream, "merge_document", merge)
+    failures = _process([factura, albaran, suelto], scan, tmp_path, config)
+
+    assert [(f.doc, f.paso) for f in failures] == [(factura, "merge")]
+    assert factura.ruta_destino is None
+    assert factura.estado == albaran.estado == EstadoDocumento.REVISAR
+    assert suelto.ruta_destino is not None
+
+
+def test_archive_retries_network_errors(scan, tmp_path, config, monkeypatch):
+    factura, albaran, suelto = _batch()
+    real_move = archiver.shutil.move
+    attempts = []
+
+    def move(src, dst):
+        attempts.append(dst)
+        if "31000" in dst or len(attempts) == 1:
+            raise OSError("recurso compartido no disponible")
+        return real_move(src, dst)
+
+    monkeypatch.setattr(archiver.shutil, "move", move)
+    failures = _process([factura, suelto], scan, tmp_path, config)
+
+    assert [(f.doc, f.paso) for f in failures] == [(suelto, "archive")]
+    assert suelto.estado == EstadoDocumento.REVISAR
+    assert factura.ruta_destino is not None
+
+
+def test_lookup_skipped_only_for_documents_already_looked_up(scan, tmp_path, config, lookup):
+    factura, albaran, suelto = _batch()
+    # El de la factura ya se hizo en línea; el del suelto falló y se repite aquí
+    lookup.failing.extend([factura, suelto])
+    failures = asyncio.run(downstream.process_documents(
+        [factura, albaran, suelto], scan, tmp_path / "merged", config,
+        maestro=MAESTRO, looked_up={factura.id},
+    ))
+
+    assert [(f.doc, f.paso) for f in failures] == [(suelto, "lookup")]
+    assert factura.estado == albaran.estado == EstadoDocumento.OK
+    assert suelto.ruta_destino.startswith(config.paths.pendientes)
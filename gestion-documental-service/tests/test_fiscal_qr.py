@@ -0,0 +1,87 @@
+"""Facturas con QR VeriFactu/TicketBAI: lectura del QR y paso por la cascada."""
+
+import json
+from datetime import date
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("fitz")
+pytest.importorskip("openai")
+
+from core.analyzer import (  # noqa: E402
+    ORIGEN_CODIGO, _code_page_result, _retry_result, _wants_region, needs_high_detail,
+)
+from core.barcodes import parse_fiscal_qr  # noqa: E402
+from core.models import TipoDocumento  # noqa: E402
+
+VERIFACTU = (
+    "https://www2.agenciatributaria.gob.es/wlpl/TIKE-CONT/ValidarQR"
+    "?nif=B12345674&numserie=F2024-0001&fecha=15-03-2024&importe=121.00"
+)
+TICKETBAI = (
+    "https://batuz.eus/QRTBAI/?id=TBAI-B12345674-150324-abcdefghijklm-123"
+    "&s=A&nf=0042&i=60.50&cr=123"
+)
+
+
+def test_verifactu():
+    data = parse_fiscal_qr(VERIFACTU)
+    assert data["tipo"] == "factura"
+    assert data["proveedor_nif"] == "B12345674"
+    assert data["numero_factura"] == "F2024-0001"
+    assert data["fecha"] == "2024-03-15"
+    assert data["importe"] == "121.00"
+    assert data["numeros_albaran_referenciados"] == []
+
+
+def test_ticketbai_joins_series_and_number():
+    data = parse_fiscal_qr(TICKETBAI)
+    assert data["proveedor_nif"] == "B12345674"
+    assert data["numero_factura"] == "A0042"
+    assert data["fecha"] == "2024-03-15"
+
+
+@pytest.mark.parametrize("value", [
+    "no es una url",
+    "https://example.com/?nif=B12345674&numserie=1&fecha=15-03-2024",
+    VERIFACTU.replace("15-03-2024", "31-02-2024"),
+    VERIFACTU.replace("&numserie=F2024-0001", ""),
+])
+def test_rejects_other_or_incomplete_codes(value):
+    assert parse_fiscal_qr(value) is None
+
+
+def test_qr_invoice_goes_up_the_cascade_for_references():
+    result = _code_page_result(parse_fiscal_qr(VERIFACTU), 1, "p1.png")
+    assert result.origen == ORIGEN_CODIGO
+    assert needs_high_detail(result)
+    # Le falta también el proveedor: página entera, no el recorte de la tabla
+    assert not _wants_region(result)
+
+    result.numeros_albaran_ref = ["A-1001"]
+    assert not needs_high_detail(result)
+
+
+def test_page_retry_keeps_qr_fields():
+    qr = _code_page_result(parse_fiscal_qr(VERIFACTU), 1, "p1.png")
+    answer = json.dumps({
+        "tipo": "albaran",
+        "proveedor": "Suministros Norte SL",
+        "proveedor_nif": "B99999999",
+        "numero_factura": "F2024-0007",
+        "numeros_albaran_referenciados": ["A-1001", "A-1002"],
+        "fecha": "2024-01-01",
+        "es_continuacion_anterior": True,
+        "confianza": 0.6,
+    })
+    result = _retry_result(answer, qr)
+
+    assert result.tipo == TipoDocumento.FACTURA
+    assert result.proveedor == "Suministros Norte SL"
+    assert result.numeros_albaran_ref == ["A-1001", "A-1002"]
+    assert result.proveedor_nif == "B12345674"
+    assert result.numero_factura == "F2024-0001"
+    assert result.fecha == date(2024, 3, 15)
+    assert not result.es_continuacion_anterior
+    assert result.origen == ORIGEN_CODIGO
@@ -0,0 +1,65 @@
+"""Agrupación en línea de páginas en documentos (`OnlineGrouper`)."""
+
+from core.grouper import OnlineGrouper, group_pages_into_documents
+from core.models import EstadoDocumento, PageResult, TipoDocumento
+
+
+def _page(n, tipo=TipoDocumento.FACTURA, cont=False, confianza=0.95, **kw):
+    return PageResult(page_number=n, tipo=tipo, es_continuacion_anterior=cont, confianza=confianza, **kw)
+
+
+def test_add_returns_previous_document_when_next_starts():
+    grouper = OnlineGrouper()
+    assert grouper.add(_page(1, proveedor="ACME", numero_factura="F1")) is None
+    assert grouper.add(_page(2, cont=True, numeros_albaran_ref=["A1"])) is None
+    done = grouper.add(_page(3, tipo=TipoDocumento.ALBARAN, proveedor="ACME", numero_albaran="A1"))
+    assert done.paginas == [1, 2]
+    assert done.numeros_albaran_ref == ["A1"]
+    assert done.estado == EstadoDocumento.OK
+
+    last = grouper.finish()
+    assert last.paginas == [3]
+    assert grouper.documents == [done, last]
+
+
+def test_blank_pages_follow_current_document_or_are_dropped():
+    pages = [
+        _page(1, es_blanco=True),
+        _page(2, proveedor="ACME", numero_factura="F1"),
+        _page(3, es_blanco=True, confianza=0.0),
+        _page(4, cont=True),
+    ]
+    doc, = group_pages_into_documents(pages)
+    assert doc.paginas == [2, 3, 4]
+    # La página en blanco no cuenta en la confianza media
+    assert doc.confianza == 0.95
+
+    doc, = group_pages_into_documents([_page(1, proveedor="ACME", numero_factura="F1"),
+                                       _page(2, es_blanco=True)], drop_blank_pages=True)
+    assert doc.paginas == [1]
+
+
+def test_continuation_with_own_number_starts_new_document():
+    docs = group_pages_into_documents([
+        _page(1, proveedor="ACME", numero_factura="F1"),
+        _page(2, cont=True, numero_factura="F2"),
+    ])
+    assert [d.numero_factura for d in docs] == ["F1", "F2"]
+
+
+def test_headerless_low_confidence_page_becomes_continuation():
+    docs = group_pages_into_documents([
+        _page(1, proveedor="ACME", numero_factura="F1"),
+        _page(2, confianza=0.5),
+    ], confidence_threshold=0.7)
+    assert len(docs) == 1
+    assert docs[0].confianza == (0.95 + 0.5) / 2
+
+
+def test_review_state():
+    docs = group_pages_into_documents([
+        _page(1, proveedor="ACME", numero_factura="F1", confianza=0.6),
+        _page(2, proveedor="ACME"),  # factura sin número
+        _page(3, tipo=TipoDocumento.DESCONOCIDO, proveedor="ACME"),
+    ])
+    assert [d.estado for d in docs] == [EstadoDocumento.REVISAR] * 3
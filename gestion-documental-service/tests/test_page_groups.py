@@ -0,0 +1,101 @@
+"""Varias páginas por llamada y caché de resultados."""
+
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("fitz")
+pytest.importorskip("openai")
+
+from core import analyzer  # noqa: E402
+from core.result_cache import PageResultCache  # noqa: E402
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Sustituye la imagen y la API: cada llamada queda registrada con sus páginas."""
+    calls = []
+
+    async def encode_image(image_path, store=None):
+        return f"imagen-{image_path}"
+
+    async def complete_json(client, messages, page_number, model, timeout, max_retries, max_tokens=500, **kwargs):
+        pages = [
+            int(part["text"].split()[1].rstrip(":"))
+            for part in messages[1]["content"]
+            if part["type"] == "text" and part["text"].startswith("Página ")
+        ] or [page_number]
+        calls.append(pages)
+        answer = [{"tipo": "factura", "numero_factura": f"F{n}", "confianza": 0.9} for n in pages]
+        return json.dumps({"paginas": answer} if len(pages) > 1 else answer[0])
+
+    monkeypatch.setattr(analyzer, "_encode_image", encode_image)
+    monkeypatch.setattr(analyzer, "_get_api_image_path", lambda path, store=None: path)
+    monkeypatch.setattr(analyzer, "_complete_json", complete_json)
+    return calls
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = PageResultCache(tmp_path / "cache.sqlite")
+    yield cache
+    cache.close()
+
+
+def _group(pages, cache):
+    return asyncio.run(analyzer._analyze_page_group(
+        None, [(n, f"p{n}.png") for n in pages], "gpt-4o-mini", 30, 1, cache=cache,
+    ))
+
+
+def _single(page_number, cache):
+    return asyncio.run(analyzer._analyze_single_page(
+        None, f"p{page_number}.png", page_number, "gpt-4o-mini", 30, 1, cache=cache,
+    ))
+
+
+def test_group_served_from_cache(api, cache):
+    first = _group([1, 2, 3], cache)
+    again = _group([1, 2, 3], cache)
+
+    assert api == [[1, 2, 3]]
+    assert [r.numero_factura for r in again] == [r.numero_factura for r in first] == ["F1", "F2", "F3"]
+
+
+def test_group_results_do_not_answer_single_pages(api, cache):
+    _group([1, 2, 3], cache)
+    _single(2, cache)
+    # Ni a la misma página en otro grupo
+    _group([3, 4], cache)
+
+    assert api == [[1, 2, 3], [2], [3, 4]]
+
+
+def test_pages_cached_alone_split_the_group(api, cache):
+    _single(2, cache)
+    _single(5, cache)
+    results = _group([1, 2, 3, 4, 5, 6], cache)
+
+    # Tramos consecutivos alrededor de las páginas en caché
+    assert api == [[2], [5], [1], [3, 4], [6]]
+    assert [r.page_number for r in results] == [1, 2, 3, 4, 5, 6]
+
+
+def _classify(pages, cache):
+    return asyncio.run(analyzer._classify_pages(
+        None, [(n, f"p{n}.png") for n in pages], "gpt-4o-mini", 30, 1, cache=cache,
+    ))
+
+
+def test_classification_cached_per_run(api, cache):
+    _classify([1, 2], cache)
+    _classify([1, 2], cache)
+    assert api == [[1, 2]]
+
+    # Págs. 2 y 3 ya clasificadas, pero en otros tramos: sus flags de
+    # continuación no valen para este
+    _classify([3, 4], cache)
+    _classify([2, 3], cache)
+    assert api == [[1, 2], [3, 4], [2, 3]]
@@ -0,0 +1,134 @@
+"""Asociación de albaranes y facturas entre lotes."""
+
+import pytest
+
+pytest.importorskip("fitz")
+
+from core import pending_associations  # noqa: E402
+from core.models import Document, TipoDocumento  # noqa: E402
+from core.pending_associations import PendingAssociationStore, link_across_batches  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = PendingAssociationStore(tmp_path / "pending.sqlite")
+    yield store
+    store.close()
+
+
+class FakeAppend:
+    """Sustituye la unión de PDFs; con `fail` falla como un corte del recurso compartido."""
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def __call__(self, target, source):
+        if self.fail:
+            raise OSError("recurso compartido no disponible")
+        self.calls.append((str(target), str(source)))
+
+
+@pytest.fixture
+def appended(monkeypatch):
+    fake = FakeAppend()
+    monkeypatch.setattr(pending_associations, "append_pdf", fake)
+    return fake
+
+
+def _archived(tmp_path, name, **fields):
+    path = tmp_path / name
+    path.write_bytes(b"%PDF-1.4")
+    return Document(ruta_destino=str(path), proveedor_nif="B12345674", **fields)
+
+
+def test_albaran_waits_for_a_later_factura(tmp_path, store, appended):
+    albaran = _archived(tmp_path, "ALB - 27780.pdf", tipo=TipoDocumento.ALBARAN, numero_albaran="27780")
+    assert link_across_batches([albaran], store) == []
+
+    factura = _archived(
+        tmp_path, "FAC - F-1.pdf", tipo=TipoDocumento.FACTURA, numero_factura="F-1",
+        numeros_albaran_ref=["ALB-27780"],
+    )
+    late = link_across_batches([factura], store)
+
+    assert [(link.albaran_id, link.factura_id) for link in late] == [(albaran.id, factura.id)]
+    assert appended.calls == [(factura.ruta_destino, albaran.ruta_destino)]
+    assert store.find_albaran("27780", "B12345674") is None
+
+
+def test_failed_append_keeps_the_albaran_pending(tmp_path, store, appended):
+    albaran = _archived(tmp_path, "ALB - 27780.pdf", tipo=TipoDocumento.ALBARAN, numero_albaran="27780")
+    link_across_batches([albaran], store)
+    factura = _archived(
+        tmp_path, "FAC - F-1.pdf", tipo=TipoDocumento.FACTURA, numero_factura="F-1",
+        numeros_albaran_ref=["27780"],
+    )
+
+    appended.fail = True
+    assert link_across_batches([factura], store) == []
+    assert store.find_albaran("27780", "B12345674")[0] == albaran.id
+
+    # Un lote posterior que vuelve a referenciarlo sí lo une
+    appended.fail = False
+    assert len(link_across_batches([factura], store)) == 1
+
+
+def test_failed_append_keeps_the_reference_pending(tmp_path, store, appended):
+    factura = _archived(
+        tmp_path, "FAC - F-1.pdf", tipo=TipoDocumento.FACTURA, numero_factura="F-1",
+        numeros_albaran_ref=["27780"],
+    )
+    link_across_batches([factura], store)
+    albaran = _archived(tmp_path, "ALB - 27780.pdf", tipo=TipoDocumento.ALBARAN, numero_albaran="27780")
+
+    appended.fail = True
+    link_across_batches([albaran], store)
+
+    assert albaran.factura_asociada_id is None
+    assert store.find_ref("27780", "B12345674")[0] == factura.id
+    assert store.find_albaran("27780", "B12345674")[0] == albaran.id
+
+
+def test_albaran_joins_an_earlier_factura(tmp_path, store, appended):
+    factura = _archived(
+        tmp_path, "FAC - F-1.pdf", tipo=TipoDocumento.FACTURA, numero_factura="F-1",
+        numeros_albaran_ref=["27780"],
+    )
+    link_across_batches([factura], store)
+    albaran = _archived(tmp_path, "ALB - 27780.pdf", tipo=TipoDocumento.ALBARAN, numero_albaran="27780")
+    link_across_batches([albaran], store)
+
+    assert albaran.factura_asociada_id == factura.id
+    assert albaran.ruta_destino == factura.ruta_destino
+    assert store.find_ref("27780", "B12345674") is None
+
+
+def test_different_nif_or_missing_pdf_does_not_match(tmp_path, store, appended):
+    albaran = _archived(tmp_path, "ALB - 27780.pdf", tipo=TipoDocumento.ALBARAN, numero_albaran="27780")
+    link_across_batches([albaran], store)
+
+    assert store.find_albaran("27780", "A58818501") is None
+    assert store.find_albaran("27780", "")[0] == albaran.id
+
+    (tmp_path / "ALB - 27780.pdf").unlink()
+    assert store.find_albaran("27780", "B12345674") is None
+
+
+def test_append_pdf(tmp_path):
+    import fitz
+
+    def pdf(name, pages):
+        path = tmp_path / name
+        with fitz.open() as doc:
+            for _ in range(pages):
+                doc.new_page()
+            doc.save(str(path))
+        return path
+
+    target, source = pdf("factura.pdf", 2), pdf("albaran.pdf", 1)
+    pending_associations.append_pdf(target, source)
+
+    with fitz.open(str(target)) as doc:
+        assert doc.page_count == 3
+    assert not source.exists()
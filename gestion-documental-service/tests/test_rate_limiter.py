@@ -0,0 +1,85 @@
+"""Limitador adaptativo de concurrencia (`AdaptiveLimiter`)."""
+
+import asyncio
+from types import SimpleNamespace
+
+from core.rate_limiter import AdaptiveLimiter, is_rate_limit, retry_after_seconds
+
+
+def _error_429(headers=None):
+    return SimpleNamespace(status_code=429, response=SimpleNamespace(headers=headers or {}))
+
+
+def test_slots_granted_by_priority_then_arrival():
+    async def scenario():
+        limiter = AdaptiveLimiter(max_limit=1, initial=1)
+        await limiter.acquire()
+        order = []
+
+        async def worker(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = [asyncio.create_task(worker(n, p)) for n, p in [("a", 1), ("b", 0), ("c", 1)]]
+        await asyncio.sleep(0)
+        assert limiter.in_flight == 1
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.in_flight
+
+    assert asyncio.run(scenario()) == (["b", "a", "c"], 0)
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        limiter = AdaptiveLimiter(max_limit=1, initial=1)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        limiter.release()
+        await limiter.acquire()
+        return limiter.in_flight
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_additive_increase_while_healthy():
+    limiter = AdaptiveLimiter(max_limit=4, initial=2, latency_target=5.0)
+    for _ in range(10):
+        limiter.on_success(1.0)
+    assert limiter.limit == 4
+
+    slow = AdaptiveLimiter(max_limit=4, initial=2, latency_target=5.0)
+    slow.on_success(10.0)
+    assert slow.limit == 2
+
+
+def test_rate_limit_halves_once_and_blocks():
+    limiter = AdaptiveLimiter(max_limit=8, initial=8)
+    limiter.on_error(_error_429({"retry-after": "3"}))
+    limiter.on_error(_error_429())  # misma ráfaga: no se reduce otra vez
+    assert limiter.limit == 4
+    assert limiter.rate_limited == 2
+    assert limiter._blocked_until > 0
+
+    limiter.on_error(ValueError("otro"))
+    assert limiter.rate_limited == 2
+
+
+def test_rate_limit_never_below_min():
+    limiter = AdaptiveLimiter(max_limit=2, min_limit=1, initial=1)
+    limiter.on_timeout()
+    assert limiter.limit == 1
+
+
+def test_retry_after_headers():
+    assert is_rate_limit(_error_429())
+    assert is_rate_limit(SimpleNamespace(response=SimpleNamespace(status_code=429)))
+    assert not is_rate_limit(SimpleNamespace(status_code=500))
+    assert retry_after_seconds(_error_429({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(_error_429({"retry-after": "2"})) == 2.0
+    assert retry_after_seconds(_error_429({"retry-after": "Wed, 21 Oct 2026 07:28:00 GMT"})) is None
+    assert retry_after_seconds(ValueError()) is None
@@ -0,0 +1,86 @@
+"""Validación local de NIFs, nºs de documento y fechas."""
+
+from datetime import date
+
+import pytest
+
+pytest.importorskip("thefuzz")
+
+from core.models import PageResult, TipoDocumento  # noqa: E402
+from core.supplier_lookup import Supplier  # noqa: E402
+from core.validators import (  # noqa: E402
+    PageValidator, normalize_nif, plausible_date, valid_document_number, valid_nif,
+)
+
+TODAY = date(2024, 3, 20)
+
+
+@pytest.mark.parametrize("nif", [
+    "12345678Z",        # DNI
+    "X1234567L",        # NIE
+    "K1234567L",        # NIF K/L/M
+    "B12345674",        # CIF con dígito de control
+    "Q2826000H",        # CIF con letra de control
+    "A58818501",
+    "ES-B12345674",     # prefijo de país y separadores
+    "b-12345674",
+])
+def test_valid_nif(nif):
+    assert valid_nif(nif)
+
+
+@pytest.mark.parametrize("nif", [
+    "12345678A", "X1234567A", "B12345675", "Q2826000A", "B1234567", "", None, "FMV",
+])
+def test_invalid_nif(nif):
+    assert not valid_nif(nif)
+
+
+def test_normalize_nif():
+    assert normalize_nif("es b-12.345.674") == "B12345674"
+
+
+@pytest.mark.parametrize("value", [
+    "123", "F-2024/001", "A 12.5", "FAC#2024-1", "  F-1  ",
+    "Nº 123", "Nº123", "N.º 2024/15", "N° 77", "No. 4567", "Núm. 88", "NÚMERO: 12", "#4521",
+    "NO-2024-1",
+])
+def test_valid_document_number(value):
+    assert valid_document_number(value)
+
+
+@pytest.mark.parametrize("value", ["", None, "ABC", "Nº", "N-", "-123", "1" * 31, "12*4"])
+def test_invalid_document_number(value):
+    assert not valid_document_number(value)
+
+
+def test_plausible_date():
+    assert plausible_date(date(2024, 3, 1), TODAY)
+    assert plausible_date(date(2024, 3, 25), TODAY)
+    assert not plausible_date(date(2024, 4, 30), TODAY)
+    assert not plausible_date(date(2019, 1, 1), TODAY)
+    assert not plausible_date(None, TODAY)
+
+
+def _factura(**fields):
+    values = dict(
+        page_number=1, tipo=TipoDocumento.FACTURA, proveedor_nif="B12345674",
+        numero_factura="F-2024/001", fecha=date(2024, 3, 1), confianza=0.5,
+    )
+    values.update(fields)
+    return PageResult(**values)
+
+
+def test_page_validator_reports_invalid_data():
+    report = PageValidator().check(
+        _factura(proveedor_nif="B12345675", numeros_albaran_ref=["27780", "??"]), TODAY,
+    )
+    assert len(report.errors) == 2
+    assert not report.complete
+
+
+def test_page_validator_complete_with_known_nif():
+    validator = PageValidator([Supplier("P001", "Suministros Norte SL", "B-12345674")])
+    assert validator.check(_factura(numero_factura="Nº 2024/001"), TODAY).complete
+    assert not validator.check(_factura(proveedor_nif="A58818501"), TODAY).complete
+    assert validator.supplier_name("ES B12345674") == "Suministros Norte SL"